@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# -*- coding: iso-8859-1 -*-
+"""
+Compares the streaming parse_catalog of peps_catalog.py with the former
+implementation, which loaded the whole search.json with json.load.
+Peak memory is measured with tracemalloc.
+
+    python benchmarks/bench_parse_catalog.py -n 20000
+"""
+import contextlib
+import json
+import optparse
+import os
+import os.path
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import peps_catalog
+
+
+def make_search_json(fileName, nb_features):
+    """ writes a catalog answer similar to the ones of PEPS, with nb_features features """
+    with open(fileName, "w") as f:
+        f.write('{"type": "FeatureCollection", "properties": {"totalResults": %d, "links": []}, "features": [\n'
+                % nb_features)
+        for i in range(nb_features):
+            day = "2017-%02d-%02d" % (1 + (i // 28) % 12, 1 + i % 28)
+            prod = "S2A_MSIL1C_%sT105031_N0204_R%03d_T31TCJ_%sT%06d" % (
+                day.replace("-", ""), 8 if i % 2 else 51, day.replace("-", ""), i)
+            feature = {
+                "type": "Feature", "id": "%08d-0000-5000-8000-%012d" % (i, i),
+                "geometry": {"type": "Polygon",
+                             "coordinates": [[[0.5 + k * 0.01, 43.0 + k * 0.01] for k in range(40)]]},
+                "properties": {
+                    "collection": "S2ST", "productIdentifier": prod, "productType": "S2MSI1C",
+                    "platform": "S2A", "instrument": "MSI", "orbitNumber": 8000 + i,
+                    "startDate": day + "T10:50:31.026Z", "completionDate": day + "T10:50:31.026Z",
+                    "resourceSize": 500000000 + i, "storage": {"mode": "disk" if i % 3 else "tape"},
+                    "keywords": [{"name": "keyword %d" % k, "id": "%x" % k} for k in range(20)],
+                    "services": {"download": {"url": "https://peps.cnes.fr/resto/collections/S2ST/%d/download" % i,
+                                              "mimeType": "application/zip", "size": 500000000 + i}},
+                },
+            }
+            if i > 0:
+                f.write(",\n")
+            json.dump(feature, f)
+        f.write("\n]}\n")
+
+
+def legacy_parse_catalog(search_json_file, orbit=None):
+    """ parse_catalog as it was before peps_catalog.py """
+    with open(search_json_file) as data_file:
+        data = json.load(data_file)
+    download_dict = {}
+    storage_dict = {}
+    size_dict = {}
+    for i in range(len(data["features"])):
+        prod = data["features"][i]["properties"]["productIdentifier"]
+        print(prod, data["features"][i]["properties"]["storage"]["mode"])
+        feature_id = data["features"][i]["id"]
+        storage = data["features"][i]["properties"]["storage"]["mode"]
+        resourceSize = data["features"][i]["properties"]["resourceSize"]
+        if orbit is None or prod.find("_R%03d" % orbit) > 0:
+            download_dict[prod] = feature_id
+            storage_dict[prod] = storage
+            size_dict[prod] = resourceSize
+    return (prod, download_dict, storage_dict, size_dict)
+
+
+def streaming_parse_catalog(search_json_file, orbit=None):
+    return peps_catalog.parse_catalog(peps_catalog.read_records(search_json_file), orbit)
+
+
+def measure(function, search_json_file):
+    """ returns the duration in seconds and the peak of allocated memory in bytes """
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            result = function(search_json_file)
+            duration = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return duration, peak, result
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--nb_features", dest="nb_features", action="store", type="int",
+                      help="number of features of the synthetic search.json", default=20000)
+    (options, args) = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        search_json_file = os.path.join(tmp_dir, "search.json")
+        make_search_json(search_json_file, options.nb_features)
+        size = os.path.getsize(search_json_file)
+        print("search.json: {:d} features, {:.1f} MB".format(options.nb_features, size / 1e6))
+        results = []
+        for name, function in (("json.load", legacy_parse_catalog), ("streaming", streaming_parse_catalog)):
+            duration, peak, result = measure(function, search_json_file)
+            results.append(result[1:])
+            print("{:10s}: {:6.2f} s  {:8.1f} features/s  peak memory {:7.1f} MB ({:.2f} x file size)".format(
+                name, duration, options.nb_features / duration, peak / 1e6, peak / size))
+        if results[0] != results[1]:
+            print("the two parsers do not give the same selection")
+            sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+#! /usr/bin/env python3
+# -*- coding: iso-8859-1 -*-
+"""
+Offline benchmarks of the parsers and of the download path.
+The fixtures are synthetic: a search.json catalog, WPS status documents, a
+Full_MAJA execution report with many results, and a large zip file served by
+a local HTTP server, generated on the fly so that it takes no disk space.
+For each benchmark, the duration of the runs (percentiles), the throughput
+and the peak of allocated memory are printed, and written as JSON with -o,
+to be compared between versions. The downloads also give the CPU time of the
+downloading thread per GB.
+
+    python3 benchmarks/bench_suite.py -o bench.json
+    python3 benchmarks/bench_suite.py --zip_size 4096 -b downloadFile
+    python3 benchmarks/bench_suite.py -b download_verified --chunk_size 4096 --sync_mb 256
+"""
+import contextlib
+import http.server
+import json
+import optparse
+import os
+import os.path
+import platform
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import peps_catalog
+import peps_http
+import peps_manifest
+import peps_wps
+from bench_parse_catalog import make_search_json
+from full_maja_download import parse_json
+
+# size of the block repeated in the synthetic zip file
+BLOCK_SIZE = 1024 * 1024
+
+###########################################################################
+
+
+def make_status_document(wps_id, nb_references=1):
+    """ returns a wps:ExecuteResponse similar to the status documents of PEPS """
+    references = "".join(
+        '<wps:Output><ows:Identifier>result{0:d}</ows:Identifier>'
+        '<wps:Reference href="https://peps.cnes.fr/cgi-bin/mapcache_results/maja/{1}/report{0:d}.json" '
+        'mimeType="application/json"/></wps:Output>'.format(i, wps_id) for i in range(nb_references))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<wps:ExecuteResponse xmlns:wps="http://www.opengis.net/wps/1.0.0" '
+            'xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'service="WPS" version="1.0.0" '
+            'statusLocation="https://peps.cnes.fr/cgi-bin/mapcache_results/logs/pywps-{0}.xml">'
+            '<wps:Process><ows:Identifier>FULL_MAJA</ows:Identifier></wps:Process>'
+            '<wps:Status creationTime="2019-01-01T00:00:00Z">'
+            '<wps:ProcessSucceeded>PyWPS Process FULL_MAJA successfully calculated</wps:ProcessSucceeded>'
+            '</wps:Status><wps:ProcessOutputs>{1}</wps:ProcessOutputs>'
+            '</wps:ExecuteResponse>\n'.format(wps_id, references)).encode("utf-8")
+
+
+def make_maja_status(wps_id):
+    """ returns the json report of a single product MAJA processing """
+    return json.dumps({"percentCompleted": 100, "status": "FINISHED",
+                       "result": "https://peps.cnes.fr/cgi-bin/mapcache_results/maja/{}/"
+                                 "SENTINEL2A_20170101-105432-759_L2A_T31TCJ_C_V1-0.zip".format(wps_id)},
+                      indent=1).encode("utf-8")
+
+
+def make_report(fileName, nb_results):
+    """ writes a Full_MAJA execution report with nb_results results, and returns their names """
+    names = ["SENTINEL2A_2017{:04d}-105432-759_L2A_T31TCJ_C_V1-0{}.zip".format(i, "_NOVALD" if i % 5 == 0 else "")
+             for i in range(nb_results)]
+    data = {"USER_INFO": {"job_status": "FINISHED", "unprocessed": "0", "process": "100%",
+                          "message": "", "logs": ["log"],
+                          "results": ["https://peps.cnes.fr/cgi-bin/mapcache_results/maja/x/" + name
+                                      for name in names]}}
+    with open(fileName, "w") as f:
+        json.dump(data, f)
+    return names
+
+###########################################################################
+
+
+class SyntheticZip(object):
+    """
+    A zip file with one stored member made of a repeated block of random bytes,
+    whose bytes are computed on demand
+    """
+
+    def __init__(self, size):
+        self.block = os.urandom(BLOCK_SIZE)
+        name = b"data.bin"
+        # local header, data, central directory and zip64 records around size bytes of data
+        self.data_size = size
+        crc = 0
+        for i in range(0, size, BLOCK_SIZE):
+            crc = zlib.crc32(self.block[:min(BLOCK_SIZE, size - i)], crc)
+        extra = struct.pack("<HHQQ", 1, 16, size, size)
+        self.header = struct.pack("<4sHHHHHIIIHH", b"PK\x03\x04", 45, 0, 0, 0, 0, crc,
+                                  0xFFFFFFFF, 0xFFFFFFFF, len(name), len(extra)) + name + extra
+        cd_offset = len(self.header) + size
+        extra = struct.pack("<HHQQQ", 1, 24, size, size, 0)
+        central = struct.pack("<4sHHHHHHIIIHHHHHII", b"PK\x01\x02", 45, 45, 0, 0, 0, 0, crc,
+                              0xFFFFFFFF, 0xFFFFFFFF, len(name), len(extra), 0, 0, 0, 0, 0xFFFFFFFF) + name + extra
+        eocd64_offset = cd_offset + len(central)
+        eocd64 = struct.pack("<4sQHHIIQQQQ", b"PK\x06\x06", 44, 45, 45, 0, 0, 1, 1, len(central), cd_offset)
+        locator = struct.pack("<4sIQI", b"PK\x06\x07", 0, eocd64_offset, 1)
+        eocd = struct.pack("<4sHHHHIIH", b"PK\x05\x06", 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+        self.trailer = central + eocd64 + locator + eocd
+        self.size = len(self.header) + size + len(self.trailer)
+
+    def read(self, offset, length):
+        """ returns length bytes from offset """
+        parts = []
+        end = min(offset + length, self.size)
+        while offset < end:
+            if offset < len(self.header):
+                part = self.header[offset:end]
+            elif offset < len(self.header) + self.data_size:
+                data_offset = offset - len(self.header)
+                start = data_offset % BLOCK_SIZE
+                part = self.block[start:start + min(end - offset, BLOCK_SIZE - start,
+                                                    self.data_size - data_offset)]
+            else:
+                trailer_offset = offset - len(self.header) - self.data_size
+                part = self.trailer[trailer_offset:trailer_offset + end - offset]
+            parts.append(part)
+            offset += len(part)
+        return b"".join(parts)
+
+
+class ZipHandler(http.server.BaseHTTPRequestHandler):
+    """ serves the SyntheticZip of the server at any path, with Range support """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        zip_file = self.server.zip_file
+        start, end = 0, zip_file.size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match is not None:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {:d}-{:d}/{:d}".format(start, end, zip_file.size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        for offset in range(start, end + 1, BLOCK_SIZE):
+            self.wfile.write(zip_file.read(offset, min(BLOCK_SIZE, end + 1 - offset)))
+
+
+def start_server(zip_file):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ZipHandler)
+    server.daemon_threads = True
+    server.zip_file = zip_file
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+###########################################################################
+
+
+def percentile(values, p):
+    """ nearest rank percentile of values """
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def run(function, repeat, trace_memory=True, cpu_times=None):
+    """
+    Calls function repeat times, its output being discarded
+    :param cpu_times: if given, list to which the CPU time of the calling thread during each call is added
+    :return: list of durations in seconds, and the peak of memory allocated by a call, in bytes
+    """
+    durations = []
+    peak = 0
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for i in range(repeat):
+                if trace_memory:
+                    tracemalloc.start()
+                t0 = time.perf_counter()
+                cpu0 = time.thread_time()
+                function()
+                durations.append(time.perf_counter() - t0)
+                if cpu_times is not None:
+                    cpu_times.append(time.thread_time() - cpu0)
+                if trace_memory:
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+    return durations, peak
+
+
+def summary(durations, peak, items, unit):
+    """ statistics of a benchmark, items being the number of unit processed by each run """
+    total = sum(durations)
+    return {"runs": len(durations), "items": items, "unit": unit,
+            "p50_s": percentile(durations, 50), "p90_s": percentile(durations, 90),
+            "p99_s": percentile(durations, 99), "min_s": min(durations), "max_s": max(durations),
+            "throughput": items * len(durations) / total if total > 0 else None,
+            "peak_memory_bytes": peak}
+
+
+def bench_parse_catalog(tmp_dir, options):
+    fileName = os.path.join(tmp_dir, "search.json")
+    make_search_json(fileName, options.nb_features)
+    durations, peak = run(lambda: peps_catalog.parse_catalog(peps_catalog.read_records(fileName)),
+                          options.repeat)
+    return summary(durations, peak, options.nb_features, "features")
+
+
+def bench_parse_wps(tmp_dir, options):
+    document = make_status_document("bench", nb_references=10)
+    n = options.nb_documents
+
+    def parse_all():
+        for i in range(n):
+            peps_wps.parse_wps(document)
+    durations, peak = run(parse_all, options.repeat)
+    result = summary(durations, peak, n, "documents")
+    # latency of one document
+    latencies, unused = run(lambda: peps_wps.parse_wps(document, ("references",)), n, trace_memory=False)
+    result["latency_p50_s"] = percentile(latencies, 50)
+    result["latency_p99_s"] = percentile(latencies, 99)
+    return result
+
+
+def bench_parse_maja_status(tmp_dir, options):
+    document = make_maja_status("bench")
+    n = options.nb_documents
+
+    def parse_all():
+        for i in range(n):
+            peps_wps.parse_maja_status(document)
+    durations, peak = run(parse_all, options.repeat)
+    return summary(durations, peak, n, "documents")
+
+
+def bench_parse_json(tmp_dir, options):
+    """ results loop of a finished job whose products are all downloaded already """
+    write_dir = os.path.join(tmp_dir, "parse_json")
+    os.makedirs(write_dir)
+    json_file = os.path.join(tmp_dir, "report.json")
+    names = make_report(json_file, options.nb_results)
+    manifest = peps_manifest.Manifest(write_dir)
+    for name in names:
+        manifest.entries[name] = {"size": 0, "sha256": "", "verified": True}
+    manifest.save()
+    durations, peak = run(lambda: parse_json(json_file, None, write_dir), options.repeat)
+    return summary(durations, peak, options.nb_results, "results")
+
+
+def bench_downloadFile(tmp_dir, options, verified=False):
+    zip_file = SyntheticZip(options.zip_size * 1024 * 1024)
+    server = start_server(zip_file)
+    url = "http://127.0.0.1:{:d}/bench.zip".format(server.server_address[1])
+    session = peps_http.new_session("bench", "bench", chunk_size=options.chunk_size * 1024,
+                                    sync_bytes=options.sync_mb * 1000000 if options.sync_mb is not None else None)
+    fileName = os.path.join(tmp_dir, "bench.zip")
+
+    def download():
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        if verified:
+            manifest = peps_manifest.Manifest(tmp_dir)
+            peps_manifest.download_verified(session, url, fileName, manifest)
+        else:
+            peps_http.downloadFile(session, url, fileName)
+    # tracemalloc slows down the copy loop: memory is measured on a separate run
+    cpu_times = []
+    durations, unused = run(download, options.repeat, trace_memory=False, cpu_times=cpu_times)
+    unused, peak = run(download, 1)
+    os.remove(fileName)
+    server.shutdown()
+    server.server_close()
+    result = summary(durations, peak, zip_file.size / 1e6, "MB")
+    # the server runs in the same process: only the downloading thread is measured
+    result["cpu_s_per_GB"] = percentile(cpu_times, 50) / (zip_file.size / 1e9)
+    return result
+
+
+BENCHMARKS = [
+    ("parse_catalog", bench_parse_catalog),
+    ("parse_wps", bench_parse_wps),
+    ("parse_maja_status", bench_parse_maja_status),
+    ("parse_json", bench_parse_json),
+    ("downloadFile", bench_downloadFile),
+    ("download_verified", lambda tmp_dir, options: bench_downloadFile(tmp_dir, options, verified=True)),
+]
+
+
+def version():
+    """ git revision of the scripts, if available """
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-o", "--output", dest="output", action="store", type="string",
+                      help="JSON file where the results are written", default=None)
+    parser.add_option("-b", "--benchmark", dest="benchmarks", action="append", type="string",
+                      help="benchmark to run (repeatable), among: " + ", ".join(name for name, f in BENCHMARKS))
+    parser.add_option("-r", "--repeat", dest="repeat", action="store", type="int",
+                      help="number of runs of each benchmark", default=5)
+    parser.add_option("-n", "--nb_features", dest="nb_features", action="store", type="int",
+                      help="number of features of the synthetic search.json", default=5000)
+    parser.add_option("--nb_documents", dest="nb_documents", action="store", type="int",
+                      help="number of WPS documents parsed by a run", default=1000)
+    parser.add_option("--nb_results", dest="nb_results", action="store", type="int",
+                      help="number of results of the synthetic execution report", default=2000)
+    parser.add_option("--zip_size", dest="zip_size", action="store", type="int",
+                      help="size of the downloaded zip file, in MB", default=256)
+    parser.add_option("--chunk_size", dest="chunk_size", action="store", type="int",
+                      help="bytes read at a time by the downloads, in kB", default=peps_http.COPY_SIZE // 1024)
+    parser.add_option("--sync_mb", dest="sync_mb", action="store", type="int",
+                      help="write the downloaded file to the disk every this number of MB (0: once at the end)",
+                      default=None)
+    (options, args) = parser.parse_args()
+
+    selected = options.benchmarks or [name for name, f in BENCHMARKS]
+    unknown = set(selected) - set(name for name, f in BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmark: " + ", ".join(sorted(unknown)))
+
+    results = {"version": version(), "python": platform.python_version(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "parameters": vars(options), "benchmarks": {}}
+    for name, function in BENCHMARKS:
+        if name not in selected:
+            continue
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = function(tmp_dir, options)
+        results["benchmarks"][name] = result
+        print("{:18s}: p50 {:8.4f} s  p90 {:8.4f} s  p99 {:8.4f} s  {:10.1f} {}/s  peak memory {:7.1f} MB".format(
+            name, result["p50_s"], result["p90_s"], result["p99_s"], result["throughput"], result["unit"],
+            result["peak_memory_bytes"] / 1e6) + (
+            "  cpu {:6.3f} s/GB".format(result["cpu_s_per_GB"]) if "cpu_s_per_GB" in result else ""))
+
+    if resource is not None:
+        # ru_maxrss is in kB on Linux
+        results["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Submits a list of Full_MAJA processings to PEPS, a few at a time.
+PEPS processes at most 10 tiles in parallel for all its users, the other ones
+are kept PENDING. The jobs of the manifest are queued locally, and a new one is
+submitted each time one of ours ends, so that at most max_jobs are in flight.
+"""
+import os
+import os.path
+import optparse
+import sys
+import time
+import requests
+import peps_http
+import peps_jobs
+import peps_manifest
+import peps_metrics
+from full_maja_process import check_params, split_period, submit, OVERLAP_DAYS
+from full_maja_download import get_job_status, parse_json
+
+###########################################################################
+
+
+class OptionParser (optparse.OptionParser):
+
+    def check_required(self, opt):
+        option = self.get_option(opt)
+
+        # Assumes the option's 'default' is set to None!
+        if getattr(self.values, option.dest) is None:
+            self.error("%s option not supplied" % option)
+
+###########################################################################
+
+# once a job has one of these status, it does not use a PEPS slot anymore
+FINAL_STATUS = ("FINISHED", "ERROR", "CANCELED")
+
+
+def job_name(tile, orbit, start_date, end_date):
+    return "Full_MAJA_{}_{}_{}_{}".format(tile, orbit if orbit is not None else "all", start_date, end_date)
+
+
+class Job(object):
+    """
+    one Full_MAJA processing of the manifest, or one window of a longer period
+    of the manifest, which is downloaded with the other windows in the folder
+    named after the whole period, and submitted after the previous window
+    """
+
+    def __init__(self, tile, orbit, start_date, end_date, log_dir, series=None, previous=None):
+        if tile.startswith('T'):
+            tile = tile[1:]
+        self.tile = tile
+        self.orbit = orbit
+        self.start_date = start_date
+        self.end_date = end_date
+        self.name = job_name(tile, orbit, start_date, end_date)
+        self.series = series if series is not None else self.name
+        self.previous = previous
+        self.logName = os.path.join(log_dir, self.name + ".log")
+        self.status = None
+
+    def ready(self):
+        """ tells if the job can be submitted: the previous window, if any, is over """
+        return self.previous is None or self.previous.status in FINAL_STATUS + ("INVALID", "REJECTED")
+
+
+def read_manifest(manifest, log_dir, split=False, overlap=OVERLAP_DAYS, chain=True):
+    """
+    Reads the jobs of a manifest, one job per line : tile,orbit,start_date,end_date
+    The orbit may be left empty to process all the orbits. Lines starting with # are ignored.
+    With split, the periods longer than a year are split in windows overlapping by
+    overlap days (see full_maja_process.split_period), each window being submitted
+    once the previous one is over if chain is set.
+    """
+    jobs = []
+    with open(manifest) as f:
+        for ligne in f.readlines():
+            ligne = ligne.strip()
+            if ligne == "" or ligne.startswith("#") or ligne.startswith("tile"):
+                continue
+            (tile, orbit, start_date, end_date) = [field.strip() for field in ligne.split(",")]
+            orbit = int(orbit) if orbit != "" else None
+            windows = split_period(start_date, end_date, overlap) if split else [(start_date, end_date)]
+            if len(windows) == 1:
+                jobs.append(Job(tile, orbit, start_date, end_date, log_dir))
+                continue
+            series = job_name(tile[1:] if tile.startswith('T') else tile, orbit, start_date, end_date)
+            previous = None
+            for (window_start, window_end) in windows:
+                job = Job(tile, orbit, window_start, window_end, log_dir, series, previous if chain else None)
+                jobs.append(job)
+                previous = job
+    return jobs
+
+###########################################################################
+
+
+class Scheduler(object):
+    """ keeps at most max_jobs of the jobs submitted and not finished """
+
+    def __init__(self, session, jobs, store, max_jobs=10, write_dir=None, download_jobs=1):
+        self.session = session
+        self.store = store
+        self.max_jobs = max_jobs
+        self.write_dir = write_dir
+        self.download_jobs = download_jobs
+        # a job with a log file was submitted by a previous run, and does not need
+        # any request if the store knows that it is over and downloaded
+        self.queued = [job for job in jobs if not os.path.exists(job.logName)]
+        self.in_flight = []
+        self.done = []
+        for job in jobs:
+            if os.path.exists(job.logName):
+                manifest = None
+                if write_dir is not None:
+                    manifest = peps_manifest.Manifest(os.path.join(write_dir, job.series))
+                if store.is_complete(job.name, manifest, stitch=job.series != job.name):
+                    job.status = store.job(job.name).status
+                    self.done.append(job)
+                else:
+                    self.in_flight.append(job)
+
+    def poll(self):
+        """ updates the status of the jobs in flight, returns the jobs which just finished """
+        finished = []
+        for job in list(self.in_flight):
+            try:
+                JSONFileName, job.status = get_job_status(self.session, job.logName, self.store)
+            except Exception as e:
+                print("{}: status not available ({!r})".format(job.name, e))
+                continue
+            print("{}: {}".format(job.name, job.status))
+            if job.status in FINAL_STATUS:
+                self.in_flight.remove(job)
+                self.done.append(job)
+                if job.status == "FINISHED":
+                    finished.append((job, JSONFileName))
+        return finished
+
+    def fill(self):
+        """ submits queued jobs while less than max_jobs are in flight """
+        while len(self.in_flight) < self.max_jobs:
+            ready = [job for job in self.queued if job.ready()]
+            if len(ready) == 0:
+                return
+            job = ready[0]
+            self.queued.remove(job)
+            try:
+                check_params(job.start_date, job.end_date, job.tile, job.orbit)
+            except ValueError as e:
+                print("{}: {}".format(job.name, e))
+                job.status = "INVALID"
+                self.done.append(job)
+                continue
+            print("*** submission of {} ***".format(job.name))
+            try:
+                accepted = submit(self.session, job.start_date, job.end_date, job.tile, job.orbit,
+                                  job.logName, self.store)
+            except (requests.exceptions.RequestException, IOError) as e:
+                # PEPS not reachable: the job is submitted again at the next cycle, without
+                # a log file, which would make the next runs poll it
+                print("{}: submission failed ({!r}), will retry".format(job.name, e))
+                if os.path.exists(job.logName):
+                    os.remove(job.logName)
+                self.queued.insert(0, job)
+                return
+            if accepted:
+                job.status = "SUBMITTED"
+                self.in_flight.append(job)
+            else:
+                # keep the answer for diagnosis, without making the job look submitted
+                os.rename(job.logName, job.logName + ".rejected")
+                job.status = "REJECTED"
+                self.done.append(job)
+
+    def download(self, job, JSONFileName):
+        # the windows of a period are stitched in the folder of the period
+        write_dir = os.path.join(self.write_dir, job.series)
+        if not os.path.exists(write_dir):
+            os.makedirs(write_dir)
+        parse_json(JSONFileName, self.session, write_dir, self.download_jobs, store=self.store,
+                   stitch=job.series != job.name)
+
+    def run(self, interval):
+        while True:
+            finished = self.poll()
+            # free slots are used before downloading, which can take a while
+            self.fill()
+            if self.write_dir is not None:
+                for (job, JSONFileName) in finished:
+                    self.download(job, JSONFileName)
+            print("{:d} jobs queued, {:d} in flight, {:d} done".format(
+                len(self.queued), len(self.in_flight), len(self.done)))
+            peps_metrics.set_gauge("peps_jobs", len(self.queued), state="queued")
+            peps_metrics.set_gauge("peps_jobs", len(self.in_flight), state="in_flight")
+            peps_metrics.set_gauge("peps_jobs", len(self.done), state="done")
+            peps_metrics.export()
+            if len(self.queued) == 0 and len(self.in_flight) == 0:
+                break
+            time.sleep(interval)
+        for job in self.done:
+            print("{}: {}".format(job.name, job.status))
+
+
+# ######################### MAIN
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example : python %s -a peps.txt -m tiles.csv -g ./logs -c 4 -w ./Full_MAJA_OUTPUT_DIR" % sys.argv[0])
+        sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("-m", "--manifest", dest="manifest", action="store", type="string",
+                          help="file with one job per line : tile,orbit,start_date,end_date")
+        parser.add_option("-g", "--log_dir", dest="log_dir", action="store", type="string",
+                          help="directory for the log files of the jobs", default='.')
+        parser.add_option("-c", "--max_jobs", dest="max_jobs", action="store", type="int",
+                          help="maximum number of our jobs in flight at PEPS", default=10)
+        parser.add_option("-i", "--interval", dest="interval", action="store", type="int",
+                          help="seconds between two status polls", default=600)
+        parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
+                          help="if given, finished jobs are downloaded there, one sub-directory per job",
+                          default=None)
+        parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int",
+                          help="number of products downloaded in parallel", default=1)
+        parser.add_option("--split", dest="split", action="store_true",
+                          help="split the periods longer than a year into windows processed one after the other",
+                          default=False)
+        parser.add_option("--overlap", dest="overlap", action="store", type="int",
+                          help="with --split, days of a window processed again by the next one for the "
+                          "initialisation of MAJA", default=OVERLAP_DAYS)
+        parser.add_option("--parallel_windows", dest="parallel_windows", action="store_true",
+                          help="with --split, submit the windows of a period without waiting for the previous one",
+                          default=False)
+        parser.add_option("--adaptive", dest="adaptive", action="store_true",
+                          help="lower the number of parallel downloads when PEPS is overloaded", default=False)
+        parser.add_option("--max_rate", dest="max_rate", action="store", type="float",
+                          help="maximum total download throughput, in MB/s", default=None)
+        parser.add_option("--reserve", dest="reserve", action="store", type="float",
+                          help="GB kept free on the output volume, the downloads wait for space beyond it",
+                          default=peps_http.DISK_RESERVE / 1e9)
+        parser.add_option("--chunk_size", dest="chunk_size", action="store", type="int",
+                          help="bytes read at a time by each download, in kB", default=peps_http.COPY_SIZE // 1024)
+        parser.add_option("--sync_mb", dest="sync_mb", action="store", type="int",
+                          help="write the downloaded files to the disk every this number of MB "
+                          "(0: once each file is complete; by default, left to the system)", default=None)
+        parser.add_option("--metrics", dest="metrics", action="store", type="string",
+                          help="file where the metrics are written after each poll: Prometheus textfile "
+                          "if its name ends with .prom, else JSON lines", default=None)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-a")
+        parser.check_required("-m")
+        peps_metrics.enable(options.metrics)
+
+        if not (os.path.exists(options.log_dir)):
+            os.mkdir(options.log_dir)
+        if options.write_dir is not None and not (os.path.exists(options.write_dir)):
+            os.mkdir(options.write_dir)
+    print("---------------------------------------------------------------------------")
+
+    # ====================
+    # read authentification file
+    # ====================
+    try:
+        f = open(options.auth)
+        try:
+            (email, passwd) = f.readline().split(' ')
+            if passwd.endswith('\n'):
+                passwd = passwd[:-1]
+            f.close()
+        except ValueError:
+            print("error with password file content")
+            sys.exit(-2)
+    except IOError:
+        print("error with password file")
+        sys.exit(-2)
+
+    try:
+        jobs = read_manifest(options.manifest, options.log_dir, options.split, options.overlap,
+                             not options.parallel_windows)
+    except (IOError, ValueError) as e:
+        print("error with manifest file: {}".format(e))
+        sys.exit(-3)
+
+    session = peps_http.get_session(email, passwd, jobs=options.jobs,
+                                    adaptive=options.adaptive, max_rate=options.max_rate,
+                                    reserve=int(options.reserve * 1e9), chunk_size=options.chunk_size * 1024,
+                                    sync_bytes=options.sync_mb * 1000000 if options.sync_mb is not None else None)
+    store = peps_jobs.JobStore(os.path.join(options.log_dir, peps_jobs.STATE_NAME))
+    scheduler = Scheduler(session, jobs, store, options.max_jobs, options.write_dir, options.jobs)
+    scheduler.run(options.interval)
+    print("---------------------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
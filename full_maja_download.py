@@ -10,7 +10,18 @@ import optparse
 import sys
 import requests
 import json
-import shutil
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import peps_extract
+import peps_http
+import peps_jobs
+import peps_manifest
+import peps_metrics
+import peps_wps
 
 ###########################################################################
 
@@ -27,32 +38,83 @@ class OptionParser (optparse.OptionParser):
 # ##########################################################################
 
 
-def downloadFile(url, fileName, email, password):
-    r = requests.get(url, auth=(email, passwd), stream=True, verify=False)
-    with open(fileName, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
-    return
-
-
-def getURL(url, fileName, email, passwd):
-    req = requests.get(url, auth=(email, passwd), verify=False)
-    with open(fileName, "w") as f:
-        if sys.version_info[0] < 3:
-            f.write(req.text.encode('utf-8'))
-        else:    
-            f.write(req.text)
-        if req.status_code == 200:
-            print("Request OK")
-        else:
-            print("Wrong request status {}".format(str(req.status_code)))
-            sys.exit(-1)
-
-    return
+def download_products(downloads, session, manifest, jobs=1, extract=False, keep_zip=False, include=None):
+    """ downloads (url, fileName) pairs with a pool of at most jobs threads
+
+    Each file is verified while it is downloaded and recorded in the manifest
+    With extract, the products are unzipped on the fly to their folder, and the
+    zip file is only kept with keep_zip
+    With include, a list of glob patterns, only the matching files of the
+    products are downloaded to their folder
+
+    Returns a list of (fileName, size, seconds) for the completed downloads
+    """
+    todo = queue.Queue()
+    for download in downloads:
+        todo.put(download)
+    stats = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                (url, fileName) = todo.get_nowait()
+            except queue.Empty:
+                return
+            L2AName = os.path.basename(fileName)
+            print("downloading %s" % L2AName)
+            t0 = time.time()
+            try:
+                if include:
+                    size = peps_extract.extract_members(session, url, fileName, include, manifest)
+                elif extract:
+                    size = peps_extract.extract_verified(session, url, fileName, manifest, keep_zip)
+                else:
+                    size = peps_manifest.download_verified(session, url, fileName, manifest)
+            except (requests.exceptions.RequestException, IOError) as e:
+                print("download of {} failed: {}".format(L2AName, e))
+                peps_metrics.count("peps_downloads_total", result="failed")
+                continue
+            peps_metrics.count("peps_downloads_total", result="completed")
+            with lock:
+                stats.append((fileName, size, time.time() - t0))
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(jobs, len(downloads))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def print_throughput(stats, elapsed):
+    """ prints per-file and aggregate download throughput """
+    if len(stats) == 0:
+        return
+    total = 0
+    for (fileName, size, seconds) in stats:
+        total += size
+        print("{}: {:.1f} MB in {:.1f} s ({:.2f} MB/s)".format(
+            os.path.basename(fileName), size / 1e6, seconds, size / 1e6 / max(seconds, 1e-6)))
+    print("downloaded {:d} files, {:.1f} MB in {:.1f} s ({:.2f} MB/s)".format(
+        len(stats), total / 1e6, elapsed, total / 1e6 / max(elapsed, 1e-6)))
 
 ###########################################################################
 
 
-def parse_json(json_file, email, passwd, write_dir):
+def parse_json(json_file, session, write_dir, jobs=1, extract=False, keep_zip=False, include=None, store=None,
+               manifest=None, stitch=False):
+    """
+    Downloads the results of a job if it is finished, and records the state of
+    each of them in store (peps_jobs.JobStore) if given
+    The products already in write_dir are found in its index, manifest
+    (peps_manifest.Manifest), which is read from write_dir if not given.
+    With stitch, for the windows of a period downloaded to the same write_dir,
+    a product is also skipped if the same acquisition (platform, date and tile)
+    is already there, processed by another window.
+    """
+    job = peps_jobs.job_name(json_file)
     with open(json_file) as data_file:
         data = json.load(data_file)
     status = data["USER_INFO"]["job_status"]
@@ -60,15 +122,36 @@ def parse_json(json_file, email, passwd, write_dir):
     if status == "FINISHED":
         print("finished")
         results = data["USER_INFO"]["results"]
+        if manifest is None:
+            manifest = peps_manifest.Manifest(write_dir)
+        acquisitions = manifest.acquisitions(include) if stitch else set()
+        downloads = []
         for urlL2A in results:
             L2AName = urlL2A.split('/')[-1]
             if L2AName.find('NOVALD') >= 0:
                 print("%s was too cloudy" % L2AName)
-            elif os.path.isfile(os.path.join(write_dir, L2AName)):
+            elif manifest.check(os.path.join(write_dir, L2AName), include):
                 print("skipping {}: already on disk".format(L2AName))
+                if store is not None:
+                    store.record_file(job, L2AName, peps_jobs.DOWNLOADED)
+            elif peps_manifest.acquisition(L2AName) in acquisitions:
+                print("skipping {}: processed by another window".format(L2AName))
+                if store is not None:
+                    store.record_file(job, L2AName, peps_jobs.DOWNLOADED)
             else:
-                print("downloading %s" % L2AName)
-                downloadFile(urlL2A, "%s/%s" % (write_dir, L2AName), email, passwd)
+                downloads.append((urlL2A, "%s/%s" % (write_dir, L2AName)))
+        t0 = time.time()
+        with peps_metrics.stage("download"):
+            stats = download_products(downloads, session, manifest, jobs, extract, keep_zip, include)
+        print_throughput(stats, time.time() - t0)
+        if store is not None:
+            completed = dict((os.path.basename(fileName), size) for (fileName, size, seconds) in stats)
+            for (urlL2A, fileName) in downloads:
+                L2AName = os.path.basename(fileName)
+                if L2AName in completed:
+                    store.record_file(job, L2AName, peps_jobs.DOWNLOADED, completed[L2AName])
+                else:
+                    store.record_file(job, L2AName, peps_jobs.FAILED)
         n_unproc = int(data["USER_INFO"]["unprocessed"])
         if n_unproc > 0:
             print("\nWarning: {:d} products have not been processed".format(n_unproc))
@@ -89,113 +172,222 @@ def parse_json(json_file, email, passwd, write_dir):
         finalLog = json_file.replace(".json", ".finalLog")
         print(message)
 
-    return
+    return status
 
 
-# ######################### MAIN
-# ==================
-# parse command line
-# ==================
-if len(sys.argv) == 1:
-    prog = os.path.basename(sys.argv[0])
-    print('      ' + sys.argv[0] + ' [options]')
-    print("     Aide : ", prog, " --help")
-    print("        ou : ", prog, " -h")
-    print("example : python %s -a peps.txt -g Full_MAJA_31TCJ_51_2019.log -w ./Full_MAJA_31TCJ_51_2019 " %
-          sys.argv[0])
-
-    sys.exit(-1)
-else:
-    usage = "usage: %prog [options] "
-    parser = OptionParser(usage=usage)
-
-    parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
-                      help="Path where the products should be downloaded", default='.')
-    parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
-                      help="Peps account and password file")
-    parser.add_option("-l", "--log", dest="logName", action="store", type="string",
-                      help="log file name ", default='Full_Maja.log')
-
-    (options, args) = parser.parse_args()
-    parser.check_required("-a")
-
-    if not (os.path.exists(options.write_dir)):
-        os.mkdir(options.write_dir)
-print("---------------------------------------------------------------------------")
-
-
-# ====================
-# read authentification file
-# ====================
-try:
-    f = open(options.auth)
+def read_log(logName, store=None):
+    """
+    Gets the WPS id and the status url from the job store, or from the log written by full_maja_process.py
+    IOError is raised if the log can't be read, ValueError if it has no status url.
+    """
+    if store is not None:
+        job = store.job(peps_jobs.job_name(logName))
+        if job is not None and job.status_url is not None:
+            return job.wps_id, job.status_url
     try:
-        (email, passwd) = f.readline().split(' ')
-        if passwd.endswith('\n'):
-            passwd = passwd[:-1]
-        f.close()
-    except ValueError:
-        print("error with password file content")
-        sys.exit(-2)
-except IOError:
-    print("error with password file")
-    sys.exit(-2)
-
-# =======================================
-# read log file from full_maja_process.py
-# =======================================
-
-try:
-    with open(options.logName) as f:
-        lignes = f.readlines()
-        urlStatus = None
-        for ligne in lignes:
-            if ligne.startswith("<wps:ExecuteResponse"):
-                wpsId = ligne.split("pywps-")[1].split(".xml")[0]
-                urlStatus = ligne.split('statusLocation="')[1].split('">')[0]
-        if urlStatus is None:
-            print("url for production status not found in logName %s" % options.logName)
-            sys.exit(-4)
-except IOError:
-    print("error with logName file provided as input or as default parameter")
-    sys.exit(-3)
-
-statusFileName = options.logName.replace('log', 'stat')
-getURL(urlStatus, statusFileName, email, passwd)
-
-peps = "http://peps.cnes.fr/resto/wps"
-
-url = "{}?request=execute&service=WPS&version=1.0.0&identifier=PROCESSING_STATUS&datainputs=wps_id={}&status=false&storeExecuteResponse=false".format(
-    peps, wpsId)
-
-# Update log files
-print("Updating status files: {}".format(url))
-req = requests.get(url, auth=(email, passwd))
-
-
-# get json file from urlStatus
-# ====================
-
-try:
-    with open(statusFileName) as f:
-        lignes = f.readlines()
-        urlJSON = None
-        for ligne in lignes:
-            if ligne.find("<wps:Reference") >= 0:
-                urlJSON = ligne.split('href="')[1].split('"')[0]
+        status = peps_wps.parse_wps_file(logName, ("wps_id", "status_location"))
+    except IOError as e:
+        raise IOError("error with log file {}: {}".format(logName, e))
+    if status.status_location is None:
+        raise ValueError("url for production status not found in log file %s" % logName)
+    if store is not None:
+        store.record_location(peps_jobs.job_name(logName), status.wps_id, status.status_location)
+    return status.wps_id, status.status_location
+
+
+def get_execution_report(session, logName, store=None):
+    """ updates the processing status and gets the json execution report
+
+    With a store, the status document and the report are only downloaded if
+    they changed since the last call (see peps_http.ResponseCache)
+    Returns the name of the json file written next to logName, and False if
+    the report did not change
+    IOError is raised if a request fails, ValueError if an answer can't be used.
+    """
+    wpsId, urlStatus = read_log(logName, store)
+    cache = store.cache if store is not None else None
+
+    # the status document is parsed in memory, until its first wps:Reference
+    statusDocument, modified = peps_http.getConditional(session, urlStatus, cache)
+
+    peps = "http://peps.cnes.fr/resto/wps"
+
+    url = "{}?request=execute&service=WPS&version=1.0.0&identifier=PROCESSING_STATUS&datainputs=wps_id={}&status=false&storeExecuteResponse=false".format(
+        peps, wpsId)
+
+    # Update log files
+    print("Updating status files: {}".format(url))
+    with peps_http.Transfer(session, "status") as transfer:
+        req = session.get(url)
+        transfer.answer(req)
+        transfer.data(req.content)
+
+    # get json file from urlStatus
+    # ====================
+    urlJSON = None
+    if not modified:
+        urlJSON = cache.parsed(urlStatus)
+    if urlJSON is None:
+        urlJSON = peps_wps.parse_wps(statusDocument, ("references",)).json_url
         if urlJSON is None:
-            print("url for json output not found in statusFileName %s" % statusFileName)
-            sys.exit(-4)
-except IOError:
-    print("error with status url found in logName")
-    sys.exit(-3)
+            raise ValueError("url for json output not found in status document %s" % urlStatus)
+        if cache is not None:
+            cache.set_parsed(urlStatus, urlJSON)
+
+    # get urlJSON:
+    print("Execution report: {}".format(urlJSON))
+    JSONFileName = os.path.splitext(logName)[0] + '.json'
+    report, modified = peps_http.getConditional(session, urlJSON, cache)
+    if modified or not os.path.isfile(JSONFileName):
+        with open(JSONFileName, "wb") as f:
+            f.write(report)
+    return JSONFileName, modified
+
+
+def get_job_status(session, logName, store=None):
+    """ returns the json execution report of the job and its status (PENDING, STALLED, FINISHED...)
+
+    If given, the status, the progress and the results are recorded in store
+    Errors are raised as by get_execution_report.
+    """
+    with peps_metrics.stage("poll"):
+        JSONFileName, modified = get_execution_report(session, logName, store)
+    if not modified:
+        # the report is the same as at the last call, whose status is in the store
+        job = store.job(peps_jobs.job_name(logName))
+        if job is not None and job.status is not None:
+            print("status unchanged: {}".format(job.status))
+            return JSONFileName, job.status
+    with open(JSONFileName) as data_file:
+        data = json.load(data_file)
+    info = data["USER_INFO"]
+    if store is not None:
+        store.record_status(peps_jobs.job_name(logName), info["job_status"], info.get("process"),
+                            info.get("message"), info.get("results", []) if info["job_status"] == "FINISHED" else [])
+    return JSONFileName, info["job_status"]
 
-# get urlJSON:
-print("Execution report: {}".format(urlJSON))
-JSONFileName = options.logName.replace('log', 'json')
-getURL(urlJSON, JSONFileName, email, passwd)
 
+# ######################### MAIN
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example : python %s -a peps.txt -g Full_MAJA_31TCJ_51_2019.log -w ./Full_MAJA_31TCJ_51_2019 " %
+              sys.argv[0])
+
+        sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
+                          help="Path where the products should be downloaded", default='.')
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("-l", "--log", dest="logName", action="store", type="string",
+                          help="log file name ", default='Full_Maja.log')
+        parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int",
+                          help="number of products downloaded in parallel", default=1)
+        parser.add_option("--max_per_host", dest="max_per_host", action="store", type="int",
+                          help="maximum number of connections to one host (default: jobs + 2)", default=None)
+        parser.add_option("--adaptive", dest="adaptive", action="store_true",
+                          help="lower the number of parallel downloads when PEPS is overloaded", default=False)
+        parser.add_option("--max_rate", dest="max_rate", action="store", type="float",
+                          help="maximum total download throughput, in MB/s", default=None)
+        parser.add_option("--reserve", dest="reserve", action="store", type="float",
+                          help="GB kept free on the output volume, the downloads wait for space beyond it",
+                          default=peps_http.DISK_RESERVE / 1e9)
+        parser.add_option("--chunk_size", dest="chunk_size", action="store", type="int",
+                          help="bytes read at a time by each download, in kB", default=peps_http.COPY_SIZE // 1024)
+        parser.add_option("--sync_mb", dest="sync_mb", action="store", type="int",
+                          help="write the downloaded files to the disk every this number of MB "
+                          "(0: once each file is complete; by default, left to the system)", default=None)
+        parser.add_option("--extract", dest="extract", action="store_true",
+                          help="unzip the products while they are downloaded", default=False)
+        parser.add_option("--keep-zip", dest="keep_zip", action="store_true",
+                          help="with --extract, keep the zip files too", default=False)
+        parser.add_option("--include", dest="include", action="append", type="string",
+                          help="only download the files of the products matching this pattern, "
+                          "such as '*_FRE_B4.tif' (may be repeated)", default=None)
+        parser.add_option("--rescan", dest="rescan", action="store_true",
+                          help="update the index of the products of write_dir from its content", default=False)
+        parser.add_option("--metrics", dest="metrics", action="store", type="string",
+                          help="file where the metrics of the run are written: Prometheus textfile if "
+                          "its name ends with .prom, else JSON lines", default=None)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-a")
+        peps_metrics.enable(options.metrics)
+
+        if not (os.path.exists(options.write_dir)):
+            os.mkdir(options.write_dir)
+    print("---------------------------------------------------------------------------")
+
+    # ====================
+    # read authentification file
+    # ====================
+    try:
+        f = open(options.auth)
+        try:
+            (email, passwd) = f.readline().split(' ')
+            if passwd.endswith('\n'):
+                passwd = passwd[:-1]
+            f.close()
+        except ValueError:
+            print("error with password file content")
+            sys.exit(-2)
+    except IOError:
+        print("error with password file")
+        sys.exit(-2)
 
-# parse the resul json file, and download products if processing is completed
-parse_json(JSONFileName, email, passwd, options.write_dir)
-print("---------------------------------------------------------------------------")
+    session = peps_http.get_session(email, passwd, jobs=options.jobs, max_per_host=options.max_per_host,
+                                    adaptive=options.adaptive, max_rate=options.max_rate,
+                                    reserve=int(options.reserve * 1e9), chunk_size=options.chunk_size * 1024,
+                                    sync_bytes=options.sync_mb * 1000000 if options.sync_mb is not None else None)
+
+    manifest = peps_manifest.Manifest(options.write_dir)
+    if options.rescan:
+        (added, removed) = manifest.scan()
+        print("{}: {:d} products added to the index, {:d} removed".format(options.write_dir, added, removed))
+
+    # a job known to be over and downloaded to write_dir does not need any request
+    store = peps_jobs.JobStore(peps_jobs.state_file(options.logName))
+    if store.is_complete(peps_jobs.job_name(options.logName), manifest, options.include):
+        print("{} is over and its products are downloaded".format(options.logName))
+        print("---------------------------------------------------------------------------")
+        return
+
+    # =======================================
+    # read log file from full_maja_process.py
+    # and get the execution report
+    # =======================================
+    try:
+        read_log(options.logName, store)
+    except IOError as e:
+        print(e)
+        sys.exit(-3)
+    except ValueError as e:
+        print(e)
+        sys.exit(-4)
+    try:
+        JSONFileName, status = get_job_status(session, options.logName, store)
+    except IOError as e:
+        print(e)
+        sys.exit(-1)
+    except ValueError as e:
+        print(e)
+        sys.exit(-4)
+
+    # parse the resul json file, and download products if processing is completed
+    parse_json(JSONFileName, session, options.write_dir, options.jobs, options.extract, options.keep_zip,
+               options.include, store, manifest)
+    print("---------------------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
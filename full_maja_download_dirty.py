@@ -9,7 +9,9 @@ import os.path
 import optparse
 import sys
 import requests
-import shutil
+import peps_extract
+import peps_http
+import peps_manifest
 
 ###########################################################################
 
@@ -26,122 +28,143 @@ class OptionParser (optparse.OptionParser):
 # ##########################################################################
 
 
-def downloadFile(url, fileName, email, password):
-    r = requests.get(url, auth=(email, password), stream=True, verify=False)
-    with open(fileName, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
-    return
-
-
-def getURL(url, fileName, email, passwd):
-    req = requests.get(url, auth=(email, passwd), verify=False)
-    with open(fileName, "w") as f:
-        if sys.version_info[0] < 3:
-            f.write(req.text.encode('utf-8'))
-        else:
-            f.write(req.text)
-        if req.status_code == 200:
-            print("Request OK")
+def job_results(session, logName):
+    """
+    Returns the urls of the products of a job, listed in the log of its processing
+    :param logName: log file written by full_maja_process.py
+    IOError is raised if the log or the status can't be read, ValueError if the log has no status url.
+    """
+    try:
+        with open(logName) as f:
+            lignes = f.readlines()
+            urlStatus = None
+            for ligne in lignes:
+                if ligne.startswith("<wps:ExecuteResponse"):
+                    wpsId = ligne.split("pywps-")[1].split(".xml")[0]
+                    urlStatus = "https://peps.cnes.fr/cgi-bin/mapcache_results/logs/joblog-{}.log".format(wpsId)
+    except IOError as e:
+        raise IOError("error with log file {}: {}".format(logName, e))
+    if urlStatus is None:
+        raise ValueError("url for production status not found in log file %s" % logName)
+
+    statusFileName = os.path.splitext(logName)[0] + '.stat'
+    peps_http.getURL(session, urlStatus, statusFileName)
+
+    # get json file from urlStatus
+    # ====================
+
+    urls = []
+    try:
+        with open(statusFileName) as f:
+            lignes = f.readlines()
+            for ligne in lignes:
+                if ligne.find("https://peps.cnes.fr/cgi-bin/mapcache_results/maja/{}".format(wpsId)) >= 0:
+                    url = re.search('https:(.+).zip', ligne).group(0)
+                    urls.append(url)
+    except IOError as e:
+        raise IOError("error with status url found in {}: {}".format(logName, e))
+    return urls
+
+
+def download_results(session, urls, write_dir, include=None):
+    """ downloads the products of urls which are not in write_dir yet, or their files matching include """
+    manifest = peps_manifest.Manifest(write_dir)
+    for url in urls:
+        L2AName = url.split('/')[-1]
+        if L2AName.find('NOVALD') >= 0:
+            print("%s was too cloudy" % L2AName)
+        elif manifest.check(os.path.join(write_dir, L2AName), include):
+            print("skipping {}: already on disk".format(L2AName))
         else:
-            print("Wrong request status {}".format(str(req.status_code)))
-            sys.exit(-1)
-
-    return
+            print("downloading %s" % L2AName)
+            try:
+                if include:
+                    peps_extract.extract_members(session, url, "%s/%s" % (write_dir, L2AName), include, manifest)
+                else:
+                    peps_manifest.download_verified(session, url, "%s/%s" % (write_dir, L2AName), manifest)
+            except (requests.exceptions.RequestException, IOError) as e:
+                print("download of {} failed: {}".format(L2AName, e))
 
 
 # ######################### MAIN
-# ==================
-# parse command line
-# ==================
-if len(sys.argv) == 1:
-    prog = os.path.basename(sys.argv[0])
-    print('      ' + sys.argv[0] + ' [options]')
-    print("     Aide : ", prog, " --help")
-    print("        ou : ", prog, " -h")
-    print("example : python %s -a peps.txt -g Full_MAJA_31TCJ_51_2019.log -w ./Full_MAJA_31TCJ_51_2019 " %
-          sys.argv[0])
-
-    sys.exit(-1)
-else:
-    usage = "usage: %prog [options] "
-    parser = OptionParser(usage=usage)
-
-    parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
-                      help="Path where the products should be downloaded", default='.')
-    parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
-                      help="Peps account and password file")
-    parser.add_option("-l", "--log", dest="logName", action="store", type="string",
-                      help="log file name ", default='Full_Maja.log')
-
-    (options, args) = parser.parse_args()
-    parser.check_required("-a")
-
-    if not (os.path.exists(options.write_dir)):
-        os.mkdir(options.write_dir)
-print("---------------------------------------------------------------------------")
-
-
-# ====================
-# read authentication file
-# ====================
-try:
-    f = open(options.auth)
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example : python %s -a peps.txt -g Full_MAJA_31TCJ_51_2019.log -w ./Full_MAJA_31TCJ_51_2019 " %
+              sys.argv[0])
+
+        sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
+                          help="Path where the products should be downloaded", default='.')
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("-l", "--log", dest="logName", action="store", type="string",
+                          help="log file name ", default='Full_Maja.log')
+        parser.add_option("--max_rate", dest="max_rate", action="store", type="float",
+                          help="maximum download throughput, in MB/s", default=None)
+        parser.add_option("--reserve", dest="reserve", action="store", type="float",
+                          help="GB kept free on the output volume, the downloads wait for space beyond it",
+                          default=peps_http.DISK_RESERVE / 1e9)
+        parser.add_option("--include", dest="include", action="append", type="string",
+                          help="only download the files of the products matching this pattern, "
+                          "such as '*_FRE_B4.tif' (may be repeated)", default=None)
+        parser.add_option("--rescan", dest="rescan", action="store_true",
+                          help="update the index of the products of write_dir from its content", default=False)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-a")
+
+        if not (os.path.exists(options.write_dir)):
+            os.mkdir(options.write_dir)
+    print("---------------------------------------------------------------------------")
+
+    # ====================
+    # read authentication file
+    # ====================
     try:
-        (email, passwd) = f.readline().split(' ')
-        if passwd.endswith('\n'):
-            passwd = passwd[:-1]
-        f.close()
-    except ValueError:
-        print("error with password file content")
+        f = open(options.auth)
+        try:
+            (email, passwd) = f.readline().split(' ')
+            if passwd.endswith('\n'):
+                passwd = passwd[:-1]
+            f.close()
+        except ValueError:
+            print("error with password file content")
+            sys.exit(-2)
+    except IOError:
+        print("error with password file")
         sys.exit(-2)
-except IOError:
-    print("error with password file")
-    sys.exit(-2)
-
-# =======================================
-# read log file from full_maja_process.py
-# =======================================
-
-try:
-    with open(options.logName) as f:
-        lignes = f.readlines()
-        urlStatus = None
-        for ligne in lignes:
-            if ligne.startswith("<wps:ExecuteResponse"):
-                wpsId = ligne.split("pywps-")[1].split(".xml")[0]
-                urlStatus = "https://peps.cnes.fr/cgi-bin/mapcache_results/logs/joblog-{}.log".format(wpsId)
-        if urlStatus is None:
-            print("url for production status not found in logName %s" % options.logName)
-            sys.exit(-4)
-except IOError:
-    print("error with logName file provided as input or as default parameter")
-    sys.exit(-3)
-
-statusFileName = options.logName.replace('log', 'stat')
-getURL(urlStatus, statusFileName, email, passwd)
-
-# get json file from urlStatus
-# ====================
-
-urls = []
-try:
-    with open(statusFileName) as f:
-        lignes = f.readlines()
-        for ligne in lignes:
-            if ligne.find("https://peps.cnes.fr/cgi-bin/mapcache_results/maja/{}".format(wpsId)) >= 0:
-                url = re.search('https:(.+).zip', ligne).group(0)
-                urls.append(url)
-except IOError:
-    print("error with status url found in logName")
-    sys.exit(-3)
-
-for url in urls:
-    L2AName = url.split('/')[-1]
-    if L2AName.find('NOVALD') >= 0:
-        print("%s was too cloudy" % L2AName)
-    elif os.path.isfile(os.path.join(options.write_dir, L2AName)):
-        print("skipping {}: already on disk".format(L2AName))
-    else:
-        print("downloading %s" % L2AName)
-        downloadFile(url, "%s/%s" % (options.write_dir, L2AName), email, passwd)
-print("---------------------------------------------------------------------------")
+
+    session = peps_http.get_session(email, passwd, max_rate=options.max_rate,
+                                    reserve=int(options.reserve * 1e9))
+
+    # =======================================
+    # read log file from full_maja_process.py
+    # =======================================
+    if options.rescan:
+        (added, removed) = peps_manifest.Manifest(options.write_dir).scan()
+        print("{}: {:d} products added to the index, {:d} removed".format(options.write_dir, added, removed))
+    try:
+        urls = job_results(session, options.logName)
+    except IOError as e:
+        print(e)
+        sys.exit(-3)
+    except ValueError as e:
+        print(e)
+        sys.exit(-4)
+    download_results(session, urls, options.write_dir, options.include)
+    print("---------------------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
 #! /usr/bin/env python
 # -*- coding: iso-8859-1 -*-
-import json
-import time
 import os
 import os.path
 import optparse
 import sys
-import requests
 import re
-from datetime import date, datetime
+import peps_http
+import peps_jobs
+import peps_metrics
+import peps_wps
+from datetime import datetime, timedelta
+
+# length of the period of a processing, in days
+MIN_DAYS = 55
+MAX_DAYS = 366
+# days processed again at the start of a window of a longer period, for the initialisation of MAJA
+OVERLAP_DAYS = 60
 
 ###########################################################################
 
@@ -25,56 +32,6 @@ class OptionParser (optparse.OptionParser):
 ###########################################################################
 
 
-def parse_catalog(search_json_file):
-    # Filter catalog result
-    with open(search_json_file) as data_file:
-        data = json.load(data_file)
-
-    if 'ErrorCode' in data:
-        print(data['ErrorMessage'])
-        sys.exit(-2)
-
-    # Sort data
-    download_dict = {}
-    storage_dict = {}
-    size_dict = {}
-    if len(data["features"]) > 0:
-        for i in range(len(data["features"])):
-            prod = data["features"][i]["properties"]["productIdentifier"]
-            print(prod, data["features"][i]["properties"]["storage"]["mode"])
-            feature_id = data["features"][i]["id"]
-            try:
-                storage = data["features"][i]["properties"]["storage"]["mode"]
-                platform = data["features"][i]["properties"]["platform"]
-                resourceSize = data["features"][i]["properties"]["resourceSize"]
-                # recup du numero d'orbite
-                orbitN = data["features"][i]["properties"]["orbitNumber"]
-                if platform == 'S1A':
-                    # calcul de l'orbite relative pour Sentinel 1A
-                    relativeOrbit = ((orbitN - 73) % 175) + 1
-                elif platform == 'S1B':
-                    # calcul de l'orbite relative pour Sentinel 1B
-                    relativeOrbit = ((orbitN - 27) % 175) + 1
-
-                if options.orbit is not None:
-                    if prod.find("_R%03d" % options.orbit) > 0:
-                        download_dict[prod] = feature_id
-                        storage_dict[prod] = storage
-                        size_dict[prod] = resourceSize
-
-                else:
-                    download_dict[prod] = feature_id
-                    storage_dict[prod] = storage
-                    size_dict[prod] = resourceSize
-            except:
-                pass
-    else:
-        print(">>> no product corresponds to selection criteria")
-        sys.exit(-1)
-
-    return(prod, download_dict, storage_dict, size_dict)
-
-###########################################################################
 def check_params(start_date, stop_date, tileid, orbit=None):
     """
     Check the parameters
@@ -98,7 +55,7 @@ def check_params(start_date, stop_date, tileid, orbit=None):
 
     days = (stop_date - start_date).days
 
-    if days < 55 or days > 366:
+    if days < MIN_DAYS or days > MAX_DAYS:
         raise ValueError("The time interval must be between 2 months and 1 year")
 
     # Check orbit number
@@ -112,125 +69,195 @@ def check_params(start_date, stop_date, tileid, orbit=None):
         raise ValueError("The tile ID is in the wrong format")
 
 
-# ===================== MAIN
-# ==================
-# parse command line
-# ==================
-if len(sys.argv) == 1:
-    prog = os.path.basename(sys.argv[0])
-    print('      ' + sys.argv[0] + ' [options]')
-    print("     Aide : ", prog, " --help")
-    print("        ou : ", prog, " -h")
-    print("example  : python %s -a peps.txt -t 31TCJ -o 51 -l Full_MAJA_31TCJ_51_2019.log -d 2018-01-01 -e 2018-03-01" %
-          sys.argv[0])
-    print("example  : python %s -a peps.txt -t 31TCJ -o 51 -l Full_MAJA_31TCJ_51_2019.log -d 2018-01-01 -e 2018-03-01" %
-          sys.argv[0])
-    sys.exit(-1)
-else:
-    usage = "usage: %prog [options] "
-    parser = OptionParser(usage=usage)
-
-    parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
-                      help="Peps account and password file")
-    parser.add_option("-n", "--no_download", dest="no_download", action="store_true",
-                      help="Do not download products, just print curl command", default=False)
-    parser.add_option("-d", "--start_date", dest="start_date", action="store", type="string",
-                      help="start date, fmt('2015-12-22')", default=None)
-    parser.add_option("-t", "--tile", dest="tile", action="store", type="string",
-                      help="tile name like 31TCK')", default=None)
-    parser.add_option("-o", "--orbit", dest="orbit", action="store", type="int",
-                      help="Orbit Path number", default=None)
-    parser.add_option("-e", "--end_date", dest="end_date", action="store", type="string",
-                      help="end date, fmt('2015-12-23')", default='9999-01-01')
-    parser.add_option("-l", "--log", dest="logName", action="store", type="string",
-                      help="log file name ", default='Full_Maja.log')
-    parser.add_option("--json", dest="search_json_file", action="store", type="string",
-                      help="Output search JSON filename", default=None)
-
-    (options, args) = parser.parse_args()
-    parser.check_required("-a")
-
-
-if options.search_json_file is None or options.search_json_file == "":
-    options.search_json_file = 'search.json'
-
-
-# date parameters of catalog request
-if options.start_date is not None:
-    start_date = options.start_date
-    if options.end_date is not None:
-        end_date = options.end_date
+def split_period(start_date, end_date, overlap=OVERLAP_DAYS):
+    """
+    Splits a period of any length into windows accepted by check_params.
+    Each window starts overlap days before the end of the previous one, so that
+    MAJA is initialised before the first date which was not processed yet; the
+    last window starts earlier if needed to last at least MIN_DAYS.
+    :param start_date: Starting Date, format : str(XXXX-XX-XX)
+    :param end_date: End date, format : str(XXXX-XX-XX)
+    :return: list of (start_date, end_date)
+    """
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    if (end - start).days < MIN_DAYS:
+        raise ValueError("The time interval must be longer than {:d} days".format(MIN_DAYS))
+    if overlap >= MAX_DAYS - MIN_DAYS:
+        raise ValueError("The overlap must be shorter than {:d} days".format(MAX_DAYS - MIN_DAYS))
+    windows = []
+    while True:
+        stop = min(start + timedelta(days=MAX_DAYS), end)
+        if (stop - start).days < MIN_DAYS:
+            start = stop - timedelta(days=MIN_DAYS)
+        windows.append((start.strftime('%Y-%m-%d'), stop.strftime('%Y-%m-%d')))
+        if stop >= end:
+            return windows
+        start = stop - timedelta(days=overlap)
+
+
+def processing_url(start_date, end_date, tile, orbit=None):
+    """ returns the WPS request which starts a FULL_MAJA processing """
+    peps = "http://peps.cnes.fr/resto/wps"
+
+    if orbit is not None:
+        url = "%s?request=execute&service=WPS&version=1.0.0&identifier=FULL_MAJA&datainputs=startDate=%s;completionDate=%s;tileid=%s;relativeOrbitNumber=%s&status=true&storeExecuteResponse=true" % (
+            peps, start_date, end_date, tile, orbit)
     else:
-        end_date = datetime.date.today().isoformat()
-
-# check conditions on dates
-sdate = datetime.strptime(start_date, '%Y-%m-%d')
-edate = datetime.strptime(end_date, '%Y-%m-%d')
-if edate < datetime.strptime('2016-04-01', '%Y-%m-%d'):
-    print("because of missing information on ESA L1C products, start_date must be greater than '2016-04-01'")
-    sys.exit(-5)
-
-if (edate-sdate).days < 50:
-    print("at least 50 days should be provided to MAJA to allow a proper initialisation")
-    sys.exit(-5)
-
-if (edate-sdate).days > 366:
-    print("due to processing and disk limitations, processing is limited to a one year period per command line")
-    sys.exit(-5)
-
-
-if options.tile.startswith('T'):
-    options.tile = options.tile[1:]
-
-# Check params
-check_params(start_date, end_date, options.tile, options.orbit)
-
-# ====================
-# read authentification file
-# ====================
-try:
-    f = open(options.auth)
-    (email, passwd) = f.readline().split(' ')
-    if passwd.endswith('\n'):
-        passwd = passwd[:-1]
-    f.close()
-except:
-    print("error with password file")
-    sys.exit(-2)
-
-
-if os.path.exists(options.search_json_file):
-    os.remove(options.search_json_file)
-
-
-# =====================
-# Start Maja processing
-# =====================
-peps = "http://peps.cnes.fr/resto/wps"
+        url = "%s?request=execute&service=WPS&version=1.0.0&identifier=FULL_MAJA&datainputs=startDate=%s;completionDate=%s;tileid=%s&status=true&storeExecuteResponse=true" % (
+            peps, start_date, end_date, tile)
+    return url
 
-if options.orbit is not None:
-    url = "%s?request=execute&service=WPS&version=1.0.0&identifier=FULL_MAJA&datainputs=startDate=%s;completionDate=%s;tileid=%s;relativeOrbitNumber=%s&status=true&storeExecuteResponse=true" % (
-        peps, start_date, end_date, options.tile, options.orbit)
-else:
-    url = "%s?request=execute&service=WPS&version=1.0.0&identifier=FULL_MAJA&datainputs=startDate=%s;completionDate=%s;tileid=%s&status=true&storeExecuteResponse=true" % (
-        peps, start_date, end_date, options.tile)
 
-
-print(url)
-if not options.no_download:
-    req = requests.get(url, auth=(email, passwd))
-    with open(options.logName, "wb") as f:
+def submit(session, start_date, end_date, tile, orbit, logName, store=None):
+    """
+    Submits a FULL_MAJA processing and writes the WPS answer to logName
+    :param session: session returned by peps_http.get_session
+    :param start_date: Starting Date, format : str(XXXX-XX-XX)
+    :type start_date: str
+    :param end_date: End date, format : str(XXXX-XX-XX)
+    :type end_date: str
+    :param tile: MGRS tile ID
+    :type tile: str
+    :param orbit: relative orbit number, or None for all orbits
+    :type orbit: int
+    :param logName: log file needed by full_maja_download.py
+    :type logName: str
+    :param store: peps_jobs.JobStore where the job is recorded, by default the one next to logName
+    :return: True if the processing was accepted
+    """
+    url = processing_url(start_date, end_date, tile, orbit)
+    print(url)
+    with peps_metrics.stage("submit"), peps_http.Transfer(session, "submit") as transfer:
+        req = session.get(url)
+        transfer.answer(req)
+        transfer.data(req.content)
+    with open(logName, "wb") as f:
         f.write(req.text.encode('utf-8'))
-    print("---------------------------------------------------------------------------")
+    accepted = False
     if req.status_code == 200:
         if b"Process FULL_MAJA accepted" in req.text.encode('utf-8'):
             print("Request OK !")
-            print("To check completion and download results:")
-            print("     python full_maja_download.py -a peps.txt -l {} -w FULL_MAJA_OUTPUT_DIR".format(options.logName))
+            accepted = True
+            launch = peps_wps.parse_wps(req.content, ("wps_id", "status_location"))
+            if store is None:
+                store = peps_jobs.JobStore(peps_jobs.state_file(logName))
+            store.record_launch(peps_jobs.job_name(logName), launch.wps_id, launch.status_location)
         else:
-            print("Something is wrong : please check {} file".format(options.logName))
+            print("Something is wrong : please check {} file".format(logName))
     elif req.status_code == 401:
         print("Unauthorized request, please check the auth file with provided -a option")
     else:
         print("Wrong request status {}".format(str(req.status_code)))
-    print("---------------------------------------------------------------------------")
+    peps_metrics.count("peps_submissions_total", process="FULL_MAJA", result="accepted" if accepted else "rejected")
+    return accepted
+
+
+# ===================== MAIN
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example  : python %s -a peps.txt -t 31TCJ -o 51 -l Full_MAJA_31TCJ_51_2019.log -d 2018-01-01 -e 2018-03-01" %
+              sys.argv[0])
+        print("example  : python %s -a peps.txt -t 31TCJ -o 51 -l Full_MAJA_31TCJ_51_2019.log -d 2018-01-01 -e 2018-03-01" %
+              sys.argv[0])
+        sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("-n", "--no_download", dest="no_download", action="store_true",
+                          help="Do not download products, just print curl command", default=False)
+        parser.add_option("-d", "--start_date", dest="start_date", action="store", type="string",
+                          help="start date, fmt('2015-12-22')", default=None)
+        parser.add_option("-t", "--tile", dest="tile", action="store", type="string",
+                          help="tile name like 31TCK')", default=None)
+        parser.add_option("-o", "--orbit", dest="orbit", action="store", type="int",
+                          help="Orbit Path number", default=None)
+        parser.add_option("-e", "--end_date", dest="end_date", action="store", type="string",
+                          help="end date, fmt('2015-12-23')", default='9999-01-01')
+        parser.add_option("-l", "--log", dest="logName", action="store", type="string",
+                          help="log file name ", default='Full_Maja.log')
+        parser.add_option("--json", dest="search_json_file", action="store", type="string",
+                          help="Output search JSON filename", default=None)
+        parser.add_option("--metrics", dest="metrics", action="store", type="string",
+                          help="file where the metrics of the run are written: Prometheus textfile if "
+                          "its name ends with .prom, else JSON lines", default=None)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-a")
+        peps_metrics.enable(options.metrics)
+
+    if options.search_json_file is None or options.search_json_file == "":
+        options.search_json_file = 'search.json'
+
+    # date parameters of catalog request
+    if options.start_date is not None:
+        start_date = options.start_date
+        if options.end_date is not None:
+            end_date = options.end_date
+        else:
+            end_date = datetime.date.today().isoformat()
+
+    # check conditions on dates
+    sdate = datetime.strptime(start_date, '%Y-%m-%d')
+    edate = datetime.strptime(end_date, '%Y-%m-%d')
+    if edate < datetime.strptime('2016-04-01', '%Y-%m-%d'):
+        print("because of missing information on ESA L1C products, start_date must be greater than '2016-04-01'")
+        sys.exit(-5)
+
+    if (edate-sdate).days < 50:
+        print("at least 50 days should be provided to MAJA to allow a proper initialisation")
+        sys.exit(-5)
+
+    if (edate-sdate).days > 366:
+        print("due to processing and disk limitations, processing is limited to a one year period per command line")
+        print("longer periods can be split and processed by full_maja_batch.py --split")
+        sys.exit(-5)
+
+    if options.tile.startswith('T'):
+        options.tile = options.tile[1:]
+
+    # Check params
+    check_params(start_date, end_date, options.tile, options.orbit)
+
+    # ====================
+    # read authentification file
+    # ====================
+    try:
+        f = open(options.auth)
+        (email, passwd) = f.readline().split(' ')
+        if passwd.endswith('\n'):
+            passwd = passwd[:-1]
+        f.close()
+    except:
+        print("error with password file")
+        sys.exit(-2)
+
+    if os.path.exists(options.search_json_file):
+        os.remove(options.search_json_file)
+
+    # =====================
+    # Start Maja processing
+    # =====================
+    if options.no_download:
+        print(processing_url(start_date, end_date, options.tile, options.orbit))
+    else:
+        session = peps_http.get_session(email, passwd)
+        print("---------------------------------------------------------------------------")
+        if submit(session, start_date, end_date, options.tile, options.orbit, options.logName):
+            print("To check completion and download results:")
+            print("     python full_maja_download.py -a peps.txt -l {} -w FULL_MAJA_OUTPUT_DIR".format(options.logName))
+        print("---------------------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
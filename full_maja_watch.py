@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+# -*- coding: iso-8859-1 -*-
+"""
+Follows many Full_MAJA processings submitted with full_maja_process.py.
+The status of all the jobs is polled concurrently from one process, and the
+products of a job are downloaded as soon as it is finished.
+Requires python 3.
+"""
+import asyncio
+import glob
+import os
+import os.path
+import optparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import peps_http
+import peps_jobs
+import peps_manifest
+import peps_metrics
+from full_maja_download import get_job_status, parse_json
+
+###########################################################################
+
+
+class OptionParser (optparse.OptionParser):
+
+    def check_required(self, opt):
+        option = self.get_option(opt)
+
+        # Assumes the option's 'default' is set to None!
+        if getattr(self.values, option.dest) is None:
+            self.error("%s option not supplied" % option)
+
+###########################################################################
+
+# number of failed status polls in a row, or of failed downloads, after which a job is given up
+MAX_FAILURES = 5
+
+
+def list_logs(paths):
+    """ returns the WPS log files given directly or found in the given directories """
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            logs.extend(sorted(glob.glob(os.path.join(path, "*.log"))))
+        else:
+            logs.append(path)
+    return logs
+
+
+def job_write_dir(write_dir, logName):
+    """ each job is downloaded in a sub-directory named after its log file """
+    return os.path.join(write_dir, os.path.splitext(os.path.basename(logName))[0])
+
+###########################################################################
+
+
+class Watcher(object):
+    """ polls the status chain of several jobs on an asyncio event loop """
+
+    def __init__(self, session, paths, write_dir, max_polls=8, max_downloads=2, jobs=1,
+                 max_failures=MAX_FAILURES):
+        self.session = session
+        self.paths = paths
+        self.write_dir = write_dir
+        self.jobs = jobs
+        self.max_polls = max_polls
+        self.max_failures = max_failures
+        self.polls = None
+        # the blocking HTTP calls run in these pools, so that a long download
+        # never delays the polling of the other jobs
+        self.poll_executor = ThreadPoolExecutor(max_workers=max_polls)
+        self.download_executor = ThreadPoolExecutor(max_workers=max_downloads)
+        # log file name -> status, for the jobs which do not need polling anymore
+        self.done = {}
+        self.downloads = {}
+        # log file name -> number of failed polls in a row, of failed downloads
+        self.failed_polls = {}
+        self.failed_downloads = {}
+        # job store of each directory of log files
+        self.stores = {}
+
+    def store(self, logName):
+        fileName = peps_jobs.state_file(logName)
+        if fileName not in self.stores:
+            self.stores[fileName] = peps_jobs.JobStore(fileName)
+        return self.stores[fileName]
+
+    def active_jobs(self):
+        jobs = []
+        for logName in list_logs(self.paths):
+            if logName in self.done or logName in self.downloads:
+                continue
+            # the jobs which were over and downloaded in a previous run are not polled
+            store = self.store(logName)
+            if store.is_complete(peps_jobs.job_name(logName),
+                                 peps_manifest.Manifest(job_write_dir(self.write_dir, logName))):
+                self.done[logName] = store.job(peps_jobs.job_name(logName)).status
+                continue
+            jobs.append(logName)
+        return jobs
+
+    def give_up(self, logName, failures, reason):
+        """ counts a failure of the job, which is not followed anymore after max_failures """
+        failures[logName] = failures.get(logName, 0) + 1
+        if failures[logName] < self.max_failures:
+            print("{}: {}, will retry".format(logName, reason))
+            return
+        print("{}: {}, given up after {:d} attempts".format(logName, reason, failures[logName]))
+        self.done[logName] = "FAILED"
+
+    def download_job(self, logName, JSONFileName):
+        """ blocking download of a finished job, executed in download_executor """
+        write_dir = job_write_dir(self.write_dir, logName)
+        if not os.path.exists(write_dir):
+            os.makedirs(write_dir)
+        store = self.store(logName)
+        status = parse_json(JSONFileName, self.session, write_dir, self.jobs, store=store)
+        # the products which could not be downloaded make the download of the job fail
+        failed = store.files(peps_jobs.job_name(logName), (peps_jobs.PENDING, peps_jobs.FAILED))
+        if len(failed) > 0:
+            raise IOError("{:d} products not downloaded".format(len(failed)))
+        return status
+
+    async def poll(self, logName):
+        loop = asyncio.get_event_loop()
+        async with self.polls:
+            try:
+                JSONFileName, status = await loop.run_in_executor(self.poll_executor, get_job_status,
+                                                                  self.session, logName, self.store(logName))
+            except Exception as e:
+                # an error of one job must not stop the watcher
+                self.give_up(logName, self.failed_polls, "status not available ({!r})".format(e))
+                return
+        self.failed_polls.pop(logName, None)
+        print("{}: {}".format(logName, status))
+        if status == "FINISHED":
+            self.downloads[logName] = asyncio.ensure_future(self.download(logName, JSONFileName))
+        elif status == "ERROR" or status == "CANCELED":
+            await loop.run_in_executor(self.poll_executor, parse_json, JSONFileName,
+                                       self.session, self.write_dir)
+            self.done[logName] = status
+
+    async def download(self, logName, JSONFileName):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self.download_executor, self.download_job, logName, JSONFileName)
+            self.done[logName] = "FINISHED"
+        except Exception as e:
+            # the job is polled again, and downloaded again if it is still finished
+            self.give_up(logName, self.failed_downloads, "download failed ({!r})".format(e))
+        finally:
+            del self.downloads[logName]
+
+    async def run(self, interval, forever=False):
+        self.polls = asyncio.Semaphore(self.max_polls)
+        while True:
+            t0 = time.time()
+            jobs = self.active_jobs()
+            if not forever and len(jobs) == 0:
+                if len(self.downloads) == 0:
+                    break
+                # only downloads are left: the failed ones are polled again as soon as they end
+                await asyncio.gather(*list(self.downloads.values()))
+                continue
+            await asyncio.gather(*[self.poll(logName) for logName in jobs])
+            if not forever and len(self.active_jobs()) == 0 and len(self.downloads) == 0:
+                break
+            active = len(self.active_jobs())
+            print("{:d} jobs being processed, {:d} downloading, {:d} completed".format(
+                active, len(self.downloads), len(self.done)))
+            peps_metrics.set_gauge("peps_jobs", active, state="processing")
+            peps_metrics.set_gauge("peps_jobs", len(self.downloads), state="downloading")
+            peps_metrics.set_gauge("peps_jobs", len(self.done), state="completed")
+            peps_metrics.export()
+            await asyncio.sleep(max(0, interval - (time.time() - t0)))
+        self.poll_executor.shutdown()
+        self.download_executor.shutdown()
+        for logName in sorted(self.done):
+            print("{}: {}".format(logName, self.done[logName]))
+
+
+# ######################### MAIN
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example : python %s -a peps.txt -l ./logs -w ./Full_MAJA_OUTPUT_DIR" % sys.argv[0])
+        sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
+                          help="Path where the products should be downloaded, one sub-directory per log file",
+                          default='.')
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("-l", "--log", dest="logs", action="append", type="string",
+                          help="log file from full_maja_process.py, or directory of log files (repeatable)")
+        parser.add_option("-i", "--interval", dest="interval", action="store", type="int",
+                          help="seconds between two status polls of a job", default=600)
+        parser.add_option("-c", "--max_polls", dest="max_polls", action="store", type="int",
+                          help="number of status requests made concurrently", default=8)
+        parser.add_option("--max_downloads", dest="max_downloads", action="store", type="int",
+                          help="number of jobs downloaded concurrently", default=2)
+        parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int",
+                          help="number of products of a job downloaded in parallel", default=1)
+        parser.add_option("--max_failures", dest="max_failures", action="store", type="int",
+                          help="failed polls in a row, or failed downloads, after which a job is given up",
+                          default=MAX_FAILURES)
+        parser.add_option("--forever", dest="forever", action="store_true",
+                          help="keep watching the directories for new log files", default=False)
+        parser.add_option("--adaptive", dest="adaptive", action="store_true",
+                          help="lower the number of parallel downloads when PEPS is overloaded", default=False)
+        parser.add_option("--max_rate", dest="max_rate", action="store", type="float",
+                          help="maximum total download throughput, in MB/s", default=None)
+        parser.add_option("--reserve", dest="reserve", action="store", type="float",
+                          help="GB kept free on the output volume, the downloads wait for space beyond it",
+                          default=peps_http.DISK_RESERVE / 1e9)
+        parser.add_option("--chunk_size", dest="chunk_size", action="store", type="int",
+                          help="bytes read at a time by each download, in kB", default=peps_http.COPY_SIZE // 1024)
+        parser.add_option("--sync_mb", dest="sync_mb", action="store", type="int",
+                          help="write the downloaded files to the disk every this number of MB "
+                          "(0: once each file is complete; by default, left to the system)", default=None)
+        parser.add_option("--metrics", dest="metrics", action="store", type="string",
+                          help="file where the metrics are written after each poll: Prometheus textfile "
+                          "if its name ends with .prom, else JSON lines", default=None)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-a")
+        parser.check_required("-l")
+        peps_metrics.enable(options.metrics)
+
+        if not (os.path.exists(options.write_dir)):
+            os.mkdir(options.write_dir)
+    print("---------------------------------------------------------------------------")
+
+    # ====================
+    # read authentification file
+    # ====================
+    try:
+        f = open(options.auth)
+        try:
+            (email, passwd) = f.readline().split(' ')
+            if passwd.endswith('\n'):
+                passwd = passwd[:-1]
+            f.close()
+        except ValueError:
+            print("error with password file content")
+            sys.exit(-2)
+    except IOError:
+        print("error with password file")
+        sys.exit(-2)
+
+    session = peps_http.get_session(email, passwd,
+                                    jobs=options.max_polls + options.max_downloads * options.jobs,
+                                    adaptive=options.adaptive, max_rate=options.max_rate,
+                                    reserve=int(options.reserve * 1e9), chunk_size=options.chunk_size * 1024,
+                                    sync_bytes=options.sync_mb * 1000000 if options.sync_mb is not None else None)
+    watcher = Watcher(session, options.logs, options.write_dir, options.max_polls,
+                      options.max_downloads, options.jobs, options.max_failures)
+    asyncio.run(watcher.run(options.interval, options.forever))
+    print("---------------------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Library interface of the scripts: catalog search, submission, status polling
+and download of the MAJA and Full_MAJA processings, from one process.
+All the calls of a Client share its session, so that the connections to PEPS
+are kept alive, and the job store of each directory, so that an orchestrator
+can drive many tiles or products without starting a script for each of them.
+
+    import peps_api
+    client = peps_api.Client(*peps_api.read_auth("peps.txt"), jobs=4)
+    client.submit_full_maja("31TCJ", "2018-01-01", "2018-04-01", "logs/31TCJ.log", orbit=51)
+    if client.poll("logs/31TCJ.log") == "FINISHED":
+        client.download("logs/31TCJ.log", "Full_MAJA_OUTPUT_DIR/31TCJ")
+
+The command line scripts are thin wrappers around the same functions.
+"""
+import os
+import os.path
+import peps_catalog
+import peps_http
+import peps_jobs
+import peps_manifest
+import full_maja_download
+import full_maja_process
+import peps_maja_download
+import peps_maja_process
+
+###########################################################################
+
+
+def read_auth(fileName):
+    """
+    Reads a PEPS account file, whose first line is: email password
+    :return: (email, password), IOError or ValueError being raised for a missing or malformed file
+    """
+    with open(fileName) as f:
+        (email, passwd) = f.readline().split(' ')
+    return email, passwd.rstrip('\n')
+
+
+class Client(object):
+    """ search, submit, poll and download calls sharing one session """
+
+    def __init__(self, email, passwd, jobs=1, max_per_host=None, adaptive=False, max_rate=None, cache=None,
+                 reserve=peps_http.DISK_RESERVE, chunk_size=peps_http.COPY_SIZE, sync_bytes=None):
+        """
+        :param jobs: number of products downloaded in parallel
+        :param max_per_host: maximum number of connections to PEPS (default: jobs + 2)
+        :param adaptive: lower the number of parallel downloads when PEPS is overloaded
+        :param max_rate: maximum total download throughput, in MB/s
+        :param cache: SQLite file caching the catalog searches (see peps_catalog.CatalogCache)
+        :param reserve: bytes kept free on the volume of the downloads, which wait for space beyond it
+        :param chunk_size: bytes read at a time by each download
+        :param sync_bytes: write the downloaded files to the disk every sync_bytes bytes (0: once complete)
+        """
+        self.session = peps_http.new_session(email, passwd, jobs=jobs, max_per_host=max_per_host,
+                                             adaptive=adaptive, max_rate=max_rate, reserve=reserve,
+                                             chunk_size=chunk_size, sync_bytes=sync_bytes)
+        self.jobs = jobs
+        self.catalog = peps_catalog.CatalogCache(cache) if cache is not None else None
+        # job store and manifest of each directory
+        self.stores = {}
+        self.manifests = {}
+
+    def store(self, directory):
+        """ peps_jobs.JobStore of the jobs whose logs are in directory """
+        fileName = os.path.join(directory, peps_jobs.STATE_NAME)
+        if fileName not in self.stores:
+            self.stores[fileName] = peps_jobs.JobStore(fileName)
+        return self.stores[fileName]
+
+    def manifest(self, write_dir):
+        """ peps_manifest.Manifest, index of the products of write_dir """
+        if write_dir not in self.manifests:
+            self.manifests[write_dir] = peps_manifest.Manifest(write_dir)
+        return self.manifests[write_dir]
+
+    def rescan(self, write_dir):
+        """ updates the index of the products of write_dir from its content, see peps_manifest.Manifest.scan """
+        return self.manifest(write_dir).scan()
+
+    def search(self, queries, orbit=None, search_json_file="search.json", jobs=4):
+        """
+        Searches the L1C products of the catalog
+        :param queries: search parameters, such as {'tileid': '31TCJ', 'startDate': '2018-01-01',
+                        'completionDate': '2018-03-01', 'productType': 'S2MSI1C'}, or a list of them
+                        (several tiles or date windows), searched with at most jobs in parallel
+        :param orbit: if given, only the products of this relative orbit are kept
+        :return: dicts of the product ids, storage modes and sizes, by product name, empty if nothing
+                 was found; IOError is raised if the search fails (connection, answer of PEPS)
+        """
+        prod, download_dict, storage_dict, size_dict = peps_maja_process.search_products(
+            self.session, queries, orbit, search_json_file, self.catalog, jobs)
+        return download_dict, storage_dict, size_dict
+
+    # Full_MAJA processings of a tile, followed with their log file
+
+    def submit_full_maja(self, tile, start_date, end_date, logName, orbit=None):
+        """
+        Submits a Full_MAJA processing, ValueError being raised for invalid parameters
+        :return: True if the processing was accepted
+        """
+        if tile.startswith('T'):
+            tile = tile[1:]
+        full_maja_process.check_params(start_date, end_date, tile, orbit)
+        return full_maja_process.submit(self.session, start_date, end_date, tile, orbit, logName,
+                                        self.store(os.path.dirname(logName)))
+
+    def poll(self, logName):
+        """
+        Updates the status of a Full_MAJA job
+        :return: PENDING, STALLED, FINISHED, ERROR or CANCELED; IOError is raised if it is not available,
+                 ValueError if the answers of PEPS can't be used
+        """
+        JSONFileName, status = full_maja_download.get_job_status(self.session, logName,
+                                                                 self.store(os.path.dirname(logName)))
+        return status
+
+    def download(self, logName, write_dir, extract=False, keep_zip=False, include=None):
+        """
+        Downloads the products of a finished Full_MAJA job which are not in write_dir yet
+        Options as those of full_maja_download.py; returns the status of the job
+        """
+        if not os.path.exists(write_dir):
+            os.makedirs(write_dir)
+        store = self.store(os.path.dirname(logName))
+        if store.is_complete(peps_jobs.job_name(logName), self.manifest(write_dir), include):
+            return store.job(peps_jobs.job_name(logName)).status
+        JSONFileName = os.path.splitext(logName)[0] + '.json'
+        if not os.path.isfile(JSONFileName):
+            self.poll(logName)
+        return full_maja_download.parse_json(JSONFileName, self.session, write_dir, self.jobs, extract,
+                                             keep_zip, include, store, self.manifest(write_dir))
+
+    # MAJA processings of single products, followed in write_dir
+
+    def submit_maja(self, prod, write_dir):
+        """ submits the MAJA processing of a L1C product, returns True if it was accepted """
+        return peps_maja_process.submit_product(self.session, prod, write_dir, self.store(write_dir))
+
+    def check_maja(self, prod, write_dir):
+        """
+        Checks the MAJA processing of a product, and downloads it to write_dir once finished
+        :return: STALLED, FINISHED or CANCELED, or None if the status is not available
+        """
+        return peps_maja_download.check_product(self.session, prod, write_dir, self.manifest(write_dir),
+                                                self.store(write_dir))
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.session.close()
@@ -0,0 +1,475 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Searches the PEPS (resto) catalog.
+The results are requested page by page and parsed while they are received,
+one feature at a time, so that memory does not grow with the size of the request.
+"""
+import codecs
+import io
+import json
+from collections import namedtuple
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import peps_http
+import peps_metrics
+
+SEARCH_URL = "https://peps.cnes.fr/resto/api/collections/{}/search.json"
+# largest page size accepted by resto
+MAX_RECORDS = 500
+# characters read at a time when parsing a JSON document
+CHUNK_SIZE = 64 * 1024
+# seconds a search of search_many waits for room in its queue before checking if it was abandoned
+QUEUE_TIMEOUT = 1
+
+###########################################################################
+
+
+class JSONStream(object):
+    """ reads the JSON values of a text file object a chunk at a time """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ returns the next non blank character, or None at the end of the file """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError("expected one of {!r} in JSON stream, found {!r}".format(chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ decodes the next JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+def iter_json_features(f, header=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the features of a GeoJSON FeatureCollection one at a time, without
+    loading the whole document, so that memory does not depend on its size.
+    :param f: text file object
+    :param header: if given, dict which receives the other top level members
+                   (properties, ErrorCode...) once the document is read
+    :type header: dict
+    """
+    stream = JSONStream(f, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key == "features":
+            stream.expect("[")
+            if stream.peek() != "]":
+                while True:
+                    yield stream.value()
+                    if stream.expect(",]") == "]":
+                        break
+            else:
+                stream.expect("]")
+        else:
+            value = stream.value()
+            if header is not None:
+                header[key] = value
+        if stream.expect(",}") == "}":
+            return
+
+
+def next_link(data):
+    """ returns the url of the next page given by resto, or None """
+    for link in data.get("properties", {}).get("links", []):
+        if link.get("rel") == "next":
+            return link.get("href")
+    return None
+
+
+def search_features(session, query, collection="S2ST", max_records=MAX_RECORDS):
+    """
+    Yields the features of a catalog search, page after page
+    Each page is parsed while it is received, so that only one feature is kept in memory.
+    :param session: session returned by peps_http.get_session
+    :param query: search parameters, such as {'tileid': '31TCJ', 'startDate': '2017-01-01'}
+    :type query: dict
+    :param collection: resto collection
+    :type collection: str
+    :param max_records: number of features per page
+    :type max_records: int
+    """
+    url = SEARCH_URL.format(collection)
+    page = 1
+    params = dict(query)
+    params["maxRecords"] = max_records
+    params["page"] = page
+    while url is not None:
+        header = {}
+        nb_features = 0
+        with peps_http.Transfer(session, "catalog") as transfer:
+            req = session.get(url, params=params, stream=True)
+            complete = False
+            try:
+                print(req.url)
+                transfer.answer(req)
+                req.raw.decode_content = True
+                for feature in iter_json_features(codecs.getreader("utf-8")(req.raw), header):
+                    nb_features += 1
+                    peps_metrics.count("peps_catalog_features_total")
+                    yield feature
+                transfer.received(req.raw.tell())
+                complete = True
+            finally:
+                if not complete:
+                    # a page abandoned by its consumer gives its connection back to the pool
+                    req.close()
+        if 'ErrorCode' in header:
+            raise IOError(header['ErrorMessage'])
+        if nb_features == 0:
+            return
+        # follow the next link when resto provides one, else ask for the next page
+        # the page number is kept, as the next link may be missing from a later page
+        url = next_link(header)
+        page += 1
+        if url is not None:
+            params = None
+        elif nb_features < max_records:
+            return
+        else:
+            url = SEARCH_URL.format(collection)
+            params = dict(query)
+            params["maxRecords"] = max_records
+            params["page"] = page
+
+
+def split_dates(start_date, end_date, days):
+    """
+    Splits a search period into windows of days days, each one starting at the end of the previous one
+    :return: list of (start_date, end_date), format : str(XXXX-XX-XX)
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    windows = []
+    while start < end:
+        stop = min(start + timedelta(days=days), end)
+        windows.append((start.isoformat(), stop.isoformat()))
+        start = stop
+    return windows
+
+
+def split_box(lonmin, latmin, lonmax, latmax, step):
+    """ splits a rectangle into boxes of at most step degrees, as values of the 'box' search parameter """
+    boxes = []
+    lat = latmin
+    while lat < latmax:
+        lon = lonmin
+        while lon < lonmax:
+            boxes.append("{},{},{},{}".format(lon, lat, min(lon + step, lonmax), min(lat + step, latmax)))
+            lon += step
+        lat += step
+    return boxes
+
+
+def search_many(session, queries, jobs=4, collection="S2ST", catalog=None, max_records=MAX_RECORDS):
+    """
+    Runs several catalog searches, at most jobs at a time, and yields their
+    features as they arrive. A product found by several searches (overlapping
+    tiles, boxes or dates) is only yielded once. When a search fails, or the
+    consumer stops, the other searches are stopped and their answers closed.
+    :param queries: list of search parameters, see search_features
+    :param catalog: CatalogCache answering the searches when possible
+    """
+    todo = queue.Queue()
+    for query in queries:
+        todo.put(query)
+    # a few pages ahead of the consumer at most
+    results = queue.Queue(maxsize=4 * max_records)
+    done = object()
+    # set once the consumer stops, or a search failed
+    stop = threading.Event()
+
+    def put(item):
+        """ puts item in the results, unless the searches are abandoned while the queue is full """
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        while not stop.is_set():
+            try:
+                query = todo.get_nowait()
+            except queue.Empty:
+                break
+            features = None
+            try:
+                if catalog is not None:
+                    features = catalog.search_features(session, query, collection, max_records)
+                else:
+                    features = search_features(session, query, collection, max_records)
+                for feature in features:
+                    if not put(feature):
+                        break
+            except Exception as e:
+                put(e)
+                break
+            finally:
+                # closes the answer being read if the search is abandoned
+                if features is not None:
+                    features.close()
+        put(done)
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(jobs, len(queries))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    seen = set()
+    running = len(threads)
+    try:
+        while running > 0:
+            feature = results.get()
+            if feature is done:
+                running -= 1
+            elif isinstance(feature, Exception):
+                # the other searches are abandoned, a partial list of products is of no use
+                raise feature
+            elif feature["properties"]["productIdentifier"] not in seen:
+                seen.add(feature["properties"]["productIdentifier"])
+                yield feature
+    finally:
+        stop.set()
+        for thread in threads:
+            while thread.is_alive():
+                # frees the workers waiting for room in the queue
+                try:
+                    while True:
+                        results.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(QUEUE_TIMEOUT)
+
+
+def save_features(features, fileName):
+    """ yields the features while writing them to fileName as a GeoJSON FeatureCollection """
+    with open(fileName, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(features):
+            if i > 0:
+                f.write(',\n')
+            json.dump(feature, f)
+            yield feature
+        f.write('\n]}\n')
+
+###########################################################################
+
+# fields of a feature used to select products
+CatalogRecord = namedtuple("CatalogRecord",
+                           "productIdentifier id storage platform orbitNumber resourceSize startDate")
+
+
+def to_record(feature):
+    """ keeps only the fields of a feature used to select products """
+    properties = feature["properties"]
+    return CatalogRecord(properties["productIdentifier"], feature["id"],
+                         properties.get("storage", {}).get("mode"), properties.get("platform"),
+                         properties.get("orbitNumber"), properties.get("resourceSize"),
+                         properties.get("startDate"))
+
+
+def iter_records(features):
+    for feature in features:
+        yield to_record(feature)
+
+
+def read_records(search_json_file):
+    """ yields the records of a search JSON file, reading it incrementally """
+    header = {}
+    with io.open(search_json_file, encoding="utf-8") as f:
+        for feature in iter_json_features(f, header):
+            yield to_record(feature)
+    if 'ErrorCode' in header:
+        raise IOError(header['ErrorMessage'])
+
+
+def parse_catalog(records, orbit=None):
+    """
+    Sorts the products of a catalog request
+    :param records: CatalogRecord iterable, from iter_records or read_records
+    :param orbit: if given, only the products of this relative orbit are kept
+    :type orbit: int
+    :return: last product (None if the search found nothing), and dicts of the product ids,
+             storage modes and sizes
+    The errors of the search (connection, answer of PEPS such as Unauthorized) raise IOError.
+    """
+    download_dict = {}
+    storage_dict = {}
+    size_dict = {}
+    prod = None
+    for record in records:
+        prod = record.productIdentifier
+        print(prod, record.storage)
+        if orbit is None or prod.find("_R%03d" % orbit) > 0:
+            download_dict[prod] = record.id
+            storage_dict[prod] = record.storage
+            size_dict[prod] = record.resourceSize
+
+    return(prod, download_dict, storage_dict, size_dict)
+
+###########################################################################
+
+
+class CatalogCache(object):
+    """
+    Local SQLite copy of the catalog searches.
+    For each query (collection, product type and geometry), the cache knows the
+    ranges of acquisition dates already retrieved, and only asks PEPS for the
+    dates outside of them. Each search records its own range once it succeeded,
+    so that the windows of a period searched in parallel leave a gap where one
+    of them failed. The last refresh_days before the search date are always
+    asked again, since PEPS can still be ingesting those products.
+    The storage mode is the one of the last search, a product moved between disk
+    and tape since then is not updated.
+    """
+
+    def __init__(self, fileName, refresh_days=3):
+        self.refresh_days = refresh_days
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fileName, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS products ("
+                            "query_key TEXT, productIdentifier TEXT, id TEXT, storage TEXT, platform TEXT, "
+                            "orbitNumber INTEGER, resourceSize INTEGER, startDate TEXT, "
+                            "PRIMARY KEY (query_key, productIdentifier))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS products_date ON products (query_key, startDate)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS coverage_ranges ("
+                            "query_key TEXT, start_date TEXT, end_date TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS coverage_key ON coverage_ranges (query_key)")
+            # one range per query in the first version of the cache
+            tables = [row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            if "coverage" in tables:
+                self.db.execute("INSERT INTO coverage_ranges SELECT query_key, start_date, end_date FROM coverage")
+                self.db.execute("DROP TABLE coverage")
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def query_key(query, collection):
+        """ identifies a search independently of its dates """
+        criteria = ["{}={}".format(key, query[key]) for key in sorted(query)
+                    if key not in ("startDate", "completionDate", "maxRecords", "page")]
+        return "|".join([collection] + criteria)
+
+    def coverage(self, key):
+        """ (start, end) date ranges already retrieved for the query key, sorted and disjoint """
+        return self.db.execute("SELECT start_date, end_date FROM coverage_ranges WHERE query_key = ? "
+                               "ORDER BY start_date", (key,)).fetchall()
+
+    def missing_ranges(self, key, start_date, end_date):
+        """ returns the (start, end) date ranges which have to be asked to PEPS """
+        ranges = []
+        for (lo, hi) in self.coverage(key):
+            if hi <= start_date:
+                continue
+            if lo >= end_date:
+                break
+            if lo > start_date:
+                ranges.append((start_date, lo))
+            start_date = max(start_date, hi)
+        if start_date < end_date:
+            ranges.append((start_date, end_date))
+        return ranges
+
+    def add_coverage(self, key, start_date, end_date):
+        """ records that the dates from start_date to end_date were retrieved, merging the ranges which touch """
+        for (lo, hi) in self.coverage(key):
+            if lo <= end_date and hi >= start_date:
+                start_date = min(start_date, lo)
+                end_date = max(end_date, hi)
+                self.db.execute("DELETE FROM coverage_ranges WHERE query_key = ? AND start_date = ? AND end_date = ?",
+                                (key, lo, hi))
+        self.db.execute("INSERT INTO coverage_ranges VALUES (?, ?, ?)", (key, start_date, end_date))
+
+    def store(self, key, features):
+        """ adds or updates features, yielding them as they are stored """
+        for feature in features:
+            properties = feature["properties"]
+            storage = properties.get("storage", {}).get("mode")
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (key, properties["productIdentifier"], feature["id"], storage,
+                                 properties.get("platform"), properties.get("orbitNumber"),
+                                 properties.get("resourceSize"), properties.get("startDate")))
+            yield feature
+
+    def search_features(self, session, query, collection="S2ST", max_records=MAX_RECORDS):
+        """ same as search_features, answering from the cache when possible """
+        key = self.query_key(query, collection)
+        start_date = query["startDate"]
+        end_date = query["completionDate"]
+        # recent acquisitions are not considered complete in the catalog yet
+        complete_until = (date.today() - timedelta(days=self.refresh_days)).isoformat()
+        with self.lock:
+            ranges = self.missing_ranges(key, start_date, end_date)
+        for (missing_start, missing_end) in ranges:
+            print("asking PEPS for {} from {} to {}".format(key, missing_start, missing_end))
+            missing = dict(query)
+            missing["startDate"] = missing_start
+            missing["completionDate"] = missing_end
+            for feature in self.store(key, search_features(session, missing, collection, max_records)):
+                pass
+        with self.lock:
+            # only reached if all the missing ranges were retrieved
+            covered_until = min(end_date, complete_until)
+            if covered_until > start_date:
+                self.add_coverage(key, start_date, covered_until)
+            self.db.commit()
+            rows = self.db.execute("SELECT productIdentifier, id, storage, platform, orbitNumber, resourceSize, "
+                                   "startDate FROM products WHERE query_key = ? AND startDate >= ? AND startDate < ? "
+                                   "ORDER BY startDate", (key, start_date, end_date)).fetchall()
+        for (prod, feature_id, storage, platform, orbitN, resourceSize, acq_date) in rows:
+            yield {"id": feature_id,
+                   "properties": {"productIdentifier": prod, "storage": {"mode": storage},
+                                  "platform": platform, "orbitNumber": orbitN,
+                                  "resourceSize": resourceSize, "startDate": acq_date}}
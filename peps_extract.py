@@ -0,0 +1,435 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Extraction of the L2A products while they are downloaded.
+The members of the zip file are read from its local headers as the bytes
+arrive, and written to a temporary folder which is renamed to the product
+folder once the whole archive is received and verified.
+"""
+import fnmatch
+import os
+import os.path
+import shutil
+import struct
+import zlib
+from collections import namedtuple
+import peps_http
+import peps_manifest
+
+LOCAL_HEADER_SIZE = 30
+CENTRAL_HEADER_SIZE = 46
+# end of a remote zip asked first, enough for the central directory of an L2A product
+REMOTE_TAIL_SIZE = 64 * 1024
+DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+# signatures found after the last member
+END_SIGNATURES = (peps_manifest.CENTRAL_SIGNATURE, peps_manifest.EOCD64_SIGNATURE,
+                  peps_manifest.EOCD_SIGNATURE)
+STORED = 0
+DEFLATED = 8
+FLAG_ENCRYPTED = 0x1
+FLAG_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+###########################################################################
+
+
+class Member(object):
+    """ member of the archive being extracted """
+
+    def __init__(self, name, method, flags, crc, compressed_size, size, zip64, fileName):
+        self.name = name
+        self.method = method
+        self.flags = flags
+        self.crc = crc
+        self.size = size
+        self.zip64 = zip64
+        # compressed bytes left, unknown for a deflated member followed by a data descriptor
+        self.remaining = compressed_size
+        if flags & FLAG_DESCRIPTOR and compressed_size == 0 and method == DEFLATED:
+            self.remaining = None
+        self.decompressor = zlib.decompressobj(-15) if method == DEFLATED else None
+        self.computed_crc = 0
+        self.written = 0
+        self.f = None
+        if name.endswith("/"):
+            if not os.path.isdir(fileName):
+                os.makedirs(fileName)
+        else:
+            if not os.path.isdir(os.path.dirname(fileName)):
+                os.makedirs(os.path.dirname(fileName))
+            self.f = open(fileName, "wb")
+
+    def write(self, data):
+        """ writes the compressed bytes data, returns the bytes found after the end of the member """
+        unused = b""
+        if self.decompressor is not None:
+            data_out = self.decompressor.decompress(data)
+            unused = self.decompressor.unused_data
+        else:
+            data_out = data
+        if len(data_out) > 0:
+            self.computed_crc = zlib.crc32(data_out, self.computed_crc)
+            self.written += len(data_out)
+            if self.f is None:
+                raise ValueError("{}: a directory has content".format(self.name))
+            self.f.write(data_out)
+        return unused
+
+    def finished(self):
+        if self.remaining is not None:
+            return self.remaining == 0
+        return self.decompressor.eof
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if (self.computed_crc & 0xFFFFFFFF) != self.crc:
+            raise ValueError("{}: CRC does not match".format(self.name))
+        if self.written != self.size:
+            raise ValueError("{}: {:d} bytes extracted instead of {:d}".format(self.name, self.written, self.size))
+
+
+class StreamExtractor(object):
+    """
+    Extracts the zip file whose bytes are given to update() in dest_dir
+    It has the interface of peps_manifest.StreamVerifier, so that it can be
+    given to peps_http.downloadFile, and passes the bytes to the verifier if any.
+    The errors in the archive raise ValueError.
+    """
+
+    def __init__(self, dest_dir, verifier=None):
+        self.dest_dir = dest_dir
+        self.verifier = verifier
+        self.member = None
+        self.reset()
+
+    def reset(self):
+        self.discard()
+        os.makedirs(self.dest_dir)
+        self.size = 0
+        self.buf = bytearray()
+        self.member = None
+        self.descriptor = False
+        self.done = False
+        if self.verifier is not None:
+            self.verifier.reset()
+
+    def discard(self):
+        """ removes what was extracted """
+        if self.member is not None and self.member.f is not None:
+            self.member.f.close()
+        if os.path.isdir(self.dest_dir):
+            shutil.rmtree(self.dest_dir)
+
+    def update(self, data):
+        self.size += len(data)
+        if self.verifier is not None:
+            self.verifier.update(data)
+        if self.done:
+            return
+        self.buf += data
+        while self.step():
+            pass
+
+    def step(self):
+        """ uses the buffered bytes, returns False when more bytes are needed """
+        if self.member is None:
+            return self.read_header()
+        if self.descriptor:
+            return self.read_descriptor()
+        return self.read_data()
+
+    def read_header(self):
+        if len(self.buf) < 4:
+            return False
+        signature = bytes(self.buf[:4])
+        if signature in END_SIGNATURES:
+            # the central directory is checked by the verifier
+            self.done = True
+            self.buf = bytearray()
+            return False
+        if signature != peps_manifest.LOCAL_SIGNATURE:
+            raise ValueError("local file header expected at offset {:d}".format(self.size - len(self.buf)))
+        if len(self.buf) < LOCAL_HEADER_SIZE:
+            return False
+        (flags, method, crc, compressed_size, size, name_len, extra_len) = struct.unpack(
+            "<6xHH4xIIIHH", bytes(self.buf[:LOCAL_HEADER_SIZE]))
+        header_size = LOCAL_HEADER_SIZE + name_len + extra_len
+        if len(self.buf) < header_size:
+            return False
+        name = bytes(self.buf[LOCAL_HEADER_SIZE:LOCAL_HEADER_SIZE + name_len])
+        name = name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        extra = bytes(self.buf[LOCAL_HEADER_SIZE + name_len:header_size])
+        del self.buf[:header_size]
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            (tag, length) = struct.unpack("<HH", extra[pos:pos + 4])
+            if tag == 0x0001:
+                # zip64 extra field: the sizes saturated in the header, in this order
+                zip64 = True
+                field = extra[pos + 4:pos + 4 + length]
+                if size == 0xFFFFFFFF and len(field) >= 8:
+                    (size,) = struct.unpack("<Q", field[:8])
+                    field = field[8:]
+                if compressed_size == 0xFFFFFFFF and len(field) >= 8:
+                    (compressed_size,) = struct.unpack("<Q", field[:8])
+            pos += 4 + length
+        if flags & FLAG_ENCRYPTED:
+            raise ValueError("{}: encrypted members are not supported".format(name))
+        if method not in (STORED, DEFLATED):
+            raise ValueError("{}: compression method {:d} is not supported".format(name, method))
+        if method == STORED and flags & FLAG_DESCRIPTOR and compressed_size == 0 and not name.endswith("/"):
+            raise ValueError("{}: the size of a stored member must be known to extract it on the fly".format(name))
+        fileName = os.path.normpath(os.path.join(self.dest_dir, name))
+        if not fileName.startswith(os.path.normpath(self.dest_dir) + os.sep):
+            raise ValueError("{}: member outside of the product folder".format(name))
+        self.member = Member(name, method, flags, crc, compressed_size, size, zip64, fileName)
+        return True
+
+    def read_data(self):
+        member = self.member
+        if member.remaining is not None:
+            n = min(len(self.buf), member.remaining)
+            data = bytes(self.buf[:n])
+            del self.buf[:n]
+            member.remaining -= n
+            member.write(data)
+        else:
+            data = bytes(self.buf)
+            self.buf = bytearray(member.write(data))
+        if not member.finished():
+            return False
+        if member.flags & FLAG_DESCRIPTOR:
+            self.descriptor = True
+        else:
+            self.close_member()
+        return True
+
+    def read_descriptor(self):
+        size_len = 8 if self.member.zip64 else 4
+        start = 4 if bytes(self.buf[:4]) == DESCRIPTOR_SIGNATURE else 0
+        if len(self.buf) < start + 4 + 2 * size_len:
+            return False
+        (self.member.crc,) = struct.unpack("<I", bytes(self.buf[start:start + 4]))
+        if size_len == 8:
+            (self.member.size,) = struct.unpack("<Q", bytes(self.buf[start + 12:start + 20]))
+        else:
+            (self.member.size,) = struct.unpack("<I", bytes(self.buf[start + 8:start + 12]))
+        del self.buf[:start + 4 + 2 * size_len]
+        self.descriptor = False
+        self.close_member()
+        return True
+
+    def close_member(self):
+        member = self.member
+        self.member = None
+        member.close()
+
+    def close(self, archive=True):
+        """ checks that the whole archive was extracted, or only its last member if not archive """
+        if self.member is not None or len(self.buf) > 0:
+            raise ValueError("the archive ends in the middle of a member")
+        if archive and not self.done:
+            raise ValueError("the archive ends before its central directory")
+
+    def finalize(self, productName):
+        """
+        Renames the extracted folder to productName. When the archive holds a
+        single folder named as the product, this folder becomes productName.
+        """
+        entries = os.listdir(self.dest_dir)
+        source = self.dest_dir
+        if entries == [os.path.basename(productName)] and os.path.isdir(os.path.join(self.dest_dir, entries[0])):
+            source = os.path.join(self.dest_dir, entries[0])
+        if os.path.isdir(productName):
+            shutil.rmtree(productName)
+        os.rename(source, productName)
+        if source != self.dest_dir:
+            os.rmdir(self.dest_dir)
+
+###########################################################################
+
+
+def product_folder(fileName):
+    """ folder of the product extracted from the zip file fileName """
+    return os.path.splitext(fileName)[0]
+
+
+def extract_verified(session, url, fileName, manifest, keep_zip=False):
+    """
+    Downloads url and extracts it to the product folder of fileName on the fly
+    The product folder only appears once the archive is complete and verified.
+    The zip file itself is only written to fileName if keep_zip is set.
+    The disk space of the session is booked for the extracted members, as given
+    by the central directory, in addition to the zip file if it is kept.
+    Returns the size of the zip file.
+    """
+    productName = product_folder(fileName)
+    directory = os.path.dirname(os.path.abspath(fileName))
+    space = getattr(session, "disk_space", None)
+    members = members_size(session, url) if space is not None else None
+    verifier = peps_manifest.StreamVerifier()
+    extractor = StreamExtractor(productName + ".part", verifier)
+    try:
+        if keep_zip:
+            # the zip file and the members are booked at once
+            size = peps_http.downloadFile(session, url, fileName, verifier=extractor, extra=members or 0)
+        else:
+            size = peps_http.downloadStream(session, url, extractor, directory=directory, written=members)
+        extractor.close()
+    except ValueError as e:
+        extractor.discard()
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+        raise IOError("{} can't be extracted: {}".format(os.path.basename(fileName), e))
+    except Exception:
+        extractor.discard()
+        raise
+    sha256, error = verifier.result()
+    if error is not None:
+        manifest.record(os.path.basename(fileName), size, sha256, error)
+        extractor.discard()
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+        raise IOError("{} is not a valid zip file: {}".format(os.path.basename(fileName), error))
+    extractor.finalize(productName)
+    manifest.record(os.path.basename(fileName), size, sha256, extracted=True)
+    return size
+
+###########################################################################
+
+# member of a remote zip, as described by its central directory
+ZipEntry = namedtuple("ZipEntry", "name offset compressed_size size")
+
+
+def parse_central_directory(data):
+    """ returns the ZipEntry list of a central directory """
+    entries = []
+    pos = 0
+    while pos + CENTRAL_HEADER_SIZE <= len(data):
+        if data[pos:pos + 4] != peps_manifest.CENTRAL_SIGNATURE:
+            raise ValueError("corrupted central directory entry {:d}".format(len(entries)))
+        (flags, compressed_size, size, name_len, extra_len, comment_len, offset) = struct.unpack(
+            "<8xH10xIIHHH8xI", data[pos:pos + CENTRAL_HEADER_SIZE])
+        name = data[pos + CENTRAL_HEADER_SIZE:pos + CENTRAL_HEADER_SIZE + name_len]
+        name = name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        extra = data[pos + CENTRAL_HEADER_SIZE + name_len:pos + CENTRAL_HEADER_SIZE + name_len + extra_len]
+        i = 0
+        while i + 4 <= len(extra):
+            (tag, length) = struct.unpack("<HH", extra[i:i + 4])
+            if tag == 0x0001:
+                # zip64 extra field: the saturated values, in this order
+                field = extra[i + 4:i + 4 + length]
+                values = []
+                for value in (size, compressed_size, offset):
+                    if value == 0xFFFFFFFF and len(field) >= 8:
+                        value = struct.unpack("<Q", field[:8])[0]
+                        field = field[8:]
+                    values.append(value)
+                (size, compressed_size, offset) = values
+            i += 4 + length
+        entries.append(ZipEntry(name, offset, compressed_size, size))
+        pos += CENTRAL_HEADER_SIZE + name_len + extra_len + comment_len
+    return entries
+
+
+def read_remote_directory(session, url):
+    """
+    Reads the central directory of the zip file url with Range requests
+    :return: ZipEntry list, sorted by offset, and the offset of the central directory
+    """
+    tail, size = peps_http.getRange(session, url, -REMOTE_TAIL_SIZE)
+    if size is None:
+        raise ValueError("size of {} unknown".format(url))
+    (cd_offset, cd_size, nb_entries) = peps_manifest.locate_central_directory(tail, size)
+    start = cd_offset - (size - len(tail))
+    if start >= 0:
+        directory = tail[start:start + cd_size]
+    else:
+        directory, size = peps_http.getRange(session, url, cd_offset, cd_offset + cd_size - 1)
+    entries = parse_central_directory(directory)
+    if len(entries) != nb_entries:
+        raise ValueError("{:d} entries found in the central directory instead of {:d}".format(
+            len(entries), nb_entries))
+    return sorted(entries, key=lambda entry: entry.offset), cd_offset
+
+
+def members_size(session, url):
+    """ returns the uncompressed size of the members of the zip file url, None if it can't be read """
+    try:
+        entries, cd_offset = read_remote_directory(session, url)
+    except ValueError:
+        # no Range requests, or not a zip file, which the extraction finds out
+        return None
+    return sum(entry.size for entry in entries)
+
+
+def select_ranges(entries, cd_offset, patterns):
+    """
+    Returns the (start, end) byte ranges holding the members whose name matches
+    one of the patterns. Adjacent members are merged in a single range.
+    """
+    ranges = []
+    for (i, entry) in enumerate(entries):
+        if entry.name.endswith("/") or not any(fnmatch.fnmatch(entry.name, pattern) for pattern in patterns):
+            continue
+        # the local header, data and data descriptor end where the next member starts
+        end = entries[i + 1].offset if i + 1 < len(entries) else cd_offset
+        if len(ranges) > 0 and ranges[-1][1] == entry.offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((entry.offset, end))
+    return ranges
+
+
+class RangeFeed(object):
+    """ gives the bytes of one range of the remote zip to the extractor """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.size = 0
+
+    def reset(self):
+        raise ValueError("the transfer of a member can't be started again")
+
+    def update(self, data):
+        self.size += len(data)
+        self.extractor.update(data)
+
+
+def extract_members(session, url, fileName, patterns, manifest=None):
+    """
+    Extracts the members of the remote zip url whose name matches one of the
+    patterns (fnmatch globs, such as "*_FRE_B4.tif") to the product folder of
+    fileName. Only the central directory and the selected members are downloaded.
+    The product is recorded in manifest, if given, as partly extracted with these patterns.
+    The disk space of the session is booked for the uncompressed size of the members.
+    Returns the number of bytes of the selected members.
+    """
+    productName = product_folder(fileName)
+    directory = os.path.dirname(os.path.abspath(fileName))
+    extractor = StreamExtractor(productName + ".part")
+    try:
+        entries, cd_offset = read_remote_directory(session, url)
+        ranges = select_ranges(entries, cd_offset, patterns)
+        if len(ranges) == 0:
+            raise ValueError("no member matches {}".format(" ".join(patterns)))
+        size = 0
+        for (start, end) in ranges:
+            # a range only holds selected members
+            written = sum(entry.size for entry in entries if start <= entry.offset < end)
+            size += peps_http.downloadStream(session, url, RangeFeed(extractor), start=start, end=end - 1,
+                                             directory=directory, written=written)
+            extractor.close(archive=False)
+    except ValueError as e:
+        extractor.discard()
+        raise IOError("{} can't be extracted: {}".format(os.path.basename(fileName), e))
+    except Exception:
+        extractor.discard()
+        raise
+    extractor.finalize(productName)
+    if manifest is not None:
+        manifest.record(os.path.basename(fileName), size, None, extracted=True, partial=patterns)
+    return size
@@ -0,0 +1,794 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+HTTP client layer shared by the PEPS scripts.
+All the catalog, WPS status and download requests of a run go through the
+same requests.Session, so that connections to peps.cnes.fr are kept alive
+and reused instead of doing a TLS handshake for every call.
+"""
+import errno
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import socket
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as TransferError
+import peps_metrics
+try:
+    from http.client import HTTPException, HTTPResponse
+except ImportError:
+    from httplib import HTTPException, HTTPResponse
+
+# number of hosts (scheme + host name) for which a connection pool is kept
+POOL_CONNECTIONS = 4
+# minimum number of connections kept alive for each host
+POOL_MAXSIZE = 4
+# connections reserved for status and catalog calls on top of the downloads
+STATUS_CONNECTIONS = 2
+# bytes copied at a time from an answer to its file
+COPY_SIZE = 1024 * 1024
+# seconds to connect, and seconds without receiving any byte before a download is retried
+DOWNLOAD_TIMEOUT = (30, 300)
+# answers telling that the server is overloaded
+CONGESTION_STATUS = (429, 503)
+# errors of a connection broken or timed out while its answer is read
+NETWORK_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.ECONNREFUSED, errno.ETIMEDOUT,
+                  errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN)
+# a request whose answer takes more than LATENCY_FACTOR times the best latency seen,
+# and more than LATENCY_FLOOR seconds, shows that the server is overloaded
+LATENCY_FACTOR = 4
+LATENCY_FLOOR = 2.0
+# the concurrency is only raised while the throughput of each connection stays above
+# RATE_DROP times its average
+RATE_DROP = 0.5
+# seconds after a decrease during which the other failures do not decrease the limit again
+COOLDOWN = 5.0
+# bytes kept free on the volume of the downloads
+DISK_RESERVE = 10 ** 9
+# seconds between two checks of the free space by a download waiting for it
+SPACE_POLL = 30
+
+_session = None
+
+###########################################################################
+
+
+def new_session(email, passwd, jobs=1, max_per_host=None, verify=False, adaptive=False, max_rate=None,
+                reserve=DISK_RESERVE, chunk_size=COPY_SIZE, sync_bytes=None):
+    """
+    Creates a session with a keep-alive connection pool
+    :param email: PEPS account
+    :type email: str
+    :param passwd: PEPS password
+    :type passwd: str
+    :param jobs: number of parallel downloads the pool is sized for
+    :type jobs: int
+    :param max_per_host: maximum number of simultaneous connections to one host,
+                         by default jobs + STATUS_CONNECTIONS
+    :type max_per_host: int
+    :param verify: check the server TLS certificate
+    :type verify: bool
+    :param adaptive: adapt the number of simultaneous downloads (at most jobs) and
+                     status requests to the load of the server, see AdaptiveLimiter
+    :type adaptive: bool
+    :param max_rate: if given, cap of the total download throughput, in MB/s
+    :type max_rate: float
+    :param reserve: bytes kept free on the volume of the downloads, see DiskSpace
+    :type reserve: int
+    :param chunk_size: bytes read at a time by the downloads, see Writer
+    :type chunk_size: int
+    :param sync_bytes: flush policy of the downloaded files to the disk, see Writer
+    :type sync_bytes: int
+    """
+    if max_per_host is None:
+        max_per_host = max(POOL_MAXSIZE, jobs + STATUS_CONNECTIONS)
+    # pool_block makes the threads wait for a free connection instead of
+    # opening more than max_per_host connections to the same host
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=max_per_host, pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = (email, passwd)
+    session.verify = verify
+    # read by Transfer for each download or status request
+    session.download_limiter = AdaptiveLimiter(jobs) if adaptive else None
+    session.status_limiter = AdaptiveLimiter(max_per_host) if adaptive else None
+    session.throttle = Throttle(max_rate * 1e6) if max_rate else None
+    session.disk_space = DiskSpace(reserve)
+    session.writer = Writer(chunk_size, sync_bytes)
+    return session
+
+
+def get_session(email=None, passwd=None, jobs=1, max_per_host=None, verify=False, adaptive=False, max_rate=None,
+                reserve=DISK_RESERVE, chunk_size=COPY_SIZE, sync_bytes=None):
+    """ returns the session shared by the whole process, created at first call """
+    global _session
+    if _session is None:
+        if email is None:
+            raise ValueError("PEPS credentials are needed to create the session")
+        _session = new_session(email, passwd, jobs, max_per_host, verify, adaptive, max_rate, reserve,
+                               chunk_size, sync_bytes)
+    return _session
+
+###########################################################################
+
+
+class AdaptiveLimiter(object):
+    """
+    Additive increase, multiplicative decrease limit on the number of simultaneous requests
+    The limit starts at max_limit. It is halved when a request fails, is answered
+    429 or 503, or when its latency spikes, and grows back by one every `limit`
+    successful requests, as long as the throughput of each connection holds.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.active = 0
+        self.condition = threading.Condition()
+        self.min_latency = None
+        self.rate = None
+        self.last_decrease = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, ok=True, latency=None, rate=None):
+        """
+        :param ok: False if the request failed because of the server load
+        :param latency: seconds before the answer started
+        :param rate: bytes per second received by the request, if large enough to be measured
+        """
+        with self.condition:
+            self.active -= 1
+            if not ok or self.latency_spike(latency):
+                self.decrease()
+            elif self.rate_holds(rate):
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def latency_spike(self, latency):
+        if latency is None:
+            return False
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        return latency > max(LATENCY_FLOOR, LATENCY_FACTOR * self.min_latency)
+
+    def rate_holds(self, rate):
+        if rate is None:
+            return True
+        if self.rate is None:
+            self.rate = rate
+        holds = rate >= RATE_DROP * self.rate
+        self.rate = 0.8 * self.rate + 0.2 * rate
+        return holds
+
+    def decrease(self):
+        now = time.time()
+        if now - self.last_decrease < COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit / 2)
+        print("server overloaded, at most {:d} simultaneous requests".format(int(self.limit)))
+
+
+class Throttle(object):
+    """ caps the number of bytes per second received by all the threads """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.time()
+            # each chunk books the time it takes at the allowed rate
+            self.next_time = max(now, self.next_time) + nbytes / float(self.rate)
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def free_space(directory):
+    """ bytes available to the user on the volume of directory """
+    if hasattr(shutil, "disk_usage"):
+        return shutil.disk_usage(directory).free
+    st = os.statvfs(directory)
+    return st.f_bavail * st.f_frsize
+
+
+class DiskSpace(object):
+    """
+    Admission of the downloads by the free space of their volume
+    A download of size bytes is admitted once the free space of its volume, minus
+    the reserve and minus the bytes booked by the downloads already admitted, is
+    enough for it. The other downloads wait in a queue per volume, in their order
+    of arrival; the free space is checked again every SPACE_POLL seconds, as other
+    processes sharing the volume may also free some. A download which does not fit
+    while nothing else is booked on its volume fails, instead of blocking the queue.
+    """
+
+    def __init__(self, reserve=DISK_RESERVE):
+        self.reserve = reserve
+        self.condition = threading.Condition()
+        # bytes booked, and downloads waiting, by device
+        self.booked = {}
+        self.queues = {}
+
+    def fits(self, directory, device, size):
+        return free_space(directory) - self.reserve - self.booked.get(device, 0) >= size
+
+    def admit(self, directory, size, block=True):
+        """
+        Books size bytes on the volume of directory, waiting for them if block is set
+        :return: Reservation to release once the bytes are written,
+                 None if block is not set and the download has to wait
+        :raise IOError: if size does not fit in the volume even when nothing else is booked
+        """
+        device = os.stat(directory).st_dev
+        ticket = object()
+        with self.condition:
+            queue = self.queues.setdefault(device, [])
+            queue.append(ticket)
+            waiting = False
+            try:
+                while queue[0] is not ticket or not self.fits(directory, device, size):
+                    if queue[0] is ticket and self.booked.get(device, 0) == 0:
+                        # no download of ours can free space for it
+                        raise IOError("{:.0f} MB needed in {}, only {:.0f} MB free and {:.0f} MB kept".format(
+                            size / 1e6, directory, free_space(directory) / 1e6, self.reserve / 1e6))
+                    if not block:
+                        return None
+                    if not waiting and queue[0] is ticket:
+                        waiting = True
+                        print("waiting for {:.0f} MB of free space in {} ({:.0f} MB free, {:.0f} MB kept)".format(
+                            size / 1e6, directory, free_space(directory) / 1e6, self.reserve / 1e6))
+                    self.condition.wait(SPACE_POLL)
+                self.booked[device] = self.booked.get(device, 0) + size
+            finally:
+                queue.remove(ticket)
+                self.condition.notify_all()
+        return Reservation(self, device, size)
+
+    def release(self, device, size):
+        with self.condition:
+            self.booked[device] -= size
+            self.condition.notify_all()
+
+
+class Reservation(object):
+    """ bytes booked by a download admitted by DiskSpace """
+
+    def __init__(self, space, device, size):
+        self.space = space
+        self.device = device
+        self.size = size
+
+    def release(self):
+        """ gives the bytes back, once they are written or not needed anymore """
+        if self.size > 0:
+            self.space.release(self.device, self.size)
+            self.size = 0
+
+
+def sync(f, data_only=False):
+    """ writes what the system still keeps in memory of the file f to the disk """
+    f.flush()
+    if data_only and hasattr(os, "fdatasync"):
+        os.fdatasync(f.fileno())
+    else:
+        os.fsync(f.fileno())
+
+
+def body_file(r):
+    """
+    http.client answer under the urllib3 one of the streamed answer r, whose readinto()
+    reads the body in a buffer without allocating it, or None if there is none
+    """
+    fp = getattr(r.raw, "_fp", None)
+    if not isinstance(fp, HTTPResponse) or not hasattr(fp, "readinto"):
+        return None
+    return fp
+
+
+class Writer(object):
+    """
+    Copies the answers of the downloads to their files or consumers
+    Each thread reads the answers in its own buffer of chunk_size bytes, allocated
+    once, through a memoryview, instead of allocating a new bytes object for each
+    chunk.
+    :param chunk_size: bytes read at a time
+    :param sync_bytes: None to let the system write the files to the disk when it
+                       wants, 0 to write each file to the disk once downloaded, or
+                       else also after every sync_bytes bytes received
+    """
+
+    def __init__(self, chunk_size=COPY_SIZE, sync_bytes=None):
+        self.chunk_size = chunk_size
+        self.sync_bytes = sync_bytes
+        self.local = threading.local()
+
+    def buffer(self):
+        view = getattr(self.local, "view", None)
+        if view is None:
+            view = self.local.view = memoryview(bytearray(self.chunk_size))
+        return view
+
+    def chunks(self, r):
+        """ yields the body of the streamed answer r, as views of the buffer only valid until the next one """
+        fp = body_file(r)
+        if fp is None:
+            for chunk in iter(lambda: r.raw.read(self.chunk_size), b""):
+                yield chunk
+            return
+        view = self.buffer()
+        complete = False
+        try:
+            n = fp.readinto(view)
+            while n > 0:
+                yield view[:n]
+                n = fp.readinto(view)
+            # http.client does not check the length of the body, urllib3 does
+            complete = not fp.length
+        except HTTPException as e:
+            raise TransferError("Connection broken: {!r}".format(e))
+        finally:
+            if not complete:
+                # the connection can't be used again: it is closed and given back to the pool
+                r.close()
+        if not complete:
+            raise TransferError("Connection broken: {:d} bytes missing".format(fp.length))
+        # gives the connection back to the pool, as urllib3 does at the end of the body
+        r.raw.release_conn()
+
+    def copy(self, r, f, transfer, verifier=None):
+        """
+        Writes the body of the streamed answer r to the file f, from its position
+        :param transfer: Transfer of r, which receives the number of bytes copied
+        :param verifier: if given, its update() receives all the bytes written
+        :return: number of bytes written
+        """
+        written = 0
+        synced = 0
+        for chunk in self.chunks(r):
+            f.write(chunk)
+            if verifier is not None:
+                verifier.update(chunk)
+            transfer.data(chunk)
+            written += len(chunk)
+            if self.sync_bytes and written - synced >= self.sync_bytes:
+                sync(f, data_only=True)
+                synced = written
+        if self.sync_bytes is not None:
+            sync(f)
+        return written
+
+
+def is_network_error(e):
+    """ tells if the exception e was raised by the connection to the server, and not by the local files """
+    if isinstance(e, (requests.exceptions.RequestException, TransferError, socket.timeout)):
+        return True
+    # the socket errors read from a raw connection are plain OSError
+    return isinstance(e, EnvironmentError) and getattr(e, "errno", None) in NETWORK_ERRNOS
+
+
+def is_congestion(e):
+    """ tells if the exception e of a request is a sign that the server is overloaded """
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 or e.response.status_code in CONGESTION_STATUS
+    return is_network_error(e)
+
+
+def retry_delay(e, attempt):
+    """ seconds to wait before retrying after e, as asked by a Retry-After header or doubled at each attempt """
+    delay = min(2 ** attempt, 60)
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        retry_after = e.response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+    return delay
+
+
+class Transfer(object):
+    """
+    Context of one request, made under the limiter and the throttle of the session:
+        with Transfer(session) as transfer:
+            r = session.get(url, stream=True)
+            transfer.answer(r)
+            for chunk in ...:
+                transfer.data(chunk)
+    """
+
+    def __init__(self, session, kind="download"):
+        self.kind = kind
+        # the submissions and catalog searches share the limiter of the status requests
+        self.limiter = getattr(session, ("download" if kind == "download" else "status") + "_limiter", None)
+        self.throttle = getattr(session, "throttle", None) if kind == "download" else None
+
+    def __enter__(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        self.t0 = time.time()
+        self.size = 0
+        self.latency = None
+        self.congested = False
+        self.code = None
+        return self
+
+    def answer(self, r):
+        self.latency = r.elapsed.total_seconds()
+        self.code = r.status_code
+        self.congested = r.status_code in CONGESTION_STATUS or r.status_code >= 500
+
+    def data(self, chunk):
+        self.received(len(chunk))
+
+    def received(self, nbytes):
+        self.size += nbytes
+        if self.throttle is not None:
+            self.throttle.consume(nbytes)
+
+    def __exit__(self, exc_type, exc, tb):
+        peps_metrics.count("peps_requests_total", kind=self.kind,
+                           code=self.code if self.code is not None else "error")
+        peps_metrics.observe("peps_request_seconds", time.time() - self.t0, kind=self.kind)
+        peps_metrics.count("peps_bytes_total", self.size, kind=self.kind)
+        if self.limiter is not None:
+            ok = not self.congested and (exc is None or not is_congestion(exc))
+            rate = None
+            if self.size >= COPY_SIZE:
+                rate = self.size / max(time.time() - self.t0, 1e-6)
+            self.limiter.release(ok, self.latency, rate)
+        return False
+
+###########################################################################
+
+
+def getURL(session, url, fileName):
+    """ writes the answer to url in fileName, IOError being raised if it is not a success """
+    with Transfer(session, "status") as transfer:
+        req = session.get(url)
+        transfer.answer(req)
+        transfer.data(req.content)
+    with open(fileName, "w") as f:
+        if sys.version_info[0] < 3:
+            f.write(req.text.encode('utf-8'))
+        else:
+            f.write(req.text)
+    if req.status_code != 200:
+        raise IOError("Wrong request status {} for {}".format(req.status_code, url))
+    print("Request OK")
+
+
+def getContent(session, url):
+    """ same as getURL, but the answer is kept in memory and returned as bytes """
+    with Transfer(session, "status") as transfer:
+        req = session.get(url)
+        transfer.answer(req)
+        transfer.data(req.content)
+    if req.status_code != 200:
+        raise IOError("Wrong request status {} for {}".format(req.status_code, url))
+    print("Request OK")
+    return req.content
+
+
+class ResponseCache(object):
+    """
+    Last answer to each url, with its ETag and Last-Modified validators, kept in
+    a directory, so that the next request of the url only gets the answer if it changed.
+    A value parsed from the answer may be kept with it, to avoid parsing it again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def meta(self, url):
+        try:
+            with open(self.path(url) + ".meta") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, fileName, content, mode="w"):
+        tmpName = "{}.{:d}.tmp".format(fileName, threading.current_thread().ident)
+        with open(tmpName, mode) as f:
+            f.write(content)
+        os.rename(tmpName, fileName)
+
+    def validators(self, url):
+        """ headers of a conditional request of url """
+        meta = self.meta(url)
+        headers = {}
+        if not os.path.isfile(self.path(url)):
+            return headers
+        if meta.get("etag") is not None:
+            headers['If-None-Match'] = meta["etag"]
+        if meta.get("last_modified") is not None:
+            headers['If-Modified-Since'] = meta["last_modified"]
+        return headers
+
+    def load(self, url):
+        with open(self.path(url), "rb") as f:
+            return f.read()
+
+    def store(self, url, req):
+        self.write(self.path(url), req.content, "wb")
+        self.write(self.path(url) + ".meta", json.dumps({"etag": req.headers.get('ETag'),
+                                                         "last_modified": req.headers.get('Last-Modified')}))
+
+    def parsed(self, url):
+        """ value parsed from the cached answer, or None """
+        return self.meta(url).get("parsed")
+
+    def set_parsed(self, url, value):
+        meta = self.meta(url)
+        meta["parsed"] = value
+        self.write(self.path(url) + ".meta", json.dumps(meta))
+
+
+def getConditional(session, url, cache=None):
+    """
+    Same as getContent, but with a cache (ResponseCache) the server is asked for
+    the answer only if it changed since the cached one (HTTP 304 otherwise)
+    :return: the answer as bytes, and False if it is the cached one
+    """
+    headers = cache.validators(url) if cache is not None else {}
+    with Transfer(session, "status") as transfer:
+        req = session.get(url, headers=headers)
+        transfer.answer(req)
+        transfer.data(req.content)
+    if req.status_code == 304:
+        print("Request OK (not modified)")
+        return cache.load(url), False
+    if req.status_code != 200:
+        raise IOError("Wrong request status {} for {}".format(req.status_code, url))
+    print("Request OK")
+    if cache is not None:
+        cache.store(url, req)
+    return req.content, True
+
+
+def feed_verifier(verifier, fileName):
+    """ gives the content of a partly downloaded file to a verifier """
+    verifier.reset()
+    with open(fileName, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_SIZE), b""):
+            verifier.update(chunk)
+
+
+def downloadStream(session, url, consumer, max_retries=10, start=0, end=None, directory=None, written=None):
+    """ gives the bytes of url to consumer.update(), without writing them to a file
+
+    With start and end, only these bytes of the file are asked (end included).
+    After a failure, the download is resumed at start + consumer.size with a Range
+    request, or started again after consumer.reset() if the server ignores it.
+    If the consumer writes what it receives to directory (an extraction), the
+    download only starts once the disk space of the session admits the bytes
+    written, by default the length of the answer.
+    Returns the number of bytes received
+    """
+    partial = start > 0 or end is not None
+    writer = getattr(session, "writer", None) or Writer()
+    space = getattr(session, "disk_space", None) if directory is not None else None
+    reservation = None
+    waiting = None
+    try:
+        for attempt in range(max_retries):
+            if waiting is not None:
+                reservation = space.admit(directory, waiting)
+                waiting = None
+            headers = {}
+            if consumer.size > 0 or partial:
+                headers['Range'] = 'bytes=%d-%s' % (start + consumer.size, end if end is not None else '')
+            try:
+                with Transfer(session) as transfer:
+                    r = session.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+                    transfer.answer(r)
+                    if r.status_code == 416:
+                        total = r.headers.get('Content-Range', '*/').split('/')[-1]
+                        r.close()
+                        if total.isdigit() and int(total) == start + consumer.size:
+                            return consumer.size
+                        consumer.reset()
+                        continue
+                    if r.status_code >= 400:
+                        # the connection of a streamed answer is only given back once closed
+                        r.close()
+                        r.raise_for_status()
+                    if r.status_code == 206:
+                        total = r.headers.get('Content-Range', '*/').split('/')[-1]
+                        total = int(total) if total.isdigit() else None
+                        if end is not None:
+                            total = end + 1 if total is None else min(total, end + 1)
+                        length = total - start if total is not None else None
+                    elif partial:
+                        r.close()
+                        raise ValueError("the server does not answer Range requests for {}".format(url))
+                    else:
+                        if consumer.size > 0:
+                            consumer.reset()
+                        length = r.headers.get('Content-Length')
+                        length = int(length) if length is not None else None
+                    if space is not None and reservation is None:
+                        needed = written if written is not None else max(0, (length or 0) - consumer.size)
+                        try:
+                            reservation = space.admit(directory, needed, block=False)
+                        except IOError:
+                            r.close()
+                            raise
+                        if reservation is None:
+                            # the connection is not kept open while waiting for space
+                            r.close()
+                            waiting = needed
+                            continue
+                    for chunk in writer.chunks(r):
+                        consumer.update(chunk)
+                        transfer.data(chunk)
+            except (requests.exceptions.RequestException, TransferError, IOError) as e:
+                if getattr(e, "errno", None) == errno.ENOSPC and space is not None:
+                    # the volume was filled by others: wait for space again, at the next attempt
+                    if reservation is not None:
+                        reservation.release()
+                        reservation = None
+                    print("{}: volume full, waiting for space".format(url.split('/')[-1]))
+                    continue
+                if not is_congestion(e):
+                    raise
+                print("download of {} interrupted ({}), retrying".format(url.split('/')[-1], e))
+                peps_metrics.count("peps_retries_total", kind="download")
+                time.sleep(retry_delay(e, attempt))
+                continue
+            if length is None or consumer.size == length:
+                return consumer.size
+            print("{}: got {:d} of {:d} bytes, resuming".format(url.split('/')[-1], consumer.size, length))
+            peps_metrics.count("peps_retries_total", kind="download")
+        raise IOError("could not download {} after {:d} attempts".format(url, max_retries))
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+
+def getRange(session, url, start, end=None):
+    """
+    Returns bytes start to end (included) of url, or its last -start bytes if start is negative
+    :return: the bytes and the size of the whole file
+    """
+    if start < 0:
+        headers = {'Range': 'bytes=%d' % start}
+    else:
+        headers = {'Range': 'bytes=%d-%s' % (start, end if end is not None else '')}
+    with Transfer(session) as transfer:
+        r = session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        transfer.answer(r)
+        r.raise_for_status()
+        transfer.data(r.content)
+    if r.status_code != 206:
+        raise ValueError("the server does not answer Range requests for {}".format(url))
+    total = r.headers.get('Content-Range', '*/').split('/')[-1]
+    return r.content, int(total) if total.isdigit() else None
+
+
+def downloadFile(session, url, fileName, max_retries=10, verifier=None, expected=None, extra=0):
+    """ downloads url to fileName, resuming from fileName.part after a failure
+
+    The file is only renamed to fileName once its size matches Content-Length
+    If given, verifier.update() receives all the bytes of the file as they are
+    written (see peps_manifest.StreamVerifier). After a resume, the bytes already
+    in the part file are read again once to feed it.
+    The download only starts once the disk space of the session admits its
+    Content-Length, or expected bytes if the server does not give it, plus the
+    extra bytes written in the same directory by the verifier (an extraction). The part
+    file is not preallocated: its size is the number of bytes received, from
+    which the download is resumed. The bytes are written by the Writer of the session.
+    """
+    partName = fileName + ".part"
+    writer = getattr(session, "writer", None) or Writer()
+    space = getattr(session, "disk_space", None)
+    directory = os.path.dirname(os.path.abspath(fileName))
+    reservation = None
+    # bytes the download is waiting for, outside of any request
+    waiting = None
+    try:
+        for attempt in range(max_retries):
+            if waiting is not None:
+                reservation = space.admit(directory, waiting)
+                waiting = None
+            offset = 0
+            if os.path.isfile(partName):
+                offset = os.path.getsize(partName)
+            headers = {}
+            if offset > 0:
+                headers['Range'] = 'bytes=%d-' % offset
+            try:
+                with Transfer(session) as transfer:
+                    r = session.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+                    transfer.answer(r)
+                    if r.status_code == 416:
+                        # nothing left to send: the part file may already be complete
+                        total = r.headers.get('Content-Range', '*/').split('/')[-1]
+                        r.close()
+                        if total.isdigit() and int(total) == offset and verifier is not None:
+                            # the size alone does not prove that the part file is complete:
+                            # the verifier, checked by the caller, reads it again
+                            feed_verifier(verifier, partName)
+                            os.rename(partName, fileName)
+                            return offset
+                        os.remove(partName)
+                        continue
+                    if r.status_code >= 400:
+                        # the connection of a streamed answer is only given back once closed
+                        r.close()
+                        r.raise_for_status()
+                    if r.status_code == 206:
+                        total = r.headers.get('Content-Range', '*/').split('/')[-1]
+                        total = int(total) if total.isdigit() else None
+                    else:
+                        # server ignored the Range header, start again from byte zero
+                        offset = 0
+                        total = r.headers.get('Content-Length')
+                        total = int(total) if total is not None else None
+                    if space is not None and reservation is None:
+                        needed = max(0, (total if total is not None else expected or 0) - offset) + extra
+                        try:
+                            reservation = space.admit(directory, needed, block=False)
+                        except IOError:
+                            r.close()
+                            raise
+                        if reservation is None:
+                            # the connection is not kept open while waiting for space
+                            r.close()
+                            waiting = needed
+                            continue
+                    if verifier is not None:
+                        if offset > 0:
+                            feed_verifier(verifier, partName)
+                        else:
+                            verifier.reset()
+                    with open(partName, 'r+b' if offset > 0 else 'wb') as f:
+                        f.seek(offset)
+                        try:
+                            writer.copy(r, f, transfer, verifier)
+                        finally:
+                            # the part file of an interrupted download only keeps the bytes received
+                            f.truncate()
+            except (requests.exceptions.RequestException, TransferError, IOError) as e:
+                # reading r.raw raises the urllib3 errors (broken connection, read timeout) as they are
+                if getattr(e, "errno", None) == errno.ENOSPC and space is not None:
+                    # the volume was filled by others: wait for space again, at the next attempt
+                    if reservation is not None:
+                        reservation.release()
+                        reservation = None
+                    print("{}: volume full, waiting for space".format(os.path.basename(fileName)))
+                    continue
+                if not is_congestion(e):
+                    raise
+                print("download of {} interrupted ({}), retrying".format(os.path.basename(fileName), e))
+                peps_metrics.count("peps_retries_total", kind="download")
+                time.sleep(retry_delay(e, attempt))
+                continue
+            size = os.path.getsize(partName)
+            if total is None or size == total:
+                os.rename(partName, fileName)
+                return size
+            print("{}: got {:d} of {:d} bytes, resuming".format(os.path.basename(fileName), size, total))
+            peps_metrics.count("peps_retries_total", kind="download")
+        raise IOError("could not download {} after {:d} attempts".format(url, max_retries))
+    finally:
+        if reservation is not None:
+            reservation.release()
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+State of the processings submitted to PEPS.
+For each job, a SQLite database records its WPS id, its status url, the last
+status and progress known, the urls of its results and the download state of
+each of them, so that a new run knows what is left to do without reading the
+log files again, nor asking PEPS about the jobs already downloaded.
+"""
+import os.path
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+import peps_http
+import peps_metrics
+
+STATE_NAME = "peps_jobs.db"
+# directory of the last status answers, next to the store
+CACHE_NAME = "peps_http_cache"
+# status of a job which will not change anymore
+FINAL_STATUS = ("FINISHED", "ERROR", "CANCELED")
+# download state of a result
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+FAILED = "failed"
+NOVALD = "novald"
+
+JobState = namedtuple("JobState", "name wps_id status_url status progress message updated since")
+
+###########################################################################
+
+
+def state_file(logName):
+    """ the state of the jobs is kept next to their log files """
+    return os.path.join(os.path.dirname(logName), STATE_NAME)
+
+
+def job_name(fileName):
+    """ name of the job of a log or json report file """
+    return os.path.splitext(os.path.basename(fileName))[0]
+
+
+class JobStore(object):
+    """ SQLite database of the jobs and of the download state of their results """
+
+    def __init__(self, fileName):
+        self.lock = threading.Lock()
+        self.cache = peps_http.ResponseCache(os.path.join(os.path.dirname(fileName), CACHE_NAME))
+        # several scripts may follow the same jobs
+        self.db = sqlite3.connect(fileName, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                            "name TEXT PRIMARY KEY, wps_id TEXT, status_url TEXT, status TEXT, "
+                            "progress TEXT, message TEXT, updated REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            # time of the last change of status, added after the first version of the store
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+            if "since" not in columns:
+                self.db.execute("ALTER TABLE jobs ADD COLUMN since REAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                            "job TEXT, name TEXT, url TEXT, state TEXT, size INTEGER, "
+                            "PRIMARY KEY (job, name))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_state ON files (state, job)")
+
+    def close(self):
+        self.db.close()
+
+    def job(self, name):
+        """ returns the JobState of a job, or None if it is unknown """
+        with self.lock:
+            row = self.db.execute("SELECT name, wps_id, status_url, status, progress, message, updated, since "
+                                  "FROM jobs WHERE name = ?", (name,)).fetchone()
+        return JobState(*row) if row is not None else None
+
+    def record_launch(self, name, wps_id, status_url):
+        """ records a job accepted by PEPS """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO jobs (name, wps_id, status_url, status, updated, since) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", (name, wps_id, status_url, "SUBMITTED", now, now))
+            self.db.execute("DELETE FROM files WHERE job = ?", (name,))
+
+    def record_location(self, name, wps_id, status_url):
+        """ records the WPS id and the status url of a job submitted before the store existed """
+        with self.lock, self.db:
+            updated = self.db.execute("UPDATE jobs SET wps_id = ?, status_url = ? WHERE name = ?",
+                                      (wps_id, status_url, name))
+            if updated.rowcount == 0:
+                self.db.execute("INSERT INTO jobs (name, wps_id, status_url, updated) VALUES (?, ?, ?, ?)",
+                                (name, wps_id, status_url, time.time()))
+
+    def record_status(self, name, status, progress=None, message=None, results=()):
+        """
+        Records the last status of a job, and the urls of its results, which are
+        added as pending downloads, NOVALD products being marked as not available
+        """
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute("SELECT status, since, updated FROM jobs WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] is not None and row[0] != status:
+                # time spent in the former status, known since the store noticed it
+                peps_metrics.count("peps_job_transitions_total", **{"from": row[0], "to": status})
+                peps_metrics.observe("peps_job_state_seconds", now - (row[1] or row[2] or now), status=row[0])
+            since = (row[1] or row[2]) if row is not None and row[0] == status else now
+            updated = self.db.execute("UPDATE jobs SET status = ?, progress = ?, message = ?, updated = ?, since = ? "
+                                      "WHERE name = ?", (status, progress, message, now, since, name))
+            if updated.rowcount == 0:
+                self.db.execute("INSERT INTO jobs (name, status, progress, message, updated, since) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", (name, status, progress, message, now, now))
+            for url in results:
+                fileName = url.split('/')[-1]
+                state = NOVALD if fileName.find('NOVALD') >= 0 else PENDING
+                self.db.execute("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, NULL)",
+                                (name, fileName, url, state))
+
+    def record_file(self, name, fileName, state, size=None):
+        """ records the download state of a result of a job """
+        with self.lock, self.db:
+            self.db.execute("UPDATE files SET state = ?, size = ? WHERE job = ? AND name = ?",
+                            (state, size, name, fileName))
+
+    def files(self, name, states=None):
+        """ returns the (name, url, state) of the results of a job, optionally only those in states """
+        query = "SELECT name, url, state FROM files WHERE job = ?"
+        params = [name]
+        if states is not None:
+            query += " AND state IN ({})".format(", ".join("?" * len(states)))
+            params.extend(states)
+        with self.lock:
+            return self.db.execute(query + " ORDER BY name", params).fetchall()
+
+    def is_complete(self, name, manifest=None, include=None, stitch=False):
+        """
+        Tells if a job is over and all its available results are downloaded
+        :param manifest: peps_manifest.Manifest of the download directory; the results recorded as
+                         downloaded must be in it, with the files matching include, or else they
+                         are pending again (other directory, products deleted)
+        :param stitch: the job is a window of a period downloaded to the same directory,
+                       see peps_manifest.Manifest.contains
+        """
+        job = self.job(name)
+        if job is None or job.status not in FINAL_STATUS:
+            return False
+        # the results of a finished job are recorded with its status
+        if len(self.files(name, (PENDING, FAILED))) > 0:
+            return False
+        if manifest is not None:
+            missing = [fileName for (fileName, url, state) in self.files(name, (DOWNLOADED,))
+                       if not manifest.contains(fileName, include, stitch)]
+            for fileName in missing:
+                self.record_file(name, fileName, PENDING)
+            return len(missing) == 0
+        return True
+
+    def unfinished_jobs(self):
+        """ names of the jobs still processed by PEPS, or with results left to download """
+        with self.lock:
+            rows = self.db.execute("SELECT name FROM jobs WHERE status IS NULL OR status NOT IN (?, ?, ?) "
+                                   "UNION SELECT job FROM files WHERE state IN (?, ?) ORDER BY 1",
+                                   FINAL_STATUS + (PENDING, FAILED)).fetchall()
+        return [row[0] for row in rows]
@@ -8,6 +8,12 @@ import os
 import os.path
 import optparse
 import sys
+import peps_http
+import peps_jobs
+import peps_manifest
+import peps_metrics
+import peps_schedule
+import peps_wps
 
 
 ###########################################################################
@@ -22,157 +28,186 @@ class OptionParser (optparse.OptionParser):
         if getattr(self.values, option.dest) is None:
             self.error("%s option not supplied" % option)
 
-
-###########################################################################
-def parse_launch_feedback(log_prod):
-    """ Gets processing Id """
-    with open(log_prod) as ftmp:
-        for ligne in ftmp.readlines():
-            if ligne.find("statusLocation") > 0:
-                status_url = ligne.split("statusLocation")[1].split('"')[1]
-                wpsId = status_url.split("pywps-")[1].split(".xml")[0]
-    return status_url, wpsId
-
 ###########################################################################
 
-
-def parse_update(update_prod):
-    """ Gets update """
-    with open(update_prod) as ftmp:
-        for ligne in ftmp.readlines():
-            if ligne.find("wps:Reference") > 0:
-                json_url = ligne.split("href")[1].split('"')[1]
-        if json_url is not None:
-            return json_url
-        else:
-            print("%s only contains :" % update_prod)
-            print(ftmp.readlines())
-
-###########################################################################
-
-
-def parse_status(stat_prod):
-    """ checks if processing is completed """
-    status = "computing"
-    download_url = None
-    L2A_name = None
-    percent = 0
-    with open(stat_prod) as ftmp:
-        for ligne in ftmp.readlines():
-            if ligne.find("percentCompleted") > 0:
-                percent = int(ligne.split(":")[1].split(",")[0])
-            if ligne.find("FINISHED") > 0:
-                status = "finished"
-            if ligne.find("CANCELED") > 0:
-                status = "canceled"
-            if ligne.find("zip") >= 0 and status == "finished":
-                print ligne
-                download_url = ligne.split('"')[1]
-                L2A_name = download_url.split('/')[-1]
-    return percent, status, download_url, L2A_name
-
-
-# ===================== MAIN
-# ==================
-# parse command line
-# ==================
-if len(sys.argv) == 1:
-    prog = os.path.basename(sys.argv[0])
-    print('      ' + sys.argv[0] + ' [options]')
-    print("     Aide : ", prog, " --help")
-    print("        ou : ", prog, " -h")
-    print("example : python %s -p prod_list.txt -a peps.txt -w /mnt/data/MAJA_PEPS" % sys.argv[0])
-
-    sys.exit(-1)
-else:
-    usage = "usage: %prog [options] "
-    parser = OptionParser(usage=usage)
-
-    parser.add_option("-p", "--prod_list", dest="prod_list", action="store", type="string",
-                      help="file which contains the list of products to download", default=None)
-    parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
-                      help="Path where the products should be downloaded", default='.')
-    parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
-                      help="Peps account and password file")
-
-    (options, args) = parser.parse_args()
-    parser.check_required("-p")
-    parser.check_required("-a")
-
-    if options.write_dir is None:
-        options.write_dir = os.getcwd()
-
-
-# ====================
-# read authentification file
-# ====================
-try:
-    f = open(options.auth)
-    (email, passwd) = f.readline().split(' ')
-    if passwd.endswith('\n'):
-        passwd = passwd[:-1]
-    f.close()
-except IOError:
-    print("error with password file")
-    sys.exit(-2)
-
-# ====================
-# read product list
-# =====================
-
-try:
-    with open(options.prod_list) as f:
-        lignes = f.readlines()
-except IOError:
-    print("error with product list file")
-    sys.exit(-2)
-
-prod_list = []
-for ligne in lignes:
-    prod_list.append(ligne.strip())
-
-# check processing completion and download
-for prod in prod_list:
-    # get status file
-    log_prod = os.path.join(options.write_dir, str(prod + '.log'))
-    status_url, wpsId = parse_launch_feedback(log_prod)
+# status of the json report -> status of the job in the store
+job_status = {"finished": "FINISHED", "canceled": "CANCELED", "computing": "STALLED"}
+
+
+def check_product(session, prod, write_dir, manifest, store, expected=None):
+    """
+    Checks the MAJA processing of a L1C product submitted with peps_maja_process.py,
+    and downloads its L2A product to write_dir if it is finished
+    :param manifest: peps_manifest.Manifest of write_dir
+    :param store: peps_jobs.JobStore of write_dir
+    :param expected: estimated size of the L2A product (size of the L1C in the catalog),
+                     for the disk space admission if the server does not give it
+    :return: status of the job (STALLED, FINISHED or CANCELED), or None if it is not available
+    """
+    # a product known to be processed and downloaded does not need any request
+    if store.is_complete(prod, manifest):
+        print("\n #### %s already downloaded #### \n" % prod)
+        return store.job(prod).status
+    job = store.job(prod)
+    if job is not None and job.status_url is not None:
+        status_url, wpsId = job.status_url, job.wps_id
+    else:
+        # get status file
+        log_prod = os.path.join(write_dir, str(prod + '.log'))
+        launch = peps_wps.parse_wps_file(log_prod, ("wps_id", "status_location"))
+        status_url, wpsId = launch.status_location, launch.wps_id
     print("wpsId: ", wpsId)
 
     # -- Charlotte add
-    update_prod = os.path.join(options.write_dir, str('update_' + prod + '.txt'))
-    update_status = 'curl -o %s -k -u  "%s:%s" %s' % (
-        update_prod, email, passwd, status_url)
-    print(update_status)
-    os.system(update_status)
-
-    json_url = parse_update(update_prod)
-    stat_prod = os.path.join(options.write_dir, str(prod + '.stat'))
-    get_status = 'curl -o %s -k -u  "%s:%s" %s' % (
-        stat_prod, email, passwd, json_url)
-    print(get_status)
-    os.system(get_status)
-    (percent, status, download_url, L2A_name) = parse_status(stat_prod)
-
-    # ~ stat_prod = os.path.join(options.write_dir, str(prod + '.stat'))
+    print("updating status: %s" % status_url)
+    with peps_metrics.stage("poll"):
+        with peps_http.Transfer(session, "status") as transfer:
+            req = session.get(status_url)
+            transfer.answer(req)
+            transfer.data(req.content)
+        update = req.content
+        json_url = peps_wps.parse_wps(update, ("references",)).json_url
+        if json_url is None:
+            print("WPS status only contains :")
+            print(update)
+            return None
+        print("getting status: %s" % json_url)
+        try:
+            stat, modified = peps_http.getConditional(session, json_url, store.cache)
+        except IOError as e:
+            print(e)
+            return None
+    if not modified and job is not None and job.status is not None and job.status not in peps_jobs.FINAL_STATUS:
+        # same report as at the last run, the processing is still going on
+        print("\n #### processing of %s not completed #### \n" % prod)
+        print("percentage processed : %s" % job.progress)
+        return job.status
+
+    # ~ stat_prod = os.path.join(write_dir, str(prod + '.stat'))
     # ~ get_status = 'curl -o %s -k -u  "%s:%s" "https://peps.cnes.fr/resto/wps?service=WPS&request=execute&version=1.0.0&identifier=PROCESSING_STATUS&datainputs=\[wps_id=%s\]"' % (
     # ~ stat_prod, email, passwd, wpsId)
     # ~ print(get_status)
     #~ os.system(get_status)
 
     # Check status
-    (percent, status, download_url, L2A_name) = parse_status(stat_prod)
-    if status == "finished" and not(os.path.exists("%s/%s" % (options.write_dir, L2A_name))):
-        get_product = 'curl -o %s.tmp -k -u  "%s:%s" "%s"' % (prod, email, passwd, download_url)
-        print get_product
-        os.system(get_product)
-        os.rename("%s.tmp" % prod, "%s/%s" % (options.write_dir, L2A_name))
-        print("\n #### completed download of %s/%s #### \n" % (options.write_dir, L2A_name))
+    try:
+        (percent, status, download_url, L2A_name) = peps_wps.parse_maja_status(stat)
+    except ValueError as e:
+        print("status report of %s is not readable: %s" % (prod, e))
+        return None
+    store.record_status(prod, job_status[status], percent, results=[download_url] if download_url else [])
+    if status == "finished" and not manifest.check("%s/%s" % (write_dir, L2A_name)):
+        print("downloading %s" % download_url)
+        try:
+            with peps_metrics.stage("download"):
+                size = peps_manifest.download_verified(session, download_url,
+                                                       "%s/%s" % (write_dir, L2A_name), manifest, expected)
+        except IOError as e:
+            print("\n #### download of %s failed: %s #### \n" % (L2A_name, e))
+            peps_metrics.count("peps_downloads_total", result="failed")
+            store.record_file(prod, L2A_name, peps_jobs.FAILED)
+            return job_status[status]
+        peps_metrics.count("peps_downloads_total", result="completed")
+        store.record_file(prod, L2A_name, peps_jobs.DOWNLOADED, size)
+        print("\n #### completed download of %s/%s #### \n" % (write_dir, L2A_name))
     elif status == "canceled":
         print("\n #### processing was canceled #### ")
         print("can happen outside |lat|<60 for lack of SRTM DEM\n")
     else:
-        if os.path.exists("%s/%s" % (options.write_dir, L2A_name)):
-            print ("\n #### %s already downloaded #### \n" % prod)
+        if manifest.check("%s/%s" % (write_dir, L2A_name)):
+            print("\n #### %s already downloaded #### \n" % prod)
+            store.record_file(prod, L2A_name, peps_jobs.DOWNLOADED)
         else:
             print("\n #### processing of %s not completed #### \n" % prod)
             print("percentage processed : %s" % percent)
+    return job_status[status]
+
+
+# ===================== MAIN
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example : python %s -p prod_list.txt -a peps.txt -w /mnt/data/MAJA_PEPS" % sys.argv[0])
+
+        sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-p", "--prod_list", dest="prod_list", action="store", type="string",
+                          help="file which contains the list of products to download", default=None)
+        parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
+                          help="Path where the products should be downloaded", default='.')
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("--max_rate", dest="max_rate", action="store", type="float",
+                          help="maximum download throughput, in MB/s", default=None)
+        parser.add_option("--reserve", dest="reserve", action="store", type="float",
+                          help="GB kept free on the output volume, the downloads wait for space beyond it",
+                          default=peps_http.DISK_RESERVE / 1e9)
+        parser.add_option("--order", dest="order", action="store", type="string",
+                          help="order of the downloads, comma separated among oldest, smallest and online "
+                          "(disk before tape)", default=peps_schedule.DEFAULT_POLICY)
+        parser.add_option("--rescan", dest="rescan", action="store_true",
+                          help="update the index of the products of write_dir from its content", default=False)
+        parser.add_option("--metrics", dest="metrics", action="store", type="string",
+                          help="file where the metrics of the run are written: Prometheus textfile if "
+                          "its name ends with .prom, else JSON lines", default=None)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-p")
+        parser.check_required("-a")
+        peps_metrics.enable(options.metrics)
+        try:
+            peps_schedule.parse_policy(options.order)
+        except ValueError as e:
+            parser.error(str(e))
+
+        if options.write_dir is None:
+            options.write_dir = os.getcwd()
+
+    # ====================
+    # read authentification file
+    # ====================
+    try:
+        f = open(options.auth)
+        (email, passwd) = f.readline().split(' ')
+        if passwd.endswith('\n'):
+            passwd = passwd[:-1]
+        f.close()
+    except IOError:
+        print("error with password file")
+        sys.exit(-2)
+
+    # ====================
+    # read product list
+    # =====================
+
+    try:
+        prod_list, storage_dict, size_dict = peps_schedule.read_list(options.prod_list)
+    except IOError:
+        print("error with product list file")
+        sys.exit(-2)
+    prod_list = peps_schedule.sort_products(prod_list, options.order, storage_dict, size_dict)
+
+    session = peps_http.get_session(email, passwd, max_rate=options.max_rate,
+                                    reserve=int(options.reserve * 1e9))
+    manifest = peps_manifest.Manifest(options.write_dir)
+    if options.rescan:
+        (added, removed) = manifest.scan()
+        print("{}: {:d} products added to the index, {:d} removed".format(options.write_dir, added, removed))
+    store = peps_jobs.JobStore(os.path.join(options.write_dir, peps_jobs.STATE_NAME))
+
+    # check processing completion and download
+    for prod in prod_list:
+        check_product(session, prod, options.write_dir, manifest, store, size_dict.get(prod))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,12 +8,22 @@ Submits a L2A processing with MAJA to PEPS.
 - Before starting production, please use -n option to check the products retrieved
 """
 import json
-import time
 import os
 import os.path
 import optparse
 import sys
 from datetime import date
+import peps_http
+import peps_catalog
+import peps_jobs
+import peps_metrics
+import peps_schedule
+import peps_wps
+
+try:
+    input = raw_input
+except NameError:
+    pass
 
 ###########################################################################
 
@@ -30,14 +40,13 @@ class OptionParser (optparse.OptionParser):
 ###########################################################################
 
 
-def parse_prod(log_prod):
-    """ checks production status """
+def parse_prod(feedback, log_prod):
+    """ checks production status from the WPS answer saved in log_prod """
     status = True
-    with open(log_prod) as data_file:
-        try:
-            data = json.load(data_file)
-        except ValueError:
-            return status
+    try:
+        data = json.loads(feedback)
+    except ValueError:
+        return status
     if 'ErrorCode' in data:
         print(">>>> unable to start processing %s " % log_prod)
         if data['ErrorMessage'] == 'Unauthorized':
@@ -48,243 +57,298 @@ def parse_prod(log_prod):
     return status
 
 
-def parse_catalog(search_json_file):
-    """ parses the results of catalog request"""
-    # Filter catalog result
-    with open(search_json_file) as data_file:
-        data = json.load(data_file)
-
-    if 'ErrorCode' in data:
-        print(data['ErrorMessage'])
-        sys.exit(-2)
+def search_products(session, queries, orbit=None, search_json_file='search.json', catalog=None, jobs=4):
+    """
+    Searches the L1C products to process
+    :param session: session returned by peps_http.get_session
+    :param queries: catalog search parameters, see peps_catalog.search_features, or a list of them
+                    whose results are merged (see peps_catalog.search_many)
+    :param orbit: if given, only the products of this relative orbit are kept
+    :param search_json_file: file where the features found are saved
+    :param catalog: peps_catalog.CatalogCache answering the search when possible
+    :param jobs: number of searches made in parallel
+    :return: same as peps_catalog.parse_catalog, IOError being raised if the search fails
+    """
+    if isinstance(queries, dict):
+        queries = [queries]
+    # the pages of results are parsed as they arrive, and saved to search_json_file
+    with peps_metrics.stage("search"):
+        if len(queries) > 1:
+            features = peps_catalog.search_many(session, queries, jobs, catalog=catalog)
+        elif catalog is not None:
+            features = catalog.search_features(session, queries[0])
+        else:
+            features = peps_catalog.search_features(session, queries[0])
+        features = peps_catalog.save_features(features, search_json_file)
+        return peps_catalog.parse_catalog(peps_catalog.iter_records(features), orbit)
+
+
+def submit_product(session, prod, write_dir, store=None):
+    """
+    Submits the MAJA processing of a L1C product, whose WPS answer is written to
+    write_dir/prod.log, as needed by peps_maja_download.py
+    :param store: peps_jobs.JobStore where the job is recorded, by default the one of write_dir
+    :return: True if the processing was accepted
+    """
+    log_prod = os.path.join(write_dir, str(prod + '.log'))
+    start_maja = "https://peps.cnes.fr/resto/wps?service=WPS&request=execute&version=1.0.0&identifier=MAJA&datainputs=product=%s&storeExecuteResponse=true&status=true&title=Maja-Process" % prod
+    print("*** submission of maja processing of %s ***" % prod)
+    print(start_maja)
+    with peps_metrics.stage("submit"), peps_http.Transfer(session, "submit") as transfer:
+        req = session.get(start_maja)
+        transfer.answer(req)
+        transfer.data(req.content)
+    # the log is needed by peps_maja_download.py to follow the processing
+    with open(log_prod, 'wb') as f:
+        f.write(req.content)
+    # check process was correctly launched
+    prod_ok = parse_prod(req.text, log_prod)
+    peps_metrics.count("peps_submissions_total", process="MAJA", result="accepted" if prod_ok else "rejected")
+    if prod_ok:
+        launch = peps_wps.parse_wps(req.content, ("wps_id", "status_location"))
+        if store is None:
+            store = peps_jobs.JobStore(os.path.join(write_dir, peps_jobs.STATE_NAME))
+        store.record_launch(prod, launch.wps_id, launch.status_location)
+    return prod_ok
 
-    # Sort data
-    download_dict = {}
-    storage_dict = {}
-    size_dict = {}
-    if len(data["features"]) > 0:
-        for i in range(len(data["features"])):
-            prod = data["features"][i]["properties"]["productIdentifier"]
-            print(prod, data["features"][i]["properties"]["storage"]["mode"])
-            feature_id = data["features"][i]["id"]
-            try:
-                storage = data["features"][i]["properties"]["storage"]["mode"]
-                platform = data["features"][i]["properties"]["platform"]
-                resourceSize = data["features"][i]["properties"]["resourceSize"]
-                # recup du numero d'orbite
-                orbitN = data["features"][i]["properties"]["orbitNumber"]
-                if platform == 'S1A':
-                    # calcul de l'orbite relative pour Sentinel 1A
-                    relativeOrbit = ((orbitN - 73) % 175) + 1
-                elif platform == 'S1B':
-                    # calcul de l'orbite relative pour Sentinel 1B
-                    relativeOrbit = ((orbitN - 27) % 175) + 1
-
-                if options.orbit is not None:
-                    if prod.find("_R%03d" % options.orbit) > 0:
-                        download_dict[prod] = feature_id
-                        storage_dict[prod] = storage
-                        size_dict[prod] = resourceSize
 
-                else:
-                    download_dict[prod] = feature_id
-                    storage_dict[prod] = storage
-                    size_dict[prod] = resourceSize
-            except:
-                pass
-    else:
-        print(">>> no product corresponds to selection criteria")
+# ===================== MAIN
+def main():
+    # ==================
+    # parse command line
+    # ==================
+    if len(sys.argv) == 1:
+        prog = os.path.basename(sys.argv[0])
+        print('      ' + sys.argv[0] + ' [options]')
+        print("     Aide : ", prog, " --help")
+        print("        ou : ", prog, " -h")
+        print("example 1 : python %s -l Toulouse -a peps.txt -d 2016-12-06 -f 2017-02-01 -p maja_products.txt -w /mnt/data/MAJA" %
+              sys.argv[0])
+        print("example 2 : python %s --lon 1 --lat 44 -a peps.txt -d 2016-12-06 -f 2017-02-01  -p maja_products.txt" %
+              sys.argv[0])
+        print("example 3 : python %s --lonmin 1 --lonmax 2 --latmin 43 --latmax 44 -a peps.txt -d 2016-12-06 -f 2017-02-01 -p maja_products.txt" %
+              sys.argv[0])
+        print("example 4 : python %s -t 31TFJ -a peps.txt -d 2016-12-06 -f 2017-02-01  -p maja_products.txt" %
+              sys.argv[0])
         sys.exit(-1)
+    else:
+        usage = "usage: %prog [options] "
+        parser = OptionParser(usage=usage)
+
+        parser.add_option("-l", "--location", dest="location", action="store", type="string",
+                          help="town name (pick one which is not too frequent to avoid confusions)", default=None)
+        parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
+                          help="Peps account and password file")
+        parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
+                          help="Path where the products should be downloaded", default='.')
+        parser.add_option("-n", "--no_download", dest="no_download", action="store_true",
+                          help="Do not download products, just print curl command", default=False)
+        parser.add_option("-d", "--start_date", dest="start_date", action="store", type="string",
+                          help="start date, fmt('2015-12-22')", default=None)
+        parser.add_option("-t", "--tile", dest="tile", action="store", type="string",
+                          help="Sentinel-2 tile number", default=None)
+        parser.add_option("--tiles", dest="tiles", action="store", type="string",
+                          help="comma separated Sentinel-2 tile numbers, or file with one tile per line", default=None)
+        parser.add_option("--lat", dest="lat", action="store", type="float",
+                          help="latitude in decimal degrees", default=None)
+        parser.add_option("--lon", dest="lon", action="store", type="float",
+                          help="longitude in decimal degrees", default=None)
+        parser.add_option("--latmin", dest="latmin", action="store", type="float",
+                          help="min latitude in decimal degrees", default=None)
+        parser.add_option("--latmax", dest="latmax", action="store", type="float",
+                          help="max latitude in decimal degrees", default=None)
+        parser.add_option("--lonmin", dest="lonmin", action="store", type="float",
+                          help="min longitude in decimal degrees", default=None)
+        parser.add_option("--lonmax", dest="lonmax", action="store", type="float",
+                          help="max longitude in decimal degrees", default=None)
+        parser.add_option("--box_step", dest="box_step", action="store", type="float",
+                          help="split the rectangle into boxes of at most this size in degrees, searched in parallel",
+                          default=None)
+        parser.add_option("-o", "--orbit", dest="orbit", action="store", type="int",
+                          help="Orbit Path number", default=None)
+        parser.add_option("-f", "--end_date", dest="end_date", action="store", type="string",
+                          help="end date, fmt('2015-12-23')", default='9999-01-01')
+        parser.add_option("-p", "--prod_list", dest="prod_list", action="store", type="string",
+                          help="file which contains the list of products to download", default=None)
+
+        parser.add_option("--json", dest="search_json_file", action="store", type="string",
+                          help="Output search JSON filename", default=None)
+        parser.add_option("--cache", dest="cache", action="store", type="string",
+                          help="SQLite file caching the catalog searches, only new acquisitions are asked to PEPS",
+                          default=None)
+        parser.add_option("--date_windows", dest="date_windows", action="store", type="int",
+                          help="split the period into windows of this number of days, searched in parallel",
+                          default=None)
+        parser.add_option("--search_jobs", dest="search_jobs", action="store", type="int",
+                          help="number of catalog searches made in parallel", default=4)
+        parser.add_option("--order", dest="order", action="store", type="string",
+                          help="order of submission, comma separated among oldest, smallest and online "
+                          "(disk before tape)", default=peps_schedule.DEFAULT_POLICY)
+        parser.add_option("--windows", dest="windows", action="store_true",
+                          help="For windows usage (no longer needed, kept for compatibility)", default=False)
+        parser.add_option("--metrics", dest="metrics", action="store", type="string",
+                          help="file where the metrics of the run are written: Prometheus textfile if "
+                          "its name ends with .prom, else JSON lines", default=None)
+
+        (options, args) = parser.parse_args()
+        parser.check_required("-a")
+        parser.check_required("-p")
+        peps_metrics.enable(options.metrics)
+        try:
+            peps_schedule.parse_policy(options.order)
+        except ValueError as e:
+            parser.error(str(e))
 
-    return(prod, download_dict, storage_dict, size_dict)
+    if options.search_json_file is None or options.search_json_file == "":
+        options.search_json_file = 'search.json'
 
+    if not(os.path.exists(options.write_dir)):
+        print("The output directory %s does not exist" % options.write_dir)
+        sys.exit(-1)
 
-# ===================== MAIN
-# ==================
-# parse command line
-# ==================
-if len(sys.argv) == 1:
-    prog = os.path.basename(sys.argv[0])
-    print('      ' + sys.argv[0] + ' [options]')
-    print("     Aide : ", prog, " --help")
-    print("        ou : ", prog, " -h")
-    print("example 1 : python %s -l Toulouse -a peps.txt -d 2016-12-06 -f 2017-02-01 -p maja_products.txt -w /mnt/data/MAJA" %
-          sys.argv[0])
-    print("example 2 : python %s --lon 1 --lat 44 -a peps.txt -d 2016-12-06 -f 2017-02-01  -p maja_products.txt" %
-          sys.argv[0])
-    print("example 3 : python %s --lonmin 1 --lonmax 2 --latmin 43 --latmax 44 -a peps.txt -d 2016-12-06 -f 2017-02-01 -p maja_products.txt" %
-          sys.argv[0])
-    print("example 4 : python %s -t 31TFJ -a peps.txt -d 2016-12-06 -f 2017-02-01  -p maja_products.txt" %
-          sys.argv[0])
-    sys.exit(-1)
-else:
-    usage = "usage: %prog [options] "
-    parser = OptionParser(usage=usage)
-
-    parser.add_option("-l", "--location", dest="location", action="store", type="string",
-                      help="town name (pick one which is not too frequent to avoid confusions)", default=None)
-    parser.add_option("-a", "--auth", dest="auth", action="store", type="string",
-                      help="Peps account and password file")
-    parser.add_option("-w", "--write_dir", dest="write_dir", action="store", type="string",
-                      help="Path where the products should be downloaded", default='.')
-    parser.add_option("-n", "--no_download", dest="no_download", action="store_true",
-                      help="Do not download products, just print curl command", default=False)
-    parser.add_option("-d", "--start_date", dest="start_date", action="store", type="string",
-                      help="start date, fmt('2015-12-22')", default=None)
-    parser.add_option("-t", "--tile", dest="tile", action="store", type="string",
-                      help="Sentinel-2 tile number", default=None)
-    parser.add_option("--lat", dest="lat", action="store", type="float",
-                      help="latitude in decimal degrees", default=None)
-    parser.add_option("--lon", dest="lon", action="store", type="float",
-                      help="longitude in decimal degrees", default=None)
-    parser.add_option("--latmin", dest="latmin", action="store", type="float",
-                      help="min latitude in decimal degrees", default=None)
-    parser.add_option("--latmax", dest="latmax", action="store", type="float",
-                      help="max latitude in decimal degrees", default=None)
-    parser.add_option("--lonmin", dest="lonmin", action="store", type="float",
-                      help="min longitude in decimal degrees", default=None)
-    parser.add_option("--lonmax", dest="lonmax", action="store", type="float",
-                      help="max longitude in decimal degrees", default=None)
-    parser.add_option("-o", "--orbit", dest="orbit", action="store", type="int",
-                      help="Orbit Path number", default=None)
-    parser.add_option("-f", "--end_date", dest="end_date", action="store", type="string",
-                      help="end date, fmt('2015-12-23')", default='9999-01-01')
-    parser.add_option("-p", "--prod_list", dest="prod_list", action="store", type="string",
-                      help="file which contains the list of products to download", default=None)
-
-    parser.add_option("--json", dest="search_json_file", action="store", type="string",
-                      help="Output search JSON filename", default=None)
-    parser.add_option("--windows", dest="windows", action="store_true",
-                      help="For windows usage", default=False)
-
-    (options, args) = parser.parse_args()
-    parser.check_required("-a")
-    parser.check_required("-p")
-
-if options.search_json_file is None or options.search_json_file == "":
-    options.search_json_file = 'search.json'
-
-if not(os.path.exists(options.write_dir)):
-    print("The output directory %s does not exist" % options.write_dir)
-    sys.exit(-1)
-
-# determine location request
-if options.tile is None:
-    if options.location is None:
-        if options.lat is None or options.lon is None:
-            if (options.latmin is None) or (options.lonmin is None) or (options.latmax is None) or (options.lonmax is None):
-                print("provide at least a point or rectangle")
-                sys.exit(-1)
+    # several tiles may be searched at once
+    tiles = []
+    if options.tiles is not None:
+        if os.path.isfile(options.tiles):
+            with open(options.tiles) as f:
+                tiles = [ligne.strip() for ligne in f.readlines() if ligne.strip() != ""]
+        else:
+            tiles = [tile.strip() for tile in options.tiles.split(",") if tile.strip() != ""]
+    if options.tile is not None:
+        tiles.insert(0, options.tile)
+
+    # determine location request
+    if len(tiles) == 0:
+        if options.location is None:
+            if options.lat is None or options.lon is None:
+                if (options.latmin is None) or (options.lonmin is None) or (options.latmax is None) or (options.lonmax is None):
+                    print("provide at least a point or rectangle")
+                    sys.exit(-1)
+                else:
+                    geom = 'rectangle'
             else:
-                geom = 'rectangle'
+                if (options.latmin is None) and (options.lonmin is None) and (options.latmax is None) and (options.lonmax is None):
+                    geom = 'point'
+                else:
+                    print("please choose between point and rectangle, but not both")
+                    sys.exit(-1)
+
         else:
-            if (options.latmin is None) and (options.lonmin is None) and (options.latmax is None) and (options.lonmax is None):
-                geom = 'point'
+            if (options.latmin is None) and (options.lonmin is None) and (options.latmax is None) and (options.lonmax is None) and (options.lat is None) or (options.lon is None):
+                geom = 'location'
             else:
-                print("please choose between point and rectangle, but not both")
+                print("please choose location and coordinates, but not both")
                 sys.exit(-1)
 
-    else:
-        if (options.latmin is None) and (options.lonmin is None) and (options.latmax is None) and (options.lonmax is None) and (options.lat is None) or (options.lon is None):
-            geom = 'location'
+    # geometric parameters of catalog request
+    if len(tiles) > 0:
+        query_geoms = []
+        for tile in tiles:
+            if tile.startswith('T') and len(tile) == 6:
+                tileid = tile[1:6]
+            elif len(tile) == 5:
+                tileid = tile[0:5]
+            else:
+                print("tile name is ill-formated : 31TCJ or T31TCJ are allowed")
+                sys.exit(-4)
+            query_geoms.append({'tileid': tileid})
+    elif geom == 'point':
+        query_geoms = [{'lat': '%f' % options.lat, 'lon': '%f' % options.lon}]
+    elif geom == 'rectangle':
+        if options.box_step is not None:
+            query_geoms = [{'box': box} for box in peps_catalog.split_box(
+                options.lonmin, options.latmin, options.lonmax, options.latmax, options.box_step)]
         else:
-            print("please choose location and coordinates, but not both")
-            sys.exit(-1)
-
-# geometric parameters of catalog request
-if options.tile is not None:
-    if options.tile.startswith('T') and len(options.tile) == 6:
-        tileid = options.tile[1:6]
-    elif len(options.tile) == 5:
-        tileid = options.tile[0:5]
-    else:
-        print("tile name is ill-formated : 31TCJ or T31TCJ are allowed")
-        sys.exit(-4)
-    query_geom = "tileid=%s" % (tileid)
-elif geom == 'point':
-    query_geom = 'lat=%f\&lon=%f' % (options.lat, options.lon)
-elif geom == 'rectangle':
-    query_geom = 'box={lonmin},{latmin},{lonmax},{latmax}'.format(
-        latmin=options.latmin, latmax=options.latmax, lonmin=options.lonmin, lonmax=options.lonmax)
-elif geom == 'location':
-    query_geom = "q=%s" % options.location
-
-# date parameters of catalog request
-if options.start_date is not None:
-    start_date = options.start_date
-    if options.end_date is not None:
-        end_date = options.end_date
+            query_geoms = [{'box': '{lonmin},{latmin},{lonmax},{latmax}'.format(
+                latmin=options.latmin, latmax=options.latmax, lonmin=options.lonmin, lonmax=options.lonmax)}]
+    elif geom == 'location':
+        query_geoms = [{'q': options.location}]
+
+    # date parameters of catalog request
+    if options.start_date is not None:
+        start_date = options.start_date
+        if options.end_date is not None:
+            end_date = options.end_date
+        else:
+            end_date = date.today().isoformat()
+    if options.date_windows is not None:
+        windows = peps_catalog.split_dates(start_date, min(end_date, date.today().isoformat()),
+                                           options.date_windows)
     else:
-        end_date = date.today().isoformat()
-
-
-# ====================
-# read authentification file
-# ====================
-try:
-    f = open(options.auth)
-    (email, passwd) = f.readline().split(' ')
-    if passwd.endswith('\n'):
-        passwd = passwd[:-1]
-    f.close()
-except:
-    print("error with password file")
-    sys.exit(-2)
-
-
-if os.path.exists(options.search_json_file):
-    os.remove(options.search_json_file)
-
-
-# ====================
-# search in catalog
-# ====================
-
-search_catalog = 'curl -k -u "%s:%s" -o %s https://peps.cnes.fr/resto/api/collections/S2ST/search.json?%s\&startDate=%s\&completionDate=%s\&maxRecords=500\&productType=S2MSI1C' % (
-    email, passwd, options.search_json_file, query_geom, start_date, end_date)
-
-if options.windows:
-    search_catalog = search_catalog.replace('\&', '^&')
-
-print(search_catalog)
-os.system(search_catalog)
-time.sleep(1)
+        windows = [(start_date, end_date)]
+
+    # ====================
+    # read authentification file
+    # ====================
+    try:
+        f = open(options.auth)
+        (email, passwd) = f.readline().split(' ')
+        if passwd.endswith('\n'):
+            passwd = passwd[:-1]
+        f.close()
+    except:
+        print("error with password file")
+        sys.exit(-2)
 
-prod, download_dict, storage_dict, size_dict = parse_catalog(options.search_json_file)
+    if os.path.exists(options.search_json_file):
+        os.remove(options.search_json_file)
+
+
+    # ====================
+    # search in catalog
+    # ====================
+
+    session = peps_http.get_session(email, passwd, jobs=options.search_jobs)
+
+    # one search per tile or box and per date window, whose products are merged
+    queries = []
+    for query_geom in query_geoms:
+        for (window_start, window_end) in windows:
+            query = {'startDate': window_start, 'completionDate': window_end, 'productType': 'S2MSI1C'}
+            query.update(query_geom)
+            queries.append(query)
+    catalog = peps_catalog.CatalogCache(options.cache) if options.cache is not None else None
+    try:
+        prod, download_dict, storage_dict, size_dict = search_products(session, queries, options.orbit,
+                                                                       options.search_json_file, catalog,
+                                                                       options.search_jobs)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(-2)
+    if prod is None:
+        print(">>> no product corresponds to selection criteria")
+        sys.exit(-1)
 
-# =====================
-# Start Maja processing
-# =====================
+    # =====================
+    # Start Maja processing
+    # =====================
 
+    if len(download_dict) == 0:
+        print("No product matches the criteria")
+        sys.exit(-1)
 
-if len(download_dict) == 0:
-    print("No product matches the criteria")
-    sys.exit(-1)
+    products = peps_schedule.sort_products(list(download_dict.keys()), options.order, storage_dict, size_dict)
+    print("\nlist of products retrieved by catalog request")
+    for i, prod in enumerate(products):
+        print(i, prod, storage_dict[prod], size_dict[prod])
 
-print("\nlist of products retrieved by catalog request")
-for i, prod in enumerate(list(download_dict.keys())):
-    print(i, prod)
+    nb_prod = len(download_dict)
+    confirm = "yes"
+    if nb_prod >= 10:
+        confirm = input(
+            "\n## You are about to ask for production of %s products, please confirm (yes/no)\n" % nb_prod)
 
+    if confirm == "yes":
+        if options.write_dir is None:
+            options.write_dir = os.getcwd()
 
-nb_prod = len(download_dict)
-confirm = "yes"
-if nb_prod >= 10:
-    confirm = raw_input(
-        "\n## You are about to ask for production of %s products, please confirm (yes/no)\n" % nb_prod)
+        store = peps_jobs.JobStore(os.path.join(options.write_dir, peps_jobs.STATE_NAME))
+        # the storage and size are kept for the download order of peps_maja_download.py
+        peps_schedule.write_list(options.prod_list, products, storage_dict, size_dict)
+        if (not(options.no_download)):
+            for prod in products:
+                submit_product(session, prod, options.write_dir, store)
 
-if confirm == "yes":
-    if options.write_dir is None:
-        options.write_dir = os.getcwd()
 
-    with open(options.prod_list, "w") as f_out:
-        for prod in list(download_dict.keys()):
-            f_out.write("%s\n" % prod)
-            if (not(options.no_download)):
-                log_prod = os.path.join(options.write_dir, str(prod + '.log'))
-                start_maja = 'curl -o %s -k -u "%s:%s" "https://peps.cnes.fr/resto/wps?service=WPS&request=execute&version=1.0.0&identifier=MAJA&datainputs=product=%s&storeExecuteResponse=true&status=true&title=Maja-Process"' % (
-                    log_prod, email, passwd, prod)
-                print("*** submission of maja processing of %s ***" % prod)
-                print (start_maja)
-                os.system(start_maja)
-                # check process was correctly launched
-                prod_ok = parse_prod(log_prod)
+if __name__ == "__main__":
+    main()
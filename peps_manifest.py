@@ -0,0 +1,325 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Integrity of the downloaded L2A products.
+The checksum and the zip structure are checked while the bytes are downloaded,
+and the results are recorded in a manifest file of the download directory, so
+that the next runs can skip the verified products without reading them again.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import os.path
+import re
+import struct
+import threading
+import time
+import peps_http
+
+MANIFEST_NAME = "peps_manifest.json"
+# folders of the extracted products
+PRODUCT_PATTERN = "*_L2A_*"
+# platform, date and tile of a L2A product, such as SENTINEL2A_20170101-105432-759_L2A_T31TCJ_C_V1-0
+ACQUISITION = re.compile(r"^(SENTINEL2[A-Z])_(\d{8})-[\d-]+_L2A_(T\w{5})_")
+# end of the stream kept in memory to check the zip central directory
+TAIL_SIZE = 1024 * 1024
+# bytes read at a time when verifying a file already on disk
+CHUNK_SIZE = 1024 * 1024
+
+EOCD_SIGNATURE = b"PK\x05\x06"
+EOCD64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+EOCD64_SIGNATURE = b"PK\x06\x06"
+CENTRAL_SIGNATURE = b"PK\x01\x02"
+LOCAL_SIGNATURE = b"PK\x03\x04"
+
+###########################################################################
+
+
+def locate_central_directory(tail, size):
+    """
+    Finds the central directory of a zip file from its last bytes
+    :param tail: last bytes of the file
+    :type tail: bytes
+    :param size: size of the file
+    :type size: int
+    :return: offset, size and number of entries of the central directory
+    :raise ValueError: the end of the file is not the end of a zip file
+    """
+    tail_offset = size - len(tail)
+    pos = tail.rfind(EOCD_SIGNATURE, max(0, len(tail) - 22 - 65535))
+    if pos < 0 or pos + 22 > len(tail):
+        raise ValueError("end of central directory not found")
+    (entries, cd_size, cd_offset, comment_len) = struct.unpack("<10xHIIH", tail[pos:pos + 22])
+    if pos + 22 + comment_len != len(tail):
+        raise ValueError("data after the end of central directory")
+    cd_end = tail_offset + pos
+    locator = pos - 20
+    has_zip64 = locator >= 0 and tail[locator:locator + 4] == EOCD64_LOCATOR_SIGNATURE
+    if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF or has_zip64:
+        # zip64: the values are in the zip64 end of central directory record
+        if not has_zip64:
+            raise ValueError("zip64 end of central directory locator not found")
+        (eocd64_offset,) = struct.unpack("<Q", tail[locator + 8:locator + 16])
+        record = eocd64_offset - tail_offset
+        if record < 0 or tail[record:record + 4] != EOCD64_SIGNATURE:
+            raise ValueError("zip64 end of central directory not found")
+        (entries, cd_size, cd_offset) = struct.unpack("<QQQ", tail[record + 32:record + 56])
+        cd_end = eocd64_offset
+    if cd_offset + cd_size != cd_end:
+        raise ValueError("central directory size and offset do not match the file size")
+    return cd_offset, cd_size, entries
+
+
+def check_zip_tail(head, tail, size):
+    """
+    Checks the structure of a zip file from its first bytes and its last ones
+    :param head: first bytes of the file
+    :type head: bytes
+    :param tail: last bytes of the file
+    :type tail: bytes
+    :param size: size of the file
+    :type size: int
+    :return: None if the structure is valid, else the description of the problem
+    """
+    if not head.startswith(LOCAL_SIGNATURE):
+        return "no local file header at the beginning"
+    try:
+        (cd_offset, cd_size, entries) = locate_central_directory(tail, size)
+    except ValueError as e:
+        return str(e)
+    tail_offset = size - len(tail)
+    start = cd_offset - tail_offset
+    if start < 0:
+        # central directory larger than the tail kept in memory: only its bounds were checked
+        return None
+    nb_entries = 0
+    while start < cd_offset + cd_size - tail_offset:
+        if tail[start:start + 4] != CENTRAL_SIGNATURE:
+            return "corrupted central directory entry {:d}".format(nb_entries)
+        (name_len, extra_len, comment_len) = struct.unpack("<HHH", tail[start + 28:start + 34])
+        start += 46 + name_len + extra_len + comment_len
+        nb_entries += 1
+    if nb_entries != entries:
+        return "{:d} entries found in the central directory instead of {:d}".format(nb_entries, entries)
+    return None
+
+
+class StreamVerifier(object):
+    """ computes the sha256 and checks the zip structure of the bytes given to update() """
+
+    def __init__(self, tail_size=TAIL_SIZE):
+        self.tail_size = tail_size
+        self.reset()
+
+    def reset(self):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.tail = bytearray()
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        if len(self.head) < 4:
+            self.head = (self.head + bytes(data[:4]))[:4]
+        self.tail += data
+        if len(self.tail) > 2 * self.tail_size:
+            del self.tail[:len(self.tail) - self.tail_size]
+
+    def result(self):
+        """ returns the sha256 and None if the zip is valid, else the description of the problem """
+        error = check_zip_tail(self.head, bytes(self.tail[-self.tail_size:]), self.size)
+        return self.sha256.hexdigest(), error
+
+
+def verify_file(fileName):
+    """ verifies a file already on disk, returns its size, its sha256 and the zip problem found """
+    verifier = StreamVerifier()
+    with open(fileName, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            verifier.update(chunk)
+    sha256, error = verifier.result()
+    return verifier.size, sha256, error
+
+###########################################################################
+
+
+def acquisition(name):
+    """ returns the (platform, date, tile) of a L2A product name, or None if it is not recognised """
+    match = ACQUISITION.match(os.path.basename(name))
+    return match.groups() if match is not None else None
+
+
+class Manifest(object):
+    """
+    Index of the products of a download directory: for each product, its size,
+    its sha256, whether it was verified and whether it was extracted to its folder,
+    and for a product of which only some files were extracted, the patterns of
+    these files (see peps_extract.extract_members).
+    It is saved as MANIFEST_NAME in the directory.
+    The directory is scanned once, when the index is created, and then kept up
+    to date by the downloads, so that deciding whether a product is already on
+    disk needs no access to the file system. scan() must be called again if
+    products are added or removed by other means.
+    """
+
+    def __init__(self, write_dir):
+        self.write_dir = write_dir
+        self.fileName = os.path.join(write_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        # (platform, date, tile) -> names of the products of this acquisition in the index
+        self.by_acquisition = {}
+        self.scanned = None
+        if os.path.isfile(self.fileName):
+            with open(self.fileName) as f:
+                data = json.load(f)
+            if "products" in data:
+                self.entries = data["products"]
+                self.scanned = data.get("scanned")
+            else:
+                # manifest of a former version, which only had the downloaded products
+                self.entries = data
+        self.index_acquisitions()
+        if self.scanned is None:
+            self.scan()
+
+    def index_acquisitions(self):
+        self.by_acquisition = {}
+        for name in self.entries:
+            self.by_acquisition.setdefault(acquisition(name), set()).add(name)
+
+    def save(self):
+        tmpName = self.fileName + ".tmp"
+        with open(tmpName, "w") as f:
+            json.dump({"scanned": self.scanned, "products": self.entries}, f, indent=1, sort_keys=True)
+        os.rename(tmpName, self.fileName)
+
+    def scan(self):
+        """
+        Updates the index from the content of the directory, with a single listing:
+        zip files and product folders which are not indexed yet are added (the zip
+        files being verified by the next check), and the entries of the products
+        which are not on disk anymore are removed
+        Returns the number of entries added and removed
+        """
+        zips = {}
+        folders = set()
+        # a directory not created yet has no product
+        names = os.listdir(self.write_dir) if os.path.isdir(self.write_dir) else []
+        for name in names:
+            path = os.path.join(self.write_dir, name)
+            if name.endswith(".zip"):
+                zips[name] = os.path.getsize(path)
+            elif fnmatch.fnmatch(name, PRODUCT_PATTERN) and not name.endswith(".part") and os.path.isdir(path):
+                # the zip file of an extracted product may be kept next to its folder
+                folders.add(name + ".zip")
+        with self.lock:
+            removed = [name for name in self.entries if name not in zips and name not in folders]
+            for name in removed:
+                del self.entries[name]
+            added = []
+            for name in set(zips) | folders:
+                if name not in self.entries:
+                    added.append(name)
+                    if name in zips:
+                        self.entries[name] = {"size": zips[name], "sha256": None, "verified": None}
+                    else:
+                        self.entries[name] = {"size": None, "sha256": None, "verified": True}
+                elif name in zips and zips[name] != self.entries[name]["size"]:
+                    # replaced or truncated since it was recorded
+                    self.entries[name].update(size=zips[name], sha256=None, verified=None)
+                if name in folders:
+                    self.entries[name]["extracted"] = True
+                else:
+                    self.entries[name].pop("extracted", None)
+            self.index_acquisitions()
+            self.scanned = time.time()
+            if os.path.isdir(self.write_dir):
+                self.save()
+        return len(added), len(removed)
+
+    @staticmethod
+    def covers(entry, include=None):
+        """ tells if the files of a product in entry are those asked with the include patterns, if any """
+        if "partial" not in entry:
+            return True
+        return include is not None and set(include) <= set(entry["partial"])
+
+    def usable(self, name, include=None):
+        """ tells from the index only if the product name is valid, with the files matching include """
+        entry = self.entries.get(name)
+        return entry is not None and entry["verified"] is not False and self.covers(entry, include)
+
+    def acquisitions(self, include=None):
+        """ (platform, date, tile) of the valid products of the index, with the files matching include """
+        with self.lock:
+            return set(key for (key, names) in self.by_acquisition.items()
+                       if key is not None and any(self.usable(name, include) for name in names))
+
+    def contains(self, name, include=None, stitch=False):
+        """
+        Tells from the index only if the product name, with the files matching include,
+        is in the directory; with stitch, another product of the same acquisition,
+        processed by another window of a period, is enough
+        """
+        if self.usable(name, include):
+            return True
+        if not stitch or acquisition(name) is None:
+            return False
+        with self.lock:
+            names = list(self.by_acquisition.get(acquisition(name), ()))
+        return any(self.usable(other, include) for other in names)
+
+    def is_verified(self, name):
+        entry = self.entries.get(name)
+        return entry is not None and entry["verified"] is True
+
+    def record(self, name, size, sha256, error=None, extracted=False, partial=None):
+        """ :param partial: patterns of the files extracted, if not all of them were """
+        with self.lock:
+            self.entries[name] = {"size": size, "sha256": sha256, "verified": error is None}
+            self.by_acquisition.setdefault(acquisition(name), set()).add(name)
+            if extracted:
+                self.entries[name]["extracted"] = True
+            if partial is not None:
+                self.entries[name]["partial"] = sorted(partial)
+            if error is not None:
+                self.entries[name]["error"] = error
+            self.save()
+
+    def check(self, fileName, include=None):
+        """
+        Tells if fileName is already downloaded and valid, or extracted to its folder.
+        A product of which only some files were extracted is only there for a run
+        asking for some of these files (include patterns).
+        A zip file found by scan(), downloaded by a former version or copied in
+        the directory, is verified once and recorded.
+        """
+        name = os.path.basename(fileName)
+        entry = self.entries.get(name)
+        if entry is None or not self.covers(entry, include):
+            return False
+        if entry["verified"] is None:
+            print("verifying {}".format(name))
+            size, sha256, error = verify_file(fileName)
+            self.record(name, size, sha256, error, entry.get("extracted", False), entry.get("partial"))
+            return error is None
+        return entry["verified"] is True
+
+
+def download_verified(session, url, fileName, manifest, expected=None):
+    """
+    Downloads url to fileName, verifying it on the fly and recording it in the manifest
+    An invalid file is removed, so that it is downloaded again by the next run.
+    :param expected: estimated size of the file, if the server does not give it
+    """
+    verifier = StreamVerifier()
+    size = peps_http.downloadFile(session, url, fileName, verifier=verifier, expected=expected)
+    sha256, error = verifier.result()
+    manifest.record(os.path.basename(fileName), size, sha256, error)
+    if error is not None:
+        os.remove(fileName)
+        raise IOError("{} is not a valid zip file: {}".format(os.path.basename(fileName), error))
+    return size
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Metrics of the scripts, to find where the time of a slow batch goes: duration
+of each stage (catalog search, submission, status polling, download), number
+of requests, bytes and retries, and transitions of the jobs between states with
+the time they spent in each state.
+They are written, with the --metrics option of the scripts, as a Prometheus
+textfile (file name ending with .prom) for the textfile collector of the node
+exporter, or else appended to a JSON lines file, one line per export.
+"""
+import atexit
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# name -> (type, help) of the metrics
+METRICS = {
+    "peps_stage_seconds": ("summary", "time spent in each stage of the scripts"),
+    "peps_requests_total": ("counter", "HTTP requests made to PEPS, by kind and status code"),
+    "peps_request_seconds": ("summary", "duration of the HTTP requests, by kind"),
+    "peps_bytes_total": ("counter", "bytes received from PEPS, by kind"),
+    "peps_retries_total": ("counter", "interrupted transfers retried or resumed, by kind"),
+    "peps_catalog_features_total": ("counter", "products found by the catalog searches"),
+    "peps_submissions_total": ("counter", "processings submitted, by process and result"),
+    "peps_downloads_total": ("counter", "products downloaded, by result"),
+    "peps_job_transitions_total": ("counter", "changes of the status of the jobs"),
+    "peps_job_state_seconds": ("summary", "time spent by the jobs in a status before leaving it"),
+    "peps_jobs": ("gauge", "jobs of the script, by state"),
+    "peps_last_export_timestamp_seconds": ("gauge", "time of the export of these metrics"),
+}
+
+###########################################################################
+
+
+class Registry(object):
+    """ values of the metrics, by name and labels """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.labels = {}
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        """ adds value to a counter """
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ adds a value to a summary, exported as its _sum and _count """
+        self.count(name + "_sum", value, **labels)
+        self.count(name + "_count", 1, **labels)
+
+    def set(self, name, value, **labels):
+        """ sets a gauge """
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def samples(self):
+        """ (name, labels, value) of all the metrics, constant labels included """
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(name, dict(self.labels, **dict(labels)), value) for ((name, labels), value) in items]
+
+    def textfile(self):
+        """ metrics in the Prometheus text format """
+        lines = []
+        described = set()
+        for (name, labels, value) in self.samples():
+            base = name
+            for suffix in ("_sum", "_count"):
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                    base = name[:-len(suffix)]
+            if base not in described and base in METRICS:
+                described.add(base)
+                lines.append("# HELP {} {}".format(base, METRICS[base][1]))
+                lines.append("# TYPE {} {}".format(base, METRICS[base][0]))
+            text = ",".join('{}="{}"'.format(label, str(labels[label]).replace('\\', '\\\\').replace('"', '\\"'))
+                            for label in sorted(labels))
+            lines.append("{}{} {}".format(name, "{" + text + "}" if text else "", repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def export(self, fileName):
+        """ writes the metrics to fileName, as a textfile if it ends with .prom, else as a JSON line """
+        self.set("peps_last_export_timestamp_seconds", time.time())
+        if fileName.endswith(".prom"):
+            # the node exporter must never read a file being written
+            tmpName = "{}.{:d}.tmp".format(fileName, os.getpid())
+            with open(tmpName, "w") as f:
+                f.write(self.textfile())
+            os.rename(tmpName, fileName)
+        else:
+            metrics = {}
+            for (name, labels, value) in self.samples():
+                metrics.setdefault(name, []).append({"labels": labels, "value": value})
+            with open(fileName, "a") as f:
+                f.write(json.dumps({"time": time.time(), "metrics": metrics}, sort_keys=True) + "\n")
+
+
+registry = Registry()
+# file where the metrics are exported, see enable()
+output = None
+
+
+def count(name, value=1, **labels):
+    registry.count(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    registry.set(name, value, **labels)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of a script:
+        with peps_metrics.stage("download"):
+            ...
+    """
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        observe("peps_stage_seconds", time.time() - t0, stage=name)
+
+
+def export():
+    """ exports the metrics to the file given to enable(), if any """
+    if output is not None:
+        try:
+            registry.export(output)
+        except (IOError, OSError) as e:
+            print("metrics could not be written to {}: {}".format(output, e))
+
+
+def enable(fileName, script=None):
+    """
+    Exports the metrics to fileName when the script exits, and at each call of export()
+    :param script: name of the script, added as a label to all the metrics
+    """
+    global output
+    output = fileName
+    if output is None:
+        return
+    registry.labels["script"] = script if script is not None else os.path.splitext(
+        os.path.basename(sys.argv[0]))[0]
+    atexit.register(export)
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Order in which the products are submitted and downloaded.
+The catalog gives the products in no useful order. A policy, or a comma
+separated list of policies applied one after the other, sorts them:
+  - oldest   : by acquisition date, the natural order of MAJA, which uses the
+               previous date of a tile to process the next one
+  - smallest : by size (resourceSize of the catalog), so that the quick ones land first
+  - online   : products on disk before those on tape, whose recall by PEPS
+               overlaps with the processing of the others
+The product list written by peps_maja_process.py keeps the storage and size
+of each product, so that peps_maja_download.py can use the same policies.
+"""
+import re
+
+# acquisition date in the product name: S2A_MSIL1C_20170101T105031_... or, for the
+# names of the first products, S2A_OPER_PRD_MSIL1C_PDMC_20151230T202002_R008_V20151230T105153_...
+DATE = re.compile(r"_V(\d{8})T\d{6}|_(\d{8})T\d{6}")
+ONLINE = "disk"
+DEFAULT_POLICY = "oldest"
+
+###########################################################################
+
+
+def acquisition_date(prod):
+    """ acquisition date of a product, as YYYYMMDD, or None if it is not in its name """
+    dates = DATE.findall(prod)
+    for (validity, start) in dates:
+        if validity:
+            return validity
+    return dates[0][1] if dates else None
+
+
+def by_date(prod, storage_dict, size_dict):
+    date = acquisition_date(prod)
+    return (date is None, date)
+
+
+def by_size(prod, storage_dict, size_dict):
+    size = size_dict.get(prod)
+    return (size is None, size)
+
+
+def by_storage(prod, storage_dict, size_dict):
+    return storage_dict.get(prod) != ONLINE
+
+
+POLICIES = {"oldest": by_date, "smallest": by_size, "online": by_storage}
+
+
+def parse_policy(policy):
+    """
+    :param policy: name of a policy, or comma separated names
+    :return: list of the names, ValueError being raised for an unknown one
+    """
+    names = [name.strip() for name in policy.split(",") if name.strip() != ""]
+    for name in names:
+        if name not in POLICIES:
+            raise ValueError("unknown order {}, choose among {}".format(name, ", ".join(sorted(POLICIES))))
+    return names
+
+
+def sort_products(products, policy=DEFAULT_POLICY, storage_dict=None, size_dict=None):
+    """
+    Sorts products by policy, the first policy deciding first; products which are
+    equal for all the policies, or whose size or storage is unknown, keep their order
+    :param policy: names of the policies, as a list or comma separated
+    :param storage_dict: storage mode of the products, 'disk' or 'tape'
+    :param size_dict: size of the products, in bytes
+    """
+    names = parse_policy(policy) if not isinstance(policy, list) else policy
+    storage_dict = storage_dict or {}
+    size_dict = size_dict or {}
+    return sorted(products, key=lambda prod: tuple(POLICIES[name](prod, storage_dict, size_dict)
+                                                   for name in names))
+
+
+def write_list(fileName, products, storage_dict, size_dict):
+    """ writes a product list, one product per line followed with its storage and size """
+    with open(fileName, "w") as f:
+        for prod in products:
+            size = size_dict.get(prod)
+            f.write("%s %s %s\n" % (prod, storage_dict.get(prod, "unknown"), size if size is not None else "-"))
+
+
+def read_list(fileName):
+    """
+    Reads a product list, the storage and size columns being optional
+    :return: list of the products, and dicts of their storage modes and sizes
+    """
+    products = []
+    storage_dict = {}
+    size_dict = {}
+    with open(fileName) as f:
+        for ligne in f:
+            fields = ligne.split()
+            if len(fields) == 0:
+                continue
+            prod = fields[0]
+            products.append(prod)
+            if len(fields) > 1:
+                storage_dict[prod] = fields[1]
+            if len(fields) > 2 and fields[2].isdigit():
+                size_dict[prod] = int(fields[2])
+    return products, storage_dict, size_dict
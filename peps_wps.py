@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+Parses the answers of the PEPS WPS server.
+The documents are read from bytes in memory or from a file object, and the
+parsing stops as soon as the requested fields are known.
+"""
+import json
+import re
+from collections import namedtuple
+from xml.etree import ElementTree
+
+# bytes read at a time from a file object
+CHUNK_SIZE = 16 * 1024
+# children of wps:Status, the first one found gives the status of the process
+STATUS_TAGS = ("ProcessAccepted", "ProcessStarted", "ProcessPaused", "ProcessSucceeded", "ProcessFailed")
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+###########################################################################
+
+
+class WPSStatus(object):
+    """
+    Content of a wps:ExecuteResponse document
+    - wps_id: processing id, taken from the status location
+    - status_location: url of the document giving the processing status
+    - status: one of STATUS_TAGS
+    - percent: percentCompleted of a ProcessStarted status
+    - message: text of the status element
+    - references: href of the wps:Reference outputs
+    """
+    FIELDS = ("wps_id", "status_location", "status", "percent", "message", "references")
+
+    def __init__(self):
+        self.wps_id = None
+        self.status_location = None
+        self.status = None
+        self.percent = None
+        self.message = None
+        self.references = []
+
+    @property
+    def json_url(self):
+        """ url of the first output, the json report of the processing """
+        if len(self.references) > 0:
+            return self.references[0]
+        return None
+
+    def has(self, fields):
+        for field in fields:
+            value = getattr(self, field)
+            if value is None or value == []:
+                return False
+        return True
+
+    def __repr__(self):
+        return "WPSStatus({})".format(", ".join("{}={!r}".format(field, getattr(self, field))
+                                                for field in self.FIELDS))
+
+
+class ExecuteResponseTarget(object):
+    """ ElementTree parser target which fills a WPSStatus """
+
+    def __init__(self, status):
+        self.status = status
+        self.text = None
+
+    def start(self, tag, attrib):
+        name = tag.split("}")[-1]
+        if name == "ExecuteResponse":
+            location = attrib.get("statusLocation")
+            if location is not None:
+                self.status.status_location = location
+                match = re.search("pywps-(.+)\\.xml", location)
+                if match is not None:
+                    self.status.wps_id = match.group(1)
+        elif name in STATUS_TAGS and self.status.status is None:
+            self.status.status = name
+            if "percentCompleted" in attrib:
+                self.status.percent = int(attrib["percentCompleted"])
+            self.text = []
+        elif name == "Reference":
+            href = attrib.get("href", attrib.get(XLINK_HREF))
+            if href is not None:
+                self.status.references.append(href)
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if self.text is not None and tag.split("}")[-1] in STATUS_TAGS:
+            self.status.message = "".join(self.text).strip()
+            self.text = None
+
+    def close(self):
+        return self.status
+
+
+def parse_wps(source, fields=WPSStatus.FIELDS):
+    """
+    Parses a wps:ExecuteResponse
+    :param source: document as bytes, or binary file object
+    :param fields: WPSStatus fields needed, the parsing stops once they are all found
+    :type fields: tuple
+    :return: WPSStatus, whose fields are None when not found
+    """
+    status = WPSStatus()
+    parser = ElementTree.XMLParser(target=ExecuteResponseTarget(status))
+    if hasattr(source, "read"):
+        chunks = iter(lambda: source.read(CHUNK_SIZE), b"")
+    else:
+        chunks = (source[i:i + CHUNK_SIZE] for i in range(0, len(source), CHUNK_SIZE))
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            if status.has(fields):
+                return status
+        parser.close()
+    except ElementTree.ParseError:
+        # PEPS answers errors in JSON: keep what was found
+        pass
+    return status
+
+
+def parse_wps_file(fileName, fields=WPSStatus.FIELDS):
+    """ parses a wps:ExecuteResponse saved in fileName """
+    with open(fileName, "rb") as f:
+        return parse_wps(f, fields)
+
+###########################################################################
+
+# status of a single product MAJA processing, as given by its json report
+MajaStatus = namedtuple("MajaStatus", "percent status download_url L2A_name")
+
+
+def report_items(value, key=None):
+    """ yields the (key, value) pairs of the scalar values of a parsed json document, in document order """
+    if isinstance(value, dict):
+        for (child_key, child) in value.items():
+            for item in report_items(child, child_key):
+                yield item
+    elif isinstance(value, list):
+        for child in value:
+            for item in report_items(child, key):
+                yield item
+    else:
+        yield key, value
+
+
+def parse_maja_status(source):
+    """
+    Parses the json report of a single product MAJA processing
+    :param source: document as bytes, or binary file object
+    :return: MajaStatus, status being "computing", "finished" or "canceled";
+             ValueError is raised if the report is not json
+    """
+    if hasattr(source, "read"):
+        source = source.read()
+    report = json.loads(source.decode("utf-8"))
+    percent = 0
+    status = "computing"
+    download_url = None
+    for (key, value) in report_items(report):
+        if key == "percentCompleted":
+            percent = int(float(value))
+        elif isinstance(value, string_types):
+            if "CANCELED" in value:
+                status = "canceled"
+                break
+            if "FINISHED" in value:
+                status = "finished"
+            elif download_url is None and value.endswith(".zip"):
+                download_url = value
+        if status == "finished" and download_url is not None:
+            break
+    if status != "finished":
+        download_url = None
+    L2A_name = download_url.split('/')[-1] if download_url is not None else None
+    return MajaStatus(percent, status, download_url, L2A_name)